@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+"""Shared fixtures of the tests: the modules are imported from the top of the repository, and every test gets the
+   bundled test server on the loopback interface with a directory of its own"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tftpserver import TftpServer
+
+
+@pytest.fixture
+def serverRoot(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    return root
+
+
+@pytest.fixture
+def server(serverRoot):
+    server = TftpServer(str(serverRoot))
+    server.start()
+    yield server
+    server.stop()
+
+# End of file
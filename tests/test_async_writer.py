@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""The writer of the asyncio engine: shared threads, and a slow disk pauses reading instead of blocking the loop"""
+
+import asyncio
+import os
+import threading
+import time
+
+from tftpasync import AsyncWriteBehindWriter, TftpAsyncComm
+
+FILE_SIZE = 2 * 1024 * 1024
+
+# Seconds every write takes on the slow disk. Waiting for it on the loop would stall the loop as long
+SLOW_WRITE = 0.05
+
+
+def testDownloadsShareTheWriterThreads(tmp_path, server, serverRoot):
+    data = os.urandom(FILE_SIZE)
+    (serverRoot / "file.bin").write_bytes(data)
+
+    async def getAll():
+        comm = TftpAsyncComm()
+        return await asyncio.gather(*[comm.get(server.address[0], server.address[1], "file.bin", str(tmp_path / str(i)),
+                                               blockSize=1428, windowSize=8) for i in range(16)])
+
+    asyncio.run(getAll())
+    for i in range(16):
+        assert (tmp_path / str(i)).read_bytes() == data
+    writers = [thread for thread in threading.enumerate() if thread.name.startswith("tftpwriter")]
+    assert len(writers) <= AsyncWriteBehindWriter.WORKERS
+
+
+def testSlowDiskPausesReading(tmp_path, server, serverRoot, monkeypatch):
+    data = os.urandom(FILE_SIZE // 2)
+    (serverRoot / "file.bin").write_bytes(data)
+    writeBatch = AsyncWriteBehindWriter.writeBatch
+
+    def slowWriteBatch(self, views):
+        time.sleep(SLOW_WRITE)
+        writeBatch(self, views)
+
+    monkeypatch.setattr(AsyncWriteBehindWriter, "writeBatch", slowWriteBatch)
+
+    async def get():
+        # The loop must keep ticking while the disk is behind
+        lag = 0.0
+        task = asyncio.ensure_future(TftpAsyncComm(writeQueueSize=32 * 1024).get(server.address[0], server.address[1],
+                                                                                 "file.bin", str(tmp_path / "file.bin"),
+                                                                                 blockSize=1428, windowSize=16))
+        while not task.done():
+            start = time.monotonic()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.monotonic() - start)
+        return task.result(), lag
+
+    result, lag = asyncio.run(get())
+    assert (tmp_path / "file.bin").read_bytes() == data
+    assert result.writeStallTime > 0
+    assert lag < SLOW_WRITE / 2
+
+# End of file
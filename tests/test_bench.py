@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""The transfer benchmark, and with it the test server and the impairment proxy: a get and a put per impairment,
+   blocking and windowed, must all arrive intact"""
+
+import io
+import re
+
+import pytest
+
+from tftpbench import TransferBenchmark
+
+NO_IMPAIRMENTS = {"loss": 0.0, "delay": 0.0, "jitter": 0.0, "duplicate": 0.0, "reorder": 0.0, "seed": 1}
+
+# What the proxy counts for the impairments it counts
+STATISTICS = {"loss": "dropped", "duplicate": "duplicated", "reorder": "reordered"}
+
+
+@pytest.mark.parametrize("impairment,value", [("delay", 0.002), ("jitter", 0.002), ("loss", 0.02),
+                                              ("duplicate", 0.05), ("reorder", 0.05)])
+def testImpairment(impairment, value):
+    impairments = dict(NO_IMPAIRMENTS)
+    impairments[impairment] = value
+    output = io.StringIO()
+    results = TransferBenchmark([100000], [1428], [1, 8], ["get", "put"], repeat=1).run(impairments, output)
+    assert len(results) == 4
+    for result in results:
+        assert result["failures"] == 0, output.getvalue()
+        assert result[impairment] == value
+    # The proxy reports what it did
+    assert int(re.search(r"proxy: forwarded (\d+)", output.getvalue()).group(1)) > 0
+    if impairment in STATISTICS:
+        assert int(re.search(STATISTICS[impairment] + r" (\d+)", output.getvalue()).group(1)) > 0
+
+
+def testPutWithLoss():
+    # A lost ACK costs the client one retransmission, answered at once. When the server only answered with its own
+    # timer, this took four times as long
+    output = io.StringIO()
+    impairments = dict(NO_IMPAIRMENTS)
+    impairments["loss"] = 0.03
+    results = TransferBenchmark([300000], [512], [1, 8], ["put"], repeat=1).run(impairments, output)
+    for result in results:
+        assert result["failures"] == 0, output.getvalue()
+        assert result["seconds"] < 1.2, output.getvalue()
+
+# End of file
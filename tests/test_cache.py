@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+"""The download cache: hits put a file of the user's own in place, never the cached file itself"""
+
+import os
+
+from tftpcache import DownloadCache
+from tftpcomm import TftpComm
+
+
+def testHitCanBeOverwritten(tmp_path, server, serverRoot):
+    data = os.urandom(100000)
+    (serverRoot / "file.bin").write_bytes(data)
+    cache = DownloadCache(str(tmp_path / "cache"), ttl=60)
+    comm = TftpComm(cache=cache)
+    local = tmp_path / "file.bin"
+
+    comm.get(server.address[0], server.address[1], "file.bin", str(local))
+    result = comm.get(server.address[0], server.address[1], "file.bin", str(local))
+    assert result.cached
+    assert local.read_bytes() == data
+
+    # The file in place is not the cached one: writing it, even as root, leaves the cache alone
+    with open(local, "wb") as filehandle:
+        filehandle.write(b"changed")
+    result = comm.get(server.address[0], server.address[1], "file.bin", str(local))
+    assert result.cached
+    assert local.read_bytes() == data
+    assert cache.getStatistics()["hits"] == 2
+
+# End of file
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""Digests checked against a manifest: an upload that does not match never completes on the server, and a cached
+   file that no longer matches is fetched again"""
+
+import hashlib
+import os
+
+import pytest
+
+from tftpcache import DownloadCache
+from tftpcomm import TftpComm, TftpDigestError
+from tftpdigest import Manifest
+
+
+def createManifest(name, data):
+    manifest = Manifest()
+    manifest.add(name, "sha256", hashlib.sha256(data).hexdigest())
+    return manifest
+
+
+@pytest.mark.parametrize("windowSize", [1, 8])
+def testPutMismatch(tmp_path, server, serverRoot, windowSize):
+    data = os.urandom(100000)
+    (tmp_path / "upload.bin").write_bytes(data)
+    comm = TftpComm(manifest=createManifest("file.bin", b"something else"))
+
+    # Record what the client sends
+    sent = []
+    sendMessage = comm.sendMessage
+
+    def recordMessage(sock, message, address):
+        sent.append(bytes(message))
+        return sendMessage(sock, message, address)
+
+    comm.sendMessage = recordMessage
+    with pytest.raises(TftpDigestError) as error:
+        comm.put(server.address[0], server.address[1], "file.bin", str(tmp_path / "upload.bin"), blockSize=1428,
+                 windowSize=windowSize)
+    assert error.value.algorithm == "sha256"
+    assert error.value.actual == hashlib.sha256(data).hexdigest()
+
+    # The server was told, and never got the last block
+    assert any(message.startswith(TftpComm.ERROR) for message in sent)
+    assert (serverRoot / "file.bin").read_bytes() != data
+
+
+def testPutMatch(tmp_path, server, serverRoot):
+    data = os.urandom(100000)
+    (tmp_path / "upload.bin").write_bytes(data)
+    result = TftpComm(manifest=createManifest("file.bin", data)).put(server.address[0], server.address[1], "file.bin",
+                                                                     str(tmp_path / "upload.bin"))
+    assert (serverRoot / "file.bin").read_bytes() == data
+    assert result.digests["sha256"] == hashlib.sha256(data).hexdigest()
+
+
+def testCachedMismatchFetchedAgain(tmp_path, server, serverRoot):
+    cache = DownloadCache(str(tmp_path / "cache"), ttl=60)
+    local = tmp_path / "file.bin"
+    data = os.urandom(100000)
+    (serverRoot / "file.bin").write_bytes(data)
+    TftpComm(cache=cache, manifest=createManifest("file.bin", data)).get(server.address[0], server.address[1],
+                                                                         "file.bin", str(local))
+    result = TftpComm(cache=cache, manifest=createManifest("file.bin", data)).get(server.address[0], server.address[1],
+                                                                                  "file.bin", str(local))
+    assert result.cached
+
+    # Same size, other content, within the TTL: only the manifest tells the cached file is out of date
+    changed = os.urandom(100000)
+    (serverRoot / "file.bin").write_bytes(changed)
+    result = TftpComm(cache=cache, manifest=createManifest("file.bin", changed)).get(server.address[0], server.address[1],
+                                                                                     "file.bin", str(local))
+    assert not result.cached
+    assert local.read_bytes() == changed
+    assert result.digests["sha256"] == hashlib.sha256(changed).hexdigest()
+    statistics = cache.getStatistics()
+    assert statistics["hits"] == 1
+    assert statistics["misses"] == 2
+    assert statistics["entries"] == 1
+
+    # The entry fetched again is the new file
+    result = TftpComm(cache=cache, manifest=createManifest("file.bin", changed)).get(server.address[0], server.address[1],
+                                                                                     "file.bin", str(local))
+    assert result.cached
+
+# End of file
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Fleet transfers: the inventory, the retry policy and a run across a pool of processes"""
+
+import asyncio
+import json
+
+import pytest
+
+import tftpfleet
+from tftpcomm import TftpException, TftpServerError
+from tftpfleet import FleetOptions, FleetTarget, main, readInventory, transferTarget
+
+
+def testReadCsvInventory(tmp_path):
+    path = tmp_path / "fleet.csv"
+    path.write_text("host,port,remote,local\n"
+                    "10.0.0.1,,,\n"
+                    "switch2.example.net,6969,{host}.cfg,\n"
+                    "10.0.0.3,,,logs/{index}-{remote}\n")
+    targets = readInventory(str(path), 69, "startup.cfg", "logs/{host}-{port}.txt")
+    assert [(target.index, target.host, target.port, target.remoteFilename, target.localFilename) for target in targets] == [
+        (0, "10.0.0.1", 69, "startup.cfg", "logs/10.0.0.1-69.txt"),
+        (1, "switch2.example.net", 6969, "switch2.example.net.cfg", "logs/switch2.example.net-6969.txt"),
+        (2, "10.0.0.3", 69, "startup.cfg", "logs/2-startup.cfg")]
+
+
+def testReadJsonInventory(tmp_path):
+    path = tmp_path / "fleet.json"
+    path.write_text(json.dumps([{"host": "::1", "port": 6969}, {"host": "10.0.0.2", "remote": "other.cfg"}]))
+    targets = readInventory(str(path), remoteFilename="{host}.cfg", localFilename="switch.cfg")
+    assert [(target.host, target.port, target.remoteFilename) for target in targets] == [
+        ("::1", 6969, "::1.cfg"), ("10.0.0.2", 69, "other.cfg")]
+
+
+@pytest.mark.parametrize("name,content", [
+    ("fleet.csv", "host,remote\n,a.cfg\n"),
+    ("fleet.csv", "host,port\n10.0.0.1,x\n"),
+    ("fleet.csv", "host,remote\n10.0.0.1,{nothing}.cfg\n"),
+    ("fleet.csv", "host\n10.0.0.1\n"),
+    ("fleet.json", "{\"host\": \"10.0.0.1\"}")])
+def testReadInvalidInventory(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_text(content)
+    with pytest.raises(ValueError):
+        readInventory(str(path), localFilename="switch.cfg")
+
+
+class FailingComm:
+    """Stands in for TftpAsyncComm: every put raises the next error, then succeeds"""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+
+    async def put(self, *args):
+        if self.errors:
+            raise self.errors.pop(0)
+        raise AssertionError("no error left")
+
+
+def runTarget(errors, monkeypatch, retries=3):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(tftpfleet.asyncio, "sleep", sleep)
+    options = FleetOptions("push", retries=retries, retryDelay=0.5)
+    target = FleetTarget(0, "10.0.0.1", 69, "switch.cfg", "switch.cfg")
+
+    async def transfer():
+        return await transferTarget(FailingComm(errors), options, target, asyncio.Semaphore(1))
+
+    return asyncio.run(transfer()), delays
+
+
+def testRetriesWithDoublingDelay(monkeypatch):
+    record, delays = runTarget([TftpException("Timeout")] * 4, monkeypatch)
+    assert record["status"] == "failed"
+    assert record["attempts"] == 4
+    assert record["error"] == "Timeout"
+    assert delays == [0.5, 1.0, 2.0]
+
+
+@pytest.mark.parametrize("error", [TftpServerError(1, "File not found"), ValueError("bad block size")])
+def testFinalErrorsAreNotRetried(monkeypatch, error):
+    record, delays = runTarget([error], monkeypatch)
+    assert record["status"] == "failed"
+    assert record["attempts"] == 1
+    assert delays == []
+
+
+def testPullAcrossProcesses(tmp_path, server, serverRoot):
+    for index in range(3):
+        (serverRoot / ("file" + str(index) + ".bin")).write_bytes(bytes([index]) * 10000)
+    inventory = tmp_path / "fleet.csv"
+    # The last device does not have its file: it fails for good, without retries
+    inventory.write_text("host,remote\n127.0.0.1,\n127.0.0.1,\n127.0.0.1,\n127.0.0.1,missing.bin\n")
+    report = tmp_path / "report.json"
+
+    status = main(["pull", str(inventory), "--port", str(server.address[1]), "--remote", "file{index}.bin",
+                   "--local", str(tmp_path / "out" / "{index}.bin"), "--processes", "2", "--retry-delay", "0.01",
+                   "--report", str(report), "--quiet"])
+    assert status == 1
+    for index in range(3):
+        assert (tmp_path / "out" / (str(index) + ".bin")).read_bytes() == bytes([index]) * 10000
+
+    content = json.loads(report.read_text())
+    assert content["summary"]["targets"] == 4
+    assert content["summary"]["done"] == 3
+    assert content["summary"]["failed"] == 1
+    assert content["summary"]["bytes"] == 30000
+    assert [record["status"] for record in content["records"]] == ["done", "done", "done", "failed"]
+    assert content["records"][3]["attempts"] == 1
+    assert "File not found" in content["records"][3]["error"]
+
+# End of file
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""Netascii translation, and transfers of files whose line endings fall on the block boundaries"""
+
+import io
+import os
+
+import pytest
+
+from tftpcomm import TftpComm
+from tftpnetascii import NetasciiDecoder, encodeNetascii, getEncodedSize
+
+# Local data with every kind of line ending and CR, and what it is on the wire
+LOCAL = b"one\ntwo\r\nthree\rfour\r\0five\n\n\r\r"
+WIRE = b"one\r\ntwo\r\0\r\nthree\r\0four\r\0\0five\r\n\r\n\r\0\r\0"
+
+
+def decode(chunks):
+    decoder = NetasciiDecoder()
+    return b"".join(decoder.decode(chunk) for chunk in chunks) + decoder.decode(b"", True)
+
+
+def testEncode():
+    assert encodeNetascii(LOCAL) == WIRE
+    assert encodeNetascii(bytearray(b"a\nb")) == b"a\r\nb"
+    assert encodeNetascii(b"") == b""
+
+
+def testDecodeWhole():
+    assert decode([WIRE]) == LOCAL
+
+
+@pytest.mark.parametrize("offset", range(len(WIRE) + 1))
+def testDecodeSplit(offset):
+    # Every split, among them between the CR and the LF or NUL after it
+    assert decode([WIRE[:offset], WIRE[offset:]]) == LOCAL
+
+
+@pytest.mark.parametrize("sequence", [b"\r\n", b"\r\0"])
+def testDecodeSplitAround(sequence):
+    wire = b"ab" + sequence + b"cd" + sequence + sequence + b"e"
+    local = decode([wire])
+    for first in range(len(wire) + 1):
+        for second in range(first, len(wire) + 1):
+            assert decode([wire[:first], wire[first:second], wire[second:]]) == local
+
+
+def testDecodeByteByByte():
+    assert decode([WIRE[i:i + 1] for i in range(len(WIRE))]) == LOCAL
+
+
+def testDecodeTrailingCr():
+    # A CR ending a chunk is kept back, and comes out when the end says it stood on its own
+    decoder = NetasciiDecoder()
+    assert decoder.decode(b"abc\r") == b"abc"
+    assert decoder.decode(b"", True) == b"\r"
+    assert decode([b"abc\r"]) == b"abc\r"
+    # A bare CR from a sloppy sender stays a CR, a bare LF an LF
+    assert decode([b"a\rb\nc"]) == b"a\rb\nc"
+
+
+def testEncodedSize():
+    stream = io.BytesIO(LOCAL)
+    stream.seek(5)
+    assert getEncodedSize(stream) == len(WIRE)
+    # Back at the start, ready for the upload
+    assert stream.read() == LOCAL
+
+
+def testEncodedSizeUnknown():
+    reader, writer = os.pipe()
+    try:
+        with open(reader, "rb") as pipe:
+            assert getEncodedSize(pipe) is None
+    finally:
+        os.close(writer)
+    assert getEncodedSize(iter([LOCAL])) is None
+
+
+@pytest.mark.parametrize("windowSize", [1, 8])
+def testTransferAcrossBlocks(tmp_path, server, serverRoot, windowSize):
+    # 8 byte blocks split CR LF and CR NUL pairs everywhere, and the file ends with a lone CR
+    data = (LOCAL + b"x") * 40 + b"\r"
+    (tmp_path / "upload.txt").write_bytes(data)
+    comm = TftpComm(mode=TftpComm.MODE_NETASCII)
+    result = comm.put(server.address[0], server.address[1], "file.txt", str(tmp_path / "upload.txt"), blockSize=8,
+                      windowSize=windowSize)
+    assert (serverRoot / "file.txt").read_bytes() == data
+    assert result.fileSize == len(encodeNetascii(data))
+    comm.get(server.address[0], server.address[1], "file.txt", str(tmp_path / "download.txt"), blockSize=8,
+             windowSize=windowSize)
+    assert (tmp_path / "download.txt").read_bytes() == data
+
+# End of file
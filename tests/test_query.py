@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""Size queries of the download cache (TftpComm.queryTransferSize)"""
+
+import socket
+import threading
+import time
+
+import pytest
+
+from tftpcomm import TftpCancelledError, TftpComm, TftpTimeoutError, TransferControl
+
+
+class SilentServer:
+    """Counts the requests it gets and answers each with garbage from another port, never with a real answer"""
+
+    def __init__(self, junk):
+        self.junk = junk
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.05)
+        self.address = self.sock.getsockname()
+        self.other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                data, client = self.sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            self.requests += 1
+            # A burst of garbage used to send the request again for every packet
+            for i in range(10 if self.junk else 0):
+                self.other.sendto(b"\x00", client)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+        self.other.close()
+
+
+def testQueryTransferSize(server, serverRoot):
+    (serverRoot / "file.bin").write_bytes(b"x" * 12345)
+    assert TftpComm().queryTransferSize(server.address[0], server.address[1], "file.bin") == 12345
+
+
+def testQueryIgnoresGarbage():
+    silent = SilentServer(junk=True)
+    try:
+        with pytest.raises(TftpTimeoutError):
+            TftpComm().queryTransferSize(silent.address[0], silent.address[1], "file.bin", timeout=1500)
+    finally:
+        silent.stop()
+    # The first request and the ones the doubling timer sends within the timeout, none for the garbage
+    assert silent.requests <= 2
+
+
+def testQueryCancel():
+    silent = SilentServer(junk=False)
+    control = TransferControl()
+    threading.Timer(0.1, control.cancel).start()
+    start = time.monotonic()
+    try:
+        with pytest.raises(TftpCancelledError):
+            TftpComm().queryTransferSize(silent.address[0], silent.address[1], "file.bin", timeout=10000, control=control)
+    finally:
+        silent.stop()
+    assert time.monotonic() - start < 0.5
+
+# End of file
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""Resolution of the servers: the cache of HostResolver, and transfers over IPv6"""
+
+import asyncio
+import os
+import socket
+import threading
+
+import pytest
+
+import tftpresolve
+from tftpasync import TftpAsyncComm
+from tftpcomm import TftpComm
+from tftpresolve import HostResolver
+from tftpserver import TftpServer
+
+
+class FakeDns:
+    """Stands in for getaddrinfo and the clock: counts the lookups, and time only moves when told"""
+
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        self.lookups = []
+        self.addresses = {"switch.example.net": "192.0.2.10"}
+        monkeypatch.setattr(tftpresolve.socket, "getaddrinfo", self.getaddrinfo)
+        monkeypatch.setattr(tftpresolve.time, "monotonic", lambda: self.now)
+
+    def getaddrinfo(self, host, port, family, type):
+        self.lookups.append(host)
+        if host not in self.addresses:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_DGRAM, 17, "", (self.addresses[host], 0))]
+
+
+def testTtl(monkeypatch):
+    dns = FakeDns(monkeypatch)
+    resolver = HostResolver(ttl=60)
+    assert resolver.resolve("switch.example.net", 69) == (socket.AF_INET, ("192.0.2.10", 69))
+    dns.now += 59
+    assert resolver.resolve("switch.example.net", 6969) == (socket.AF_INET, ("192.0.2.10", 6969))
+    assert dns.lookups == ["switch.example.net"]
+
+    # Expired: looked up again, and a new address is taken
+    dns.addresses["switch.example.net"] = "192.0.2.11"
+    dns.now += 2
+    assert resolver.resolve("switch.example.net", 69) == (socket.AF_INET, ("192.0.2.11", 69))
+    assert dns.lookups == ["switch.example.net"] * 2
+    assert resolver.getStatistics() == {"hits": 1, "lookups": 2, "failures": 0, "entries": 1}
+
+
+def testNegativeTtl(monkeypatch):
+    dns = FakeDns(monkeypatch)
+    resolver = HostResolver(ttl=60, negativeTtl=10)
+    for i in range(2):
+        with pytest.raises(OSError):
+            resolver.resolve("gone.example.net", 69)
+    assert dns.lookups == ["gone.example.net"]
+
+    dns.addresses["gone.example.net"] = "192.0.2.20"
+    dns.now += 11
+    assert resolver.resolve("gone.example.net", 69) == (socket.AF_INET, ("192.0.2.20", 69))
+
+
+def testPrefetch(monkeypatch):
+    dns = FakeDns(monkeypatch)
+    dns.addresses["other.example.net"] = "192.0.2.30"
+    resolver = HostResolver()
+    resolver.prefetch(["switch.example.net", "other.example.net", "[switch.example.net]"])
+    resolver.executor.shutdown(wait=True)
+    assert sorted(dns.lookups) == ["other.example.net", "switch.example.net"]
+    assert resolver.resolve("other.example.net", 69) == (socket.AF_INET, ("192.0.2.30", 69))
+    assert len(dns.lookups) == 2
+
+
+def testConcurrentLookupsCoalesce(monkeypatch):
+    dns = FakeDns(monkeypatch)
+    release = threading.Event()
+    getaddrinfo = dns.getaddrinfo
+
+    def slowGetaddrinfo(*args):
+        release.wait()
+        return getaddrinfo(*args)
+
+    monkeypatch.setattr(tftpresolve.socket, "getaddrinfo", slowGetaddrinfo)
+    resolver = HostResolver()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve("switch.example.net", 69))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8
+    assert dns.lookups == ["switch.example.net"]
+
+
+def hasIpv6():
+    if not socket.has_ipv6:
+        return False
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as sock:
+            sock.bind(("::1", 0))
+        return True
+    except OSError:
+        return False
+
+
+@pytest.fixture
+def server6(serverRoot):
+    if not hasIpv6():
+        pytest.skip("IPv6 is not available")
+    server = TftpServer(str(serverRoot), host="::1")
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.mark.parametrize("host", ["::1", "[::1]"])
+def testIpv6RoundTrip(tmp_path, server6, serverRoot, host):
+    data = os.urandom(100000)
+    (tmp_path / "upload.bin").write_bytes(data)
+    comm = TftpComm()
+    comm.put(host, server6.address[1], "file.bin", str(tmp_path / "upload.bin"), blockSize=1428, windowSize=8)
+    assert (serverRoot / "file.bin").read_bytes() == data
+    comm.get(host, server6.address[1], "file.bin", str(tmp_path / "download.bin"), blockSize=1428, windowSize=8)
+    assert (tmp_path / "download.bin").read_bytes() == data
+
+    asyncio.run(TftpAsyncComm().get(host, server6.address[1], "file.bin", str(tmp_path / "async.bin")))
+    assert (tmp_path / "async.bin").read_bytes() == data
+
+# End of file
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""Retransmissions of uploads: duplicated packets must not make the client send windows again"""
+
+import asyncio
+import os
+
+from tftpasync import TftpAsyncComm
+from tftpcomm import TftpComm
+from tftpserver import ImpairmentProxy
+
+# 2048 blocks of 512 bytes in windows of 8
+FILE_SIZE = 1024 * 1024
+BLOCK_SIZE = 512
+WINDOW_SIZE = 8
+
+# About 5% of the packets are duplicated, every one of them used to cost a window. A few windows sent again, after
+# a duplicate arrived as late as a timeout, are fine
+MAX_RETRANSMITS = 200
+
+
+def createFile(tmp_path):
+    path = tmp_path / "upload.bin"
+    path.write_bytes(os.urandom(FILE_SIZE))
+    return path
+
+
+def startProxy(server):
+    proxy = ImpairmentProxy(server.address, duplicate=0.05, seed=1)
+    proxy.start()
+    return proxy
+
+
+def testWindowedPutWithDuplicates(tmp_path, server, serverRoot):
+    path = createFile(tmp_path)
+    proxy = startProxy(server)
+    try:
+        result = TftpComm().put(proxy.address[0], proxy.address[1], "upload.bin", str(path), blockSize=BLOCK_SIZE,
+                                windowSize=WINDOW_SIZE)
+    finally:
+        proxy.stop()
+    assert (serverRoot / "upload.bin").read_bytes() == path.read_bytes()
+    assert result.metrics.retransmits <= MAX_RETRANSMITS
+
+
+def testAsyncWindowedPutWithDuplicates(tmp_path, server, serverRoot):
+    path = createFile(tmp_path)
+    proxy = startProxy(server)
+    try:
+        result = asyncio.run(TftpAsyncComm().put(proxy.address[0], proxy.address[1], "upload.bin", str(path),
+                                                 blockSize=BLOCK_SIZE, windowSize=WINDOW_SIZE))
+    finally:
+        proxy.stop()
+    assert (serverRoot / "upload.bin").read_bytes() == path.read_bytes()
+    assert result.metrics.retransmits <= MAX_RETRANSMITS
+
+# End of file
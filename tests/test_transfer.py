@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""Round trips of the blocking and the asyncio engine against the bundled test server on the loopback interface"""
+
+import asyncio
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from tftpasync import TftpAsyncComm
+from tftpcomm import TftpCancelledError, TftpComm, TransferControl
+from tftpnetascii import encodeNetascii
+from tftpserver import ImpairmentProxy, TftpServer
+
+SIZES = [(512, 1), (1428, 8), (8192, 16)]
+
+
+def createFile(path, size):
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return data
+
+
+@pytest.fixture
+def proxy(server):
+    proxy = ImpairmentProxy(server.address, duplicate=0.05, loss=0.02, seed=7)
+    proxy.start()
+    yield proxy
+    proxy.stop()
+
+
+@pytest.mark.parametrize("mode", TftpComm.MODES)
+@pytest.mark.parametrize("blockSize,windowSize", SIZES)
+def testPutGet(tmp_path, server, serverRoot, blockSize, windowSize, mode):
+    # A multiple of the block size, which ends with an empty block, and one more byte. In netascii the server
+    # translates the file back, so it arrives unchanged too
+    comm = TftpComm(mode=mode)
+    for size in (blockSize * 100, blockSize * 100 + 1):
+        data = createFile(tmp_path / "upload.bin", size)
+        comm.put(server.address[0], server.address[1], "file.bin", str(tmp_path / "upload.bin"),
+                 blockSize=blockSize, windowSize=windowSize)
+        assert (serverRoot / "file.bin").read_bytes() == data
+        result = comm.get(server.address[0], server.address[1], "file.bin", str(tmp_path / "download.bin"),
+                          blockSize=blockSize, windowSize=windowSize)
+        assert (tmp_path / "download.bin").read_bytes() == data
+        # The size on the wire, with the line endings translated in netascii
+        assert result.fileSize == (size if mode == TftpComm.MODE_OCTET else len(encodeNetascii(data)))
+        assert result.blockSize == blockSize
+        assert result.windowSize == windowSize
+
+
+@pytest.mark.parametrize("mode", TftpComm.MODES)
+@pytest.mark.parametrize("blockSize,windowSize", SIZES)
+def testStreams(server, serverRoot, blockSize, windowSize, mode):
+    data = os.urandom(blockSize * 50 + 7)
+    comm = TftpComm(mode=mode)
+
+    # From a generator, whose size is not known up front
+    chunks = (data[start:start + 1000] for start in range(0, len(data), 1000))
+    comm.putStream(server.address[0], server.address[1], "file.bin", chunks, blockSize=blockSize,
+                   windowSize=windowSize)
+    assert (serverRoot / "file.bin").read_bytes() == data
+
+    stream = io.BytesIO()
+    comm.getStream(server.address[0], server.address[1], "file.bin", stream, blockSize=blockSize,
+                   windowSize=windowSize)
+    assert stream.getvalue() == data
+
+
+@pytest.mark.parametrize("rollover", [TftpComm.ROLLOVER_ZERO, TftpComm.ROLLOVER_ONE])
+def testRollover(tmp_path, rollover):
+    # 8 byte blocks, so the block numbers wrap around after half a MB
+    root = tmp_path / "root"
+    root.mkdir()
+    server = TftpServer(str(root), rollover=rollover)
+    server.start()
+    try:
+        data = createFile(tmp_path / "upload.bin", 8 * 70000 + 3)
+        comm = TftpComm(rollover=rollover)
+        comm.put(server.address[0], server.address[1], "file.bin", str(tmp_path / "upload.bin"), blockSize=8, windowSize=16)
+        assert (root / "file.bin").read_bytes() == data
+        comm.get(server.address[0], server.address[1], "file.bin", str(tmp_path / "download.bin"), blockSize=8, windowSize=16)
+        assert (tmp_path / "download.bin").read_bytes() == data
+    finally:
+        server.stop()
+
+
+@pytest.mark.parametrize("windowSize", [1, 8])
+def testDuplicatesAndLoss(tmp_path, serverRoot, proxy, windowSize):
+    data = createFile(tmp_path / "upload.bin", 100000)
+    TftpComm().put(proxy.address[0], proxy.address[1], "file.bin", str(tmp_path / "upload.bin"), blockSize=1428,
+                   windowSize=windowSize)
+    assert (serverRoot / "file.bin").read_bytes() == data
+    TftpComm().get(proxy.address[0], proxy.address[1], "file.bin", str(tmp_path / "download.bin"), blockSize=1428,
+                   windowSize=windowSize)
+    assert (tmp_path / "download.bin").read_bytes() == data
+    assert proxy.statistics["dropped"] > 0
+    assert proxy.statistics["duplicated"] > 0
+
+
+@pytest.mark.parametrize("windowSize", [1, 8])
+def testAsyncDuplicatesAndLoss(tmp_path, serverRoot, proxy, windowSize):
+    data = createFile(tmp_path / "upload.bin", 100000)
+
+    async def putGet():
+        comm = TftpAsyncComm()
+        await comm.put(proxy.address[0], proxy.address[1], "file.bin", str(tmp_path / "upload.bin"), blockSize=1428,
+                       windowSize=windowSize)
+        await comm.get(proxy.address[0], proxy.address[1], "file.bin", str(tmp_path / "download.bin"), blockSize=1428,
+                       windowSize=windowSize)
+
+    asyncio.run(putGet())
+    assert (serverRoot / "file.bin").read_bytes() == data
+    assert (tmp_path / "download.bin").read_bytes() == data
+
+
+@pytest.mark.parametrize("direction", ["get", "put"])
+def testCancel(tmp_path, server, serverRoot, direction):
+    # Lock-step through a proxy delaying every packet, so the transfer is still running when cancelled
+    createFile(serverRoot / "file.bin", 1000000)
+    createFile(tmp_path / "upload.bin", 1000000)
+    slowProxy = ImpairmentProxy(server.address, delay=0.01)
+    slowProxy.start()
+    control = TransferControl()
+    cancelled = []
+
+    def cancel():
+        cancelled.append(time.monotonic())
+        control.cancel()
+
+    threading.Timer(0.2, cancel).start()
+    try:
+        with pytest.raises(TftpCancelledError):
+            getattr(TftpComm(), direction)(slowProxy.address[0], slowProxy.address[1], "file.bin",
+                                           str(tmp_path / "upload.bin"), timeout=10000, stop=control)
+        latency = time.monotonic() - cancelled[0]
+    finally:
+        slowProxy.stop()
+    assert latency < 0.05
+
+# End of file
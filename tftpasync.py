@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+
+"""asyncio TFTP engine. Runs the same state machines as TftpComm, but driven by datagrams arriving on an event loop
+   and by loop timers instead of threads blocking in socket timeouts, so thousands of transfers fit in one thread.
+
+   Example:
+     results = await asyncio.gather(*[TftpAsyncComm().put(ip, 69, "switch.cfg", "switch.cfg") for ip in ips])"""
+
+import asyncio
+import concurrent.futures
+import struct
+import threading
+import time
+
+from tftpcomm import TftpComm, TftpException, TftpTimeoutError, TftpServerError, TftpDigestError, TransferResult, RttEstimator, \
+    WriteBehindWriter
+from tftptrace import RECEIVED
+
+
+class TftpAsyncComm:
+    """asyncio TFTP communication class. get() and put() are coroutines taking the same arguments as the ones in
+       TftpComm, except for the stop lambda: cancel the task to stop a transfer, the server is told about it"""
+
+    def __init__(self, fsyncPolicy=WriteBehindWriter.FSYNC_NEVER, writeQueueSize=TftpComm.DEFAULT_WRITE_QUEUE_SIZE, maxFileSize=None,
+                 metricsCallback=None, rollover=TftpComm.ROLLOVER_ZERO, rateLimit=None, digests=(), manifest=None, trace=None,
+                 resolver=None, mode=TftpComm.MODE_OCTET):
+        """rateLimit caps the packets per second sent by all the transfers together, None for no limit. The other
+           arguments are those of TftpComm"""
+        # The synchronous engine is used for checking arguments and for building and parsing messages
+        self.tftpComm = TftpComm(fsyncPolicy, writeQueueSize, maxFileSize, metricsCallback, rollover,
+                                 digests=digests, manifest=manifest, trace=trace, resolver=resolver, mode=mode)
+        self.rateLimiter = PacketRateLimiter(rateLimit) if rateLimit else None
+
+    async def get(self, ip, port, remoteFilename, localFilename, timeout=TftpComm.DEFAULT_TIMEOUT,
+                  blockSize=TftpComm.DEFAULT_BLOCK_SIZE, windowSize=TftpComm.DEFAULT_WINDOW_SIZE, progressCallback=None):
+        """Download a file from the server and return a TransferResult. Raises a TftpException if the transfer fails"""
+        self.tftpComm.checkArguments(ip, port, blockSize, windowSize)
+        result = TransferResult()
+        with open(localFilename, "wb") as filehandle:
+            protocol = AcceptDataProtocol(self.tftpComm, ip, port, remoteFilename, filehandle, timeout,
+                                          blockSize, windowSize, progressCallback or self.tftpComm.ignoreProgress, result)
+            try:
+                await self.runTransfer(protocol)
+            finally:
+                # Wait for the writer, the loop goes on meanwhile
+                try:
+                    await protocol.closeWriter()
+                finally:
+                    self.tftpComm.reportMetrics(result.metrics)
+            # The writer has seen every block by now
+            self.tftpComm.finishDigests(remoteFilename, protocol.digest, protocol.expectedDigests, result)
+        return result
+
+    async def put(self, ip, port, remoteFilename, localFilename, timeout=TftpComm.DEFAULT_TIMEOUT,
+                  blockSize=TftpComm.DEFAULT_BLOCK_SIZE, windowSize=TftpComm.DEFAULT_WINDOW_SIZE, progressCallback=None):
+        """Upload a file to the server and return a TransferResult. Raises a TftpException if the transfer fails"""
+        self.tftpComm.checkArguments(ip, port, blockSize, windowSize)
+        result = TransferResult()
+        try:
+            with open(localFilename, "rb") as filehandle:
+                await self.runTransfer(SendDataProtocol(self.tftpComm, ip, port, remoteFilename, filehandle, timeout,
+                                                        blockSize, windowSize, progressCallback or self.tftpComm.ignoreProgress, result))
+        finally:
+            self.tftpComm.reportMetrics(result.metrics)
+        return result
+
+    async def runTransfer(self, protocol):
+        """Open a UDP endpoint for the protocol and wait until the transfer is over. The endpoint is closed however
+           the transfer ends, including when the task is cancelled"""
+        loop = asyncio.get_running_loop()
+        protocol.done = loop.create_future()
+        protocol.rateLimiter = self.rateLimiter
+        try:
+            family, protocol.request = await self.tftpComm.resolver.resolveAsync(protocol.host, protocol.port)
+        except OSError as e:
+            raise TftpException(str(e)) from e
+        protocol.server = protocol.request
+        transport, ignore = await loop.create_datagram_endpoint(lambda: protocol, family=family)
+        try:
+            await protocol.done
+        except asyncio.CancelledError:
+            # Tell the server, so that it does not retransmit until it times out
+            if protocol.serverKnown:
+                self.tftpComm.abortTransfer(transport, protocol.server)
+            raise
+        finally:
+            protocol.stopTimer()
+            protocol.close()
+            protocol.metrics.finish()
+            transport.close()
+
+
+class PacketRateLimiter:
+    """Spaces out the packets of all the transfers sharing it to at most rate packets per second, with bursts of up
+       to burst packets (by default 10 ms worth). Packets over the limit are not dropped but booked a later slot, in
+       the order they were sent (a token bucket kept as the time of the next free slot)"""
+
+    def __init__(self, rate, burst=None):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(1, int(rate / 100)) if burst is None else burst) * self.interval
+        self.nextSlot = 0.0
+
+    def reserve(self):
+        """Book the next slot for a packet. Returns how long to wait before sending it, 0 to send it now"""
+        now = time.monotonic()
+        self.nextSlot = max(self.nextSlot, now) + self.interval
+        return max(0.0, self.nextSlot - now - self.tolerance)
+
+
+class AsyncWriteBehindWriter(WriteBehindWriter):
+    """The WriteBehindWriter of the asyncio engine, which neither has a thread of its own nor ever waits on the loop.
+       Datagrams are queued as they came, asyncio hands over a new bytes object for each one, and a thread pool
+       shared by all the transfers writes them in batches, one batch of a file at a time so the blocks stay in order.
+       Once more than the queue size waits for the disk the protocol stops reading its socket until a batch has been
+       written: the datagrams wait in the socket buffer, and the time they wait is the stall time"""
+    # Threads writing for all the transfers, in every loop
+    WORKERS = 4
+    executor = None
+    executorLock = threading.Lock()
+
+    def __init__(self, filehandle, queueSize, fsyncPolicy, digest, decoder, pauseReading, resumeReading):
+        self.queueSize = queueSize
+        self.pauseReading = pauseReading
+        self.resumeReading = resumeReading
+        super().__init__(filehandle, queueSize, queueSize, fsyncPolicy, digest, decoder)
+
+    @classmethod
+    def getExecutor(cls):
+        with cls.executorLock:
+            if cls.executor is None:
+                cls.executor = concurrent.futures.ThreadPoolExecutor(cls.WORKERS, "tftpwriter")
+            return cls.executor
+
+    def start(self):
+        self.blocks = []
+        self.queuedBytes = 0
+        self.drainTask = None
+        self.pausedSince = None
+
+    def write(self, data, start, end):
+        """Queue data[start:end] for writing. Never waits, over the queue size the protocol stops reading instead"""
+        self.checkError()
+        self.blocks.append((data, start, end))
+        self.queuedBytes += end - start
+        self.queuePeak = max(self.queuePeak, len(self.blocks))
+        if self.drainTask is None:
+            self.drainTask = asyncio.get_running_loop().create_task(self.drain())
+        if self.queuedBytes >= self.queueSize and self.pausedSince is None:
+            self.pausedSince = time.monotonic()
+            self.pauseReading()
+
+    async def drain(self):
+        """Write what is queued, a batch at a time, until the queue is empty"""
+        loop = asyncio.get_running_loop()
+        while self.blocks:
+            batch = self.blocks
+            self.blocks = []
+            await loop.run_in_executor(self.getExecutor(), self.writeBatches, batch, False)
+            self.queuedBytes -= sum(end - start for data, start, end in batch)
+            if self.pausedSince is not None and self.queuedBytes < self.queueSize:
+                self.stallTime += time.monotonic() - self.pausedSince
+                self.resumeReading(time.monotonic() - self.pausedSince)
+                self.pausedSince = None
+        self.drainTask = None
+
+    def writeBatches(self, batch, done):
+        """Write a batch in pieces small enough for one writev() each. Runs in the pool"""
+        for start in range(0, len(batch), self.MAX_BATCH):
+            self.writeBlocks(batch[start:start + self.MAX_BATCH], done and start + self.MAX_BATCH >= len(batch))
+        if not batch:
+            self.writeBlocks(batch, done)
+
+    async def close(self):
+        """Wait for everything queued to be written (and synced if the policy asks for it). Raises a TftpException if
+           any write failed"""
+        if self.drainTask is not None:
+            await self.drainTask
+        # The last batch, even an empty one, flushes the translation and syncs at the end
+        await asyncio.get_running_loop().run_in_executor(self.getExecutor(), self.writeBatches, self.blocks, True)
+        self.blocks = []
+        self.checkError()
+
+
+class TftpTransferProtocol(asyncio.DatagramProtocol):
+    """Base class of the transfer protocols. Takes care of the retransmission timer and of finishing the transfer.
+       The transport is used in place of the socket when calling the TftpComm message helpers, it has the same
+       sendto() method"""
+    DIRECTION = None # "get" or "put", for the metrics
+
+    def __init__(self, tftpComm, ip, port, remoteFilename, filehandle, timeout, blockSize, windowSize, progressCallback, result):
+        self.tftpComm = tftpComm
+        self.host = ip
+        self.port = int(port)
+        self.request = None # Resolved socket address of the server, set by TftpAsyncComm.runTransfer()
+        self.server = None
+        self.serverKnown = False # Set with the first answer, from then on anyone else is rejected
+        self.remoteFilename = remoteFilename
+        self.filehandle = filehandle
+        self.requestedBlockSize = blockSize
+        self.requestedWindowSize = windowSize
+        self.blockSize = blockSize
+        self.windowSize = windowSize
+        self.progressCallback = progressCallback
+        self.result = result
+        self.metrics = result.metrics
+
+        self.transport = None
+        self.done = None
+        self.timer = None
+        self.requestSent = False
+
+        # Packets wait for their slot when a PacketRateLimiter is set, the retransmission timer waits for them too
+        self.rateLimiter = None
+        self.pacingDelay = 0.0
+
+        # The retransmission timer follows the round trip time, the user timeout is how long the server may stay silent
+        self.rtt = RttEstimator(timeout / 1000, self.metrics)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.metrics.start(self.DIRECTION, self.host, self.port, self.remoteFilename)
+        self.sendRequest()
+
+    def error_received(self, exc):
+        self.fail(TftpException("Connection error: " + str(exc)))
+
+    def datagram_received(self, data, addr):
+        if self.tftpComm.trace is not None:
+            self.tftpComm.trace.record(RECEIVED, data, len(data), self.transport, addr)
+        if self.done.done():
+            return
+        if self.serverKnown and addr != self.server:
+            self.tftpComm.rejectTransferId(self.transport, addr)
+            return
+        try:
+            self.handleMessage(data, addr)
+        except TftpException as e:
+            self.fail(e)
+
+    def sendMessage(self, message, server):
+        """Send a message, dropping it if the endpoint is already gone. With a rate limit it may go out later"""
+        if self.transport.is_closing():
+            return
+        self.pacingDelay = self.rateLimiter.reserve() if self.rateLimiter is not None else 0.0
+        if self.pacingDelay > 0:
+            asyncio.get_running_loop().call_later(self.pacingDelay, self.sendNow, message, server)
+        else:
+            self.tftpComm.sendMessage(self.transport, message, server)
+
+    def sendNow(self, message, server):
+        """Send a message whose slot has come"""
+        if not self.transport.is_closing():
+            self.tftpComm.sendMessage(self.transport, message, server)
+
+    def setServer(self, server):
+        """The first answer decides which port of the server the transfer goes on with"""
+        self.server = server
+        self.serverKnown = True
+
+    def startTimer(self):
+        """(Re)start the retransmission timer. Only sending restarts it, packets which are ignored do not"""
+        self.stopTimer()
+        self.timer = asyncio.get_running_loop().call_later(self.rtt.getTimeout() + self.pacingDelay, self.timerExpired)
+
+    def stopTimer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def timerExpired(self):
+        """Called by the loop when nothing came back in time. Retransmits or gives up once the server has been silent
+           for too long"""
+        self.timer = None
+        if self.done.done():
+            return
+        if self.rtt.expired():
+            self.fail(TftpTimeoutError("Timeout"))
+            return
+        self.rtt.backoff()
+        self.retransmit()
+
+    def close(self):
+        """Release what the protocol holds once the transfer is over"""
+        pass
+
+    def finish(self):
+        self.stopTimer()
+        if not self.done.done():
+            self.done.set_result(self.result)
+
+    def fail(self, error):
+        self.stopTimer()
+        if not self.done.done():
+            self.done.set_exception(error)
+
+    def negotiate(self, options, server):
+        """Apply the options acknowledged by the server, None if it ignored them"""
+        self.blockSize = self.tftpComm.negotiateBlockSize(self.transport, server, options, self.requestedBlockSize)
+        self.windowSize = self.tftpComm.negotiateWindowSize(self.transport, server, options, self.requestedWindowSize)
+        self.result.blockSize = self.blockSize
+        self.result.windowSize = self.windowSize
+        self.result.transferSize = self.tftpComm.negotiateTransferSize(options)
+
+
+class AcceptDataProtocol(TftpTransferProtocol):
+    """Accepts data from the server, the asyncio counterpart of TftpComm.acceptDataStateMachine()"""
+    DIRECTION = "get"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        # The expected block number is the number of the last block received in order
+        self.firstBlock = True
+        self.expectedBlockNumber = 0
+        self.blocksInWindow = 0
+        self.windowBroken = False
+        self.lastAckSent = None
+        self.preallocated = False
+
+        # Blocks are written, and digested, by the pool of the writer. When too much waits for the disk, reading the
+        # socket pauses, which bounds the memory used without blocking the loop
+        self.digest, self.expectedDigests = self.tftpComm.createDigest(self.remoteFilename)
+        self.writer = AsyncWriteBehindWriter(self.filehandle, self.tftpComm.writeQueueSize, self.tftpComm.fsyncPolicy, self.digest,
+                                             self.tftpComm.createDecoder(), self.pauseReading, self.resumeReading)
+        self.readingPaused = False
+
+    async def closeWriter(self):
+        """Wait for the blocks received to be written. Raises a TftpException if writing failed"""
+        try:
+            await self.writer.close()
+        finally:
+            self.result.writeQueuePeak = self.writer.queuePeak
+            self.result.writeStallTime = self.writer.stallTime
+            self.metrics.diskTime += self.writer.writeTime
+            if self.preallocated and self.result.fileSize != self.result.transferSize:
+                await asyncio.get_running_loop().run_in_executor(self.writer.getExecutor(), self.filehandle.truncate, self.result.fileSize)
+
+    def pauseReading(self):
+        """Called by the writer when the disk falls behind. The server cannot be heard meanwhile, so the timer stops"""
+        self.readingPaused = True
+        self.stopTimer()
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+
+    def resumeReading(self, duration):
+        """Called by the writer once it caught up. The pause counts neither against the deadline nor the timer"""
+        self.readingPaused = False
+        self.rtt.suspend(duration)
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+        if not self.done.done():
+            self.startTimer()
+
+    def startTimer(self):
+        # No timer while reading is paused, resumeReading() starts it
+        if not self.readingPaused:
+            super().startTimer()
+
+    def sendRequest(self):
+        self.progressCallback(0, None)
+        self.sendMessage(self.tftpComm.createReadRequest(self.remoteFilename, self.tftpComm.mode,
+                                                         self.tftpComm.createOptions(self.requestedBlockSize, self.requestedWindowSize, 0)), self.request)
+        self.rtt.packetSent(self.requestSent, self.pacingDelay)
+        self.metrics.retransmits += self.requestSent
+        self.requestSent = True
+        self.startTimer()
+
+    def sendAck(self):
+        self.sendMessage(self.tftpComm.ACK + struct.pack(">H", self.tftpComm.toWireBlockNumber(self.expectedBlockNumber)), self.server)
+        # Sending the same ACK again is a retransmission
+        self.rtt.packetSent(self.lastAckSent == self.expectedBlockNumber, self.pacingDelay)
+        self.metrics.retransmits += self.lastAckSent == self.expectedBlockNumber
+        self.lastAckSent = self.expectedBlockNumber
+        self.firstBlock = False
+        self.blocksInWindow = 0
+
+    def retransmit(self):
+        # Either go back to the start or acknowledge the last good block again
+        if self.firstBlock:
+            self.sendRequest()
+        else:
+            self.sendAck()
+            self.startTimer()
+
+    def handleMessage(self, data, addr):
+        tftpComm = self.tftpComm
+
+        # Anything too short to have a header is garbage
+        if len(data) < tftpComm.HEADER_SIZE:
+            return
+        opcode, blockNumber = tftpComm.HEADER.unpack_from(data)
+        blockNumber = tftpComm.fromWireBlockNumber(blockNumber, self.expectedBlockNumber)
+
+        if self.firstBlock and opcode == tftpComm.OPCODE_OACK:
+            # The server accepted our options, acknowledge them with block number 0
+            self.setServer(addr)
+            self.rtt.progress()
+            self.negotiate(tftpComm.parseOptionAck(data), addr)
+            # With the size known, refuse files which are too big and reserve the space for the rest
+            if self.result.transferSize is not None:
+                tftpComm.checkFileSize(self.transport, addr, self.result.transferSize)
+                self.preallocated = tftpComm.preallocate(self.transport, addr, self.filehandle, self.result.transferSize)
+                self.progressCallback(0, self.result.transferSize)
+            self.sendAck()
+            self.startTimer()
+
+        elif opcode == tftpComm.OPCODE_DATA and blockNumber == self.expectedBlockNumber + 1:
+            # Data without an OACK means the server ignored our options, use the default sizes
+            if self.firstBlock:
+                self.setServer(addr)
+                self.negotiate(None, addr)
+                self.firstBlock = False
+
+            self.expectedBlockNumber += 1
+            self.blocksInWindow += 1
+            self.windowBroken = False
+            self.rtt.progress()
+            dataSize = len(data) - tftpComm.HEADER_SIZE
+            self.writer.write(data, tftpComm.HEADER_SIZE, len(data))
+
+            self.result.nPackets += 1
+            self.result.bytesLastPacket = len(data)
+            self.result.fileSize += dataSize
+            tftpComm.checkFileSize(self.transport, self.server, self.result.fileSize)
+
+            # Only acknowledge at the end of a window, the last block ends the transfer
+            if dataSize < self.blockSize:
+                self.sendAck()
+                self.metrics.recordBytes(self.result.fileSize)
+                self.progressCallback(self.result.fileSize, self.result.transferSize)
+                self.finish()
+            elif self.blocksInWindow >= self.windowSize:
+                self.sendAck()
+                self.metrics.recordBytes(self.result.fileSize)
+                self.progressCallback(self.result.fileSize, self.result.transferSize)
+                self.startTimer()
+
+        elif opcode == tftpComm.OPCODE_ERROR:
+            code, message = tftpComm.parseErrorMessage(data)
+            raise TftpServerError(code, message)
+
+        elif opcode == tftpComm.OPCODE_OACK or (opcode == tftpComm.OPCODE_DATA and blockNumber <= self.expectedBlockNumber):
+            # Like the blocking state machine, blocks we already have and OACKs acknowledged before are ignored. If
+            # our ACK got lost, the retransmission timer sends it again
+            self.metrics.duplicates += 1
+
+        elif opcode == tftpComm.OPCODE_DATA:
+            # A block which skipped a missing one, acknowledge the last good one so the server restarts the window there
+            self.metrics.outOfOrder += 1
+            if not self.firstBlock and not self.windowBroken:
+                self.windowBroken = True
+                self.sendAck()
+                self.startTimer()
+
+
+class SendDataProtocol(TftpTransferProtocol):
+    """Sends data to the server, the asyncio counterpart of TftpComm.sendDataStateMachine()"""
+    DIRECTION = "put"
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.state = "send_request"
+        self.lastBlockSent = False
+        # Blocks sent but not acknowledged yet. The first one in the list is always the one after the last ACK.
+        # Each message is built once from a view of the file and sent as it is when retransmitting
+        self.window = []
+        self.nextBlockNumber = 1
+        self.source = None
+        self.size = self.tftpComm.getUploadSize(self.filehandle)
+        self.sentTime = None # When the window was last sent
+        self.retransmission = False # Whether blocks of the window sent last had been sent before
+        self.echoBlockNumber = None # ACK expected twice after the window was sent again, see sendDataStateMachine()
+        self.digest, self.expectedDigests = self.tftpComm.createDigest(self.remoteFilename)
+
+    def sendRequest(self):
+        self.progressCallback(0, self.size)
+        self.sendMessage(self.tftpComm.createWriteRequest(self.remoteFilename, self.tftpComm.mode,
+                                                          self.tftpComm.createOptions(self.requestedBlockSize, self.requestedWindowSize, self.size)), self.request)
+        self.rtt.packetSent(self.requestSent, self.pacingDelay)
+        self.metrics.retransmits += self.requestSent
+        self.requestSent = True
+        self.startTimer()
+
+    def sendWindow(self):
+        """Top up the window with new blocks from the file and send all of it. Blocks which were not acknowledged
+           are sent again"""
+        # Blocks left in the window have been sent before, so this round is a retransmission
+        resent = len(self.window)
+        self.retransmission = resent > 0
+
+        while len(self.window) < self.windowSize and not self.lastBlockSent:
+            data = self.source.getBlock(self.nextBlockNumber - 1)
+            if len(data) < self.blockSize:
+                self.lastBlockSent = True
+
+            self.window.append(self.tftpComm.HEADER.pack(self.tftpComm.OPCODE_DATA, self.tftpComm.toWireBlockNumber(self.nextBlockNumber)) + data)
+            self.nextBlockNumber += 1
+            self.result.fileSize += len(data)
+            # Like the blocking state machine, a file which does not match never reaches the server in full
+            if self.digest is not None and self.lastBlockSent:
+                try:
+                    self.tftpComm.finishDigests(self.remoteFilename, self.digest, self.expectedDigests, self.result)
+                except TftpDigestError as e:
+                    # The traceback keeps this frame, the view of the file must not stay with it
+                    data = None
+                    self.sendMessage(self.tftpComm.createErrorMessage(self.tftpComm.ERROR_CODE_NOT_DEFINED, "Digest mismatch"), self.server)
+                    self.fail(e)
+                    return
+
+        # The last block has been acknowledged, we are done
+        if not self.window:
+            self.finish()
+            return
+
+        for message in self.window:
+            self.sendMessage(message, self.server)
+            self.result.nPackets += 1
+            self.result.bytesLastPacket = len(message)
+        self.rtt.packetSent(self.retransmission, self.pacingDelay)
+        self.metrics.retransmits += resent
+        self.sentTime = time.monotonic() + self.pacingDelay
+        self.startTimer()
+
+    def close(self):
+        if self.source is not None:
+            self.metrics.diskTime += self.source.readTime
+            self.source.close()
+            self.source = None
+
+    def retransmit(self):
+        if self.state == "send_request":
+            self.sendRequest()
+        else:
+            self.echoBlockNumber = self.nextBlockNumber - 1
+            self.sendWindow()
+
+    def handleMessage(self, data, addr):
+        if self.state == "send_request":
+            ackedBlockNumber, server, options = self.tftpComm.parseAck(self.transport, data, addr, 0)
+            if ackedBlockNumber is None:
+                return
+
+            # An OACK carries the negotiated options, a plain ACK means the server ignored them
+            self.setServer(server)
+            self.rtt.progress()
+            self.negotiate(options, server)
+            self.source = self.tftpComm.createUploadSource(self.filehandle, self.blockSize, self.digest)
+            self.state = "send_window"
+            self.sendWindow()
+            return
+
+        expectedBlockNumber = self.nextBlockNumber - 1
+        ackedBlockNumber, server, options = self.tftpComm.parseAck(self.transport, data, addr, expectedBlockNumber, len(self.window))
+
+        # Stale ACKs and garbage are ignored
+        if ackedBlockNumber is None:
+            return
+
+        # Like the blocking state machine, the ACK of the block before the window (the highest one acknowledged)
+        # makes us send the window again right away, unless it is a copy of the ACK which made us send it
+        if ackedBlockNumber <= expectedBlockNumber - len(self.window):
+            self.metrics.duplicates += 1
+            if ackedBlockNumber == self.echoBlockNumber:
+                self.echoBlockNumber = None
+            elif self.rtt.allowsFastRetransmit(self.sentTime):
+                self.metrics.fastRetransmits += 1
+                self.echoBlockNumber = expectedBlockNumber
+                self.sendWindow()
+            return
+
+        # Slide the window past the acknowledged blocks. An ACK stopping short of the end of the window asks for the
+        # rest of it, after a retransmission only once the window had time to arrive
+        self.rtt.progress()
+        del self.window[:len(self.window) - (expectedBlockNumber - ackedBlockNumber)]
+        self.metrics.recordBytes(min(ackedBlockNumber * self.blockSize, self.size))
+        self.progressCallback(min(ackedBlockNumber * self.blockSize, self.size), self.size)
+        if not self.window or self.tftpComm.allowsPartialRetransmit(self.rtt, self.retransmission, self.sentTime):
+            if self.window:
+                self.echoBlockNumber = expectedBlockNumber
+            self.sendWindow()
+
+# End of file
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+"""Benchmarks of the TFTP engine. Everything runs on 127.0.0.1, no server or network is needed.
+
+   Examples:
+     python -m tftpbench receive
+     python -m tftpbench receive --block-sizes 512 8192 65464 --packets 50000
+     python -m tftpbench transfer
+     python -m tftpbench transfer --loss 0 0.01 0.05 --delay 0.001 --json results.json
+     python -m tftpbench transfer --modes octet netascii --text --loss 0"""
+
+import argparse
+import filecmp
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from tftpcomm import TftpComm, TftpException
+from tftpserver import ImpairmentProxy, TftpServer
+
+
+class ReceiveBenchmark:
+    """Micro-benchmark of the per-packet work of the receive path: receiving a DATA message, checking its header and
+       writing its payload. Compares the copying path (recvfrom, slices and a packed comparison key) with the
+       zero-copy one used by TftpComm.acceptDataStateMachine (recvfrom_into a preallocated buffer, a precompiled
+       header struct and a memoryview of the payload). The payload is written to /dev/null"""
+
+    def __init__(self, blockSize, packets):
+        self.blockSize = blockSize
+        self.packets = packets
+        self.messages = [TftpComm.DATA + struct.pack(">H", blockNumber % 65536) + bytes(blockSize) for blockNumber in range(1, 257)]
+
+    def openSockets(self):
+        """Create a sender and a receiver socket on the loopback interface. Returns the sockets and how many
+           messages fit in the receive buffer at once"""
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(1)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.connect(receiver.getsockname())
+
+        # The kernel may give us less than we asked for. Keep well under it so nothing is dropped
+        receiveBuffer = receiver.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        batch = max(1, min(256, receiveBuffer // (2 * (self.blockSize + 1024))))
+        return sender, receiver, batch
+
+    def receiveCopying(self, sock, filehandle, count, blockNumber, measure):
+        """Receive count messages the way the state machine used to. Returns the next block number"""
+        for i in range(count):
+            if measure:
+                tracemalloc.reset_peak()
+            data, server = sock.recvfrom(self.blockSize + 4)
+            if (data[0:2] == TftpComm.DATA) and (data[2:4] == struct.pack(">H", blockNumber % 65536)):
+                filehandle.write(data[4:])
+                if len(data[4:]) < self.blockSize:
+                    pass
+            if measure:
+                self.recordAllocation()
+            blockNumber += 1
+        return blockNumber
+
+    def receiveZeroCopy(self, sock, filehandle, count, blockNumber, measure):
+        """Receive count messages the way the state machine does now. Returns the next block number"""
+        buffer = self.buffer
+        view = self.view
+        header = TftpComm.HEADER
+        for i in range(count):
+            if measure:
+                tracemalloc.reset_peak()
+            nbytes, server = sock.recvfrom_into(buffer)
+            opcode, receivedBlockNumber = header.unpack_from(buffer)
+            if opcode == TftpComm.OPCODE_DATA and receivedBlockNumber == blockNumber % 65536:
+                filehandle.write(view[TftpComm.HEADER_SIZE:nbytes])
+                if nbytes - TftpComm.HEADER_SIZE < self.blockSize:
+                    pass
+            if measure:
+                self.recordAllocation()
+            blockNumber += 1
+        return blockNumber
+
+    def recordAllocation(self):
+        """Add the memory allocated while handling the last packet, above what was live before it"""
+        current, peak = tracemalloc.get_traced_memory()
+        self.allocatedBytes += peak - self.baseline
+        self.baseline = current
+
+    def run(self, zeroCopy, measure=False):
+        """Run one pass. With measure set, tracemalloc tracks the memory allocated per packet (which slows the
+           pass down, so its timing is not meaningful). Returns packets per second and bytes allocated per packet"""
+        receive = self.receiveZeroCopy if zeroCopy else self.receiveCopying
+        self.buffer = bytearray(self.blockSize + TftpComm.HEADER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.allocatedBytes = 0
+
+        sender, receiver, batch = self.openSockets()
+        filehandle = open(os.devnull, "wb", buffering=0)
+        if measure:
+            tracemalloc.start()
+            self.baseline = tracemalloc.get_traced_memory()[0]
+
+        try:
+            received = 0
+            blockNumber = 1
+            elapsed = 0
+            while received < self.packets:
+                count = min(batch, self.packets - received)
+                # Only the receiving side is timed, sending is the same for both paths
+                for i in range(count):
+                    sender.send(self.messages[(blockNumber + i - 1) % len(self.messages)])
+                start = time.perf_counter()
+                blockNumber = receive(receiver, filehandle, count, blockNumber, measure)
+                elapsed += time.perf_counter() - start
+                received += count
+        finally:
+            if measure:
+                tracemalloc.stop()
+            filehandle.close()
+            sender.close()
+            receiver.close()
+
+        return self.packets / elapsed, self.allocatedBytes / self.packets
+
+
+def runReceiveBenchmark(blockSizes, packets, output=sys.stdout):
+    """Run the receive micro-benchmark for every block size and print a table"""
+    output.write("%10s %-10s %14s %12s %16s\n" % ("block size", "path", "packets/s", "MB/s", "alloc bytes/pkt"))
+    for blockSize in blockSizes:
+        benchmark = ReceiveBenchmark(blockSize, packets)
+        for zeroCopy in (False, True):
+            packetsPerSecond, ignore = benchmark.run(zeroCopy)
+            ignore, allocated = benchmark.run(zeroCopy, measure=True)
+            output.write("%10d %-10s %14.0f %12.1f %16.0f\n" % (blockSize, "zero-copy" if zeroCopy else "copying",
+                                                                 packetsPerSecond, packetsPerSecond * blockSize / 1e6, allocated))
+
+
+def runServer(root, impairments, connection):
+    """Child process of the transfer benchmark: serve root, behind an impairment proxy if any impairment is set, send
+       the port to use over the connection and serve until told to stop. Sends the proxy statistics back at the end"""
+    # Retransmit quickly like a server on a LAN would, but keep trying for as long as the client does. Puts do not
+    # wait for this timer: a DATA block sent again because its ACK was lost gets the ACK again right away
+    server = TftpServer(root, timeout=0.05, retries=100).start()
+    proxy = None
+    if any(value for key, value in impairments.items() if key != "seed"):
+        proxy = ImpairmentProxy(server.address, **impairments).start()
+    connection.send((proxy or server).address[1])
+
+    connection.recv()
+    if proxy:
+        proxy.stop()
+    server.stop()
+    connection.send(proxy.statistics if proxy else {})
+
+
+class TransferBenchmark:
+    """End to end benchmark of gets and puts against the bundled server, through the impairment proxy. The server runs
+       in a child process, so the CPU time measured is the client's alone and the two do not share an interpreter
+       lock. Every transferred file is compared with the original, a transfer that fails or corrupts the file counts
+       as a failure. Netascii transfers are translated by the server too, so their files come back unchanged and
+       are checked the same way"""
+
+    def __init__(self, fileSizes, blockSizes, windowSizes, directions, repeat=3, timeout=5000, modes=(TftpComm.MODE_OCTET,), text=False):
+        """With text the files are lines of log text instead of random bytes, which is what netascii is for: a line
+           ending every few dozen bytes rather than one in 128 bytes"""
+        self.fileSizes = fileSizes
+        self.blockSizes = blockSizes
+        self.windowSizes = windowSizes
+        self.directions = directions
+        self.repeat = repeat
+        self.timeout = timeout
+        self.modes = modes
+        self.text = text
+        self.tftpComms = {mode: TftpComm(mode=mode) for mode in modes}
+
+    def createFiles(self, directory):
+        """Create a file of random bytes, or of text, for every size. Returns their names"""
+        names = {}
+        for fileSize in self.fileSizes:
+            names[fileSize] = "bench-" + str(fileSize)
+            with open(os.path.join(directory, names[fileSize]), "wb") as filehandle:
+                filehandle.write(self.createText(fileSize) if self.text else os.urandom(fileSize))
+        return names
+
+    def createText(self, size):
+        """Lines like the ones of a device log, size bytes of them"""
+        lines = []
+        length = 0
+        while length < size:
+            line = b"%010d %08x interface ge-0/0/%d changed state to %s\n" % (len(lines), random.getrandbits(32),
+                                                                            len(lines) % 48, random.choice([b"up", b"down"]))
+            lines.append(line)
+            length += len(line)
+        return b"".join(lines)[:size]
+
+    def transfer(self, direction, mode, port, root, localDirectory, name, blockSize, windowSize):
+        """Run one transfer and check the result. Returns a dictionary with its measurements"""
+        original = os.path.join(root, name)
+        if direction == "get":
+            localFile = os.path.join(localDirectory, name)
+            copy = localFile
+        else:
+            localFile = original
+            copy = os.path.join(root, name + ".put")
+
+        startTime = time.perf_counter()
+        startCpu = time.process_time()
+        error = None
+        try:
+            if direction == "get":
+                result = self.tftpComms[mode].get("127.0.0.1", port, name, localFile, self.timeout, blockSize, windowSize)
+            else:
+                result = self.tftpComms[mode].put("127.0.0.1", port, name + ".put", localFile, self.timeout, blockSize, windowSize)
+        except TftpException as e:
+            result = None
+            error = str(e)
+        elapsed = time.perf_counter() - startTime
+        cpu = time.process_time() - startCpu
+
+        if error is None and not filecmp.cmp(original, copy, shallow=False):
+            error = "File corrupted"
+        return {"seconds": elapsed,
+                "cpu": cpu,
+                "packets": result.nPackets if result else 0,
+                "retransmits": result.metrics.retransmits if result else 0,
+                "error": error}
+
+    def run(self, impairments, output=sys.stdout):
+        """Run every combination of direction, file size, block size and window size with the given impairments
+           (keyword arguments of ImpairmentProxy). Prints a line per combination and returns a list of result
+           dictionaries, with the median of the repeats"""
+        root = tempfile.mkdtemp(prefix="tftpbench-")
+        localDirectory = os.path.join(root, "local")
+        os.mkdir(localDirectory)
+        names = self.createFiles(root)
+
+        context = multiprocessing.get_context("spawn")
+        connection, childConnection = context.Pipe()
+        process = context.Process(target=runServer, args=(root, impairments, childConnection), daemon=True)
+        process.start()
+        results = []
+        try:
+            port = connection.recv()
+            for direction in self.directions:
+                for fileSize in self.fileSizes:
+                    for blockSize in self.blockSizes:
+                        for windowSize in self.windowSizes:
+                            # The modes next to each other, for comparison
+                            for mode in self.modes:
+                                runs = [self.transfer(direction, mode, port, root, localDirectory, names[fileSize], blockSize, windowSize)
+                                        for i in range(self.repeat)]
+                                result = self.summarize(direction, mode, fileSize, blockSize, windowSize, impairments, runs)
+                                self.writeResult(result, output)
+                                results.append(result)
+        finally:
+            connection.send("stop")
+            proxyStatistics = connection.recv()
+            process.join()
+            shutil.rmtree(root, ignore_errors=True)
+        if proxyStatistics:
+            output.write("proxy: " + ", ".join(key + " " + str(value) for key, value in proxyStatistics.items()) + "\n")
+        return results
+
+    def summarize(self, direction, mode, fileSize, blockSize, windowSize, impairments, runs):
+        """Median measurements of the runs of one combination. Failed runs are counted, not measured"""
+        good = [run for run in runs if run["error"] is None]
+        seconds = statistics.median(run["seconds"] for run in good) if good else 0
+        cpu = statistics.median(run["cpu"] for run in good) if good else 0
+        packets = statistics.median(run["packets"] for run in good) if good else 0
+        megabytes = fileSize / 1e6
+        result = {"direction": direction, "mode": mode, "fileSize": fileSize, "blockSize": blockSize, "windowSize": windowSize}
+        result.update(impairments)
+        result.update({"runs": len(runs),
+                       "failures": len(runs) - len(good),
+                       "errors": sorted(set(run["error"] for run in runs if run["error"] is not None)),
+                       "seconds": seconds,
+                       "megabytesPerSecond": megabytes / seconds if seconds > 0 else 0,
+                       "packetsPerSecond": packets / seconds if seconds > 0 else 0,
+                       "cpuMsPerMegabyte": 1000 * cpu / megabytes if megabytes > 0 else 0,
+                       "retransmits": statistics.median(run["retransmits"] for run in good) if good else 0})
+        return result
+
+    def writeResult(self, result, output):
+        output.write("%-4s %-8s %6.3f %10d %6d %4d %10.2f %12.0f %10.1f %6d %s\n" % (
+            result["direction"], result["mode"], result["loss"], result["fileSize"], result["blockSize"], result["windowSize"],
+            result["megabytesPerSecond"], result["packetsPerSecond"], result["cpuMsPerMegabyte"], result["retransmits"],
+            "FAILED " + str(result["failures"]) + "/" + str(result["runs"]) + ": " + "; ".join(result["errors"]) if result["failures"] else "ok"))
+
+
+def runTransferBenchmark(args, output=sys.stdout):
+    """Run the transfer benchmark for every loss rate and print a table. Returns the results"""
+    benchmark = TransferBenchmark(args.file_sizes, args.block_sizes, args.window_sizes, args.directions, args.repeat, args.timeout,
+                                  args.modes, args.text)
+    output.write("%-4s %-8s %6s %10s %6s %4s %10s %12s %10s %6s %s\n" % ("dir", "mode", "loss", "file size", "block", "win",
+                                                                   "MB/s", "packets/s", "CPU ms/MB", "rexmit", "status"))
+    results = []
+    for loss in args.loss:
+        impairments = {"loss": loss, "delay": args.delay, "jitter": args.jitter, "duplicate": args.duplicate,
+                       "reorder": args.reorder, "seed": args.seed}
+        results.extend(benchmark.run(impairments, output))
+    return results
+
+
+def main(argv=None):
+    """Run the benchmarks selected on the command line"""
+    parser = argparse.ArgumentParser(prog="tftpbench", description="TFTP engine benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    receiveParser = subparsers.add_parser("receive", help="per-packet cost of the receive path")
+    receiveParser.add_argument("--block-sizes", type=int, nargs="+", default=[512, 1428, 8192, 65464])
+    receiveParser.add_argument("--packets", type=int, default=20000)
+
+    transferParser = subparsers.add_parser("transfer", help="gets and puts against the bundled server, with impairments")
+    transferParser.add_argument("--file-sizes", type=int, nargs="+", default=[65536, 1048576, 4194304])
+    transferParser.add_argument("--block-sizes", type=int, nargs="+", default=[512, 1428, 8192])
+    transferParser.add_argument("--window-sizes", type=int, nargs="+", default=[1, 8])
+    transferParser.add_argument("--directions", choices=["get", "put"], nargs="+", default=["get", "put"])
+    transferParser.add_argument("--modes", choices=TftpComm.MODES, nargs="+", default=[TftpComm.MODE_OCTET], help="transfer modes to run, side by side")
+    transferParser.add_argument("--text", action="store_true", help="transfer files of log text instead of random bytes")
+    transferParser.add_argument("--loss", type=float, nargs="+", default=[0.0, 0.01], help="packet loss rates to run with")
+    transferParser.add_argument("--delay", type=float, default=0.0, help="delay added to every packet, in seconds")
+    transferParser.add_argument("--jitter", type=float, default=0.0, help="random extra delay up to this, in seconds")
+    transferParser.add_argument("--duplicate", type=float, default=0.0, help="probability of duplicating a packet")
+    transferParser.add_argument("--reorder", type=float, default=0.0, help="probability of reordering a packet")
+    transferParser.add_argument("--seed", type=int, default=1, help="seed of the impairments (default: %(default)s)")
+    transferParser.add_argument("--repeat", type=int, default=3, help="runs of every combination, the median is reported")
+    transferParser.add_argument("--timeout", type=float, default=5000, help="client timeout in ms (default: %(default)s)")
+    transferParser.add_argument("--json", metavar="FILE", help="also write the results to a JSON file")
+
+    args = parser.parse_args(argv)
+    if args.benchmark == "receive":
+        runReceiveBenchmark(args.block_sizes, args.packets)
+    elif args.benchmark == "transfer":
+        results = runTransferBenchmark(args)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as filehandle:
+                json.dump(results, filehandle, indent=2)
+        # Any failed transfer fails the run, so it can gate a release
+        if any(result["failures"] for result in results):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""On-disk cache of downloaded files. Files are kept by server (host and port) and remote file name, so fetching the
+   same boot image or config again costs a single size query, or nothing at all while the entry is younger than the
+   time to live. The cache is bounded in size and evicts the least recently used files first.
+
+   Example:
+     from tftpcache import DownloadCache
+     from tftpcomm import TftpComm
+
+     tftpComm = TftpComm(cache=DownloadCache("/var/cache/tftp", maxSize=1024 * 1024 * 1024, ttl=300))
+     tftpComm.get("192.168.1.10", 69, "boot.img", "boot.img")"""
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+from tftpcomm import TftpServerError
+from tftpdigest import digestFile
+from tftpmetrics import writeFileAtomically
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class DownloadCache:
+    """Cache of downloaded files in a directory of its own. An entry is used again without asking the server while
+       it is younger than ttl seconds (None: always ask), otherwise when the server reports the same size (RFC 2349)
+       as the cached file. Servers which do not report sizes get the file transferred every time the TTL has run
+       out. A hit puts the file in place as a reflink (a copy-on-write clone, where the file system supports it) or
+       else as a copy, never as a hard link: the file at localFilename is the user's to write to, the cached one is
+       read-only and must stay as it is. The digests computed while a file was downloaded are kept with it, a hit reports them (and checks
+       them against the manifest of the engine) without reading the file"""
+    INDEX_FILE = "index.json"
+    DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+    # ioctl cloning a whole file on Linux (btrfs, xfs and others)
+    FICLONE = 0x40049409
+
+    def __init__(self, directory, maxSize=DEFAULT_MAX_SIZE, ttl=None):
+        """Keep up to maxSize bytes of files in directory, which is created if needed. Files bigger than that are
+           not cached"""
+        self.directory = directory
+        self.maxSize = maxSize
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+        # The index maps the entry names to the server, remote file, size and fetch and use times of the entries.
+        # Transfers run in parallel threads, so it is only touched under the lock
+        self.lock = threading.Lock()
+        self.index = self.readIndex()
+        self.statistics = {"hits": 0, "misses": 0, "evictions": 0, "bytesSaved": 0}
+
+    def readIndex(self):
+        """The index saved in the directory. Entries whose file has gone are dropped"""
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE), "r", encoding="utf-8") as filehandle:
+                index = json.load(filehandle)
+        except (OSError, ValueError):
+            return {}
+        return {name: entry for name, entry in index.items() if os.path.isfile(os.path.join(self.directory, name))}
+
+    def writeIndex(self):
+        writeFileAtomically(os.path.join(self.directory, self.INDEX_FILE), json.dumps(self.index, indent=1))
+
+    def getEntryName(self, ip, port, remoteFilename):
+        """File name of the entry of a remote file, the same for the same server and remote file"""
+        key = str(ip) + "\0" + str(int(port)) + "\0" + remoteFilename
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, tftpComm, ip, port, remoteFilename, localFilename, timeout, blockSize, windowSize, stop, progressCallback, result):
+        """Put a remote file at localFilename, from the cache if the entry is valid and from the server with the
+           engine tftpComm otherwise. The other arguments and errors are those of TftpComm.acceptDataStateMachine().
+           Sets result.cached on a hit"""
+        digest, expectedDigests = tftpComm.createDigest(remoteFilename)
+        name = self.getEntryName(ip, port, remoteFilename)
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            entry = self.index.get(name)
+
+        if entry is not None:
+            # Within the TTL the entry is used as it is, after that the server has to confirm the size
+            confirmed = False
+            valid = self.ttl is not None and time.time() - entry["fetchTime"] < self.ttl
+            if not valid:
+                try:
+                    size = tftpComm.queryTransferSize(ip, port, remoteFilename, timeout, stop)
+                except TftpServerError:
+                    # Gone from the server, or no longer readable
+                    self.remove(name)
+                    raise
+                valid = confirmed = size == entry["size"]
+            if valid and digest is not None:
+                try:
+                    digests = self.getDigests(path, entry, digest.getAlgorithms())
+                except FileNotFoundError:
+                    digests = None
+                # Same size but other content than the manifest says: the file changed on the server, fetch it again
+                valid = digests is not None and all(digests[algorithm] == expectedDigest for algorithm, expectedDigest in expectedDigests.items())
+                if valid:
+                    result.digests = digests
+                else:
+                    self.remove(name)
+            if valid:
+                try:
+                    self.placeFile(path, localFilename)
+                except FileNotFoundError:
+                    # Removed behind our back, fetch it again
+                    valid = False
+            if valid:
+                with self.lock:
+                    entry["useTime"] = time.time()
+                    if confirmed:
+                        entry["fetchTime"] = entry["useTime"]
+                    self.statistics["hits"] += 1
+                    self.statistics["bytesSaved"] += entry["size"]
+                    self.writeIndex()
+                result.cached = True
+                result.fileSize = entry["size"]
+                result.transferSize = entry["size"]
+                progressCallback(entry["size"], entry["size"])
+                return
+
+        # Download into a temporary file next to the entries, so a failed transfer never leaves a broken entry
+        with self.lock:
+            self.statistics["misses"] += 1
+        descriptor, temporaryFile = tempfile.mkstemp(dir=self.directory, prefix="download-")
+        try:
+            with open(descriptor, "wb") as filehandle:
+                tftpComm.acceptDataStateMachine(ip, port, remoteFilename, filehandle, timeout, blockSize, windowSize,
+                                                stop, progressCallback, result)
+            if result.fileSize > self.maxSize:
+                # Too big to keep, it only goes to its place
+                os.chmod(temporaryFile, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+                shutil.move(temporaryFile, localFilename)
+                self.remove(name)
+                return
+            os.chmod(temporaryFile, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(temporaryFile, path)
+        except BaseException:
+            try:
+                os.remove(temporaryFile)
+            except OSError:
+                pass
+            raise
+
+        now = time.time()
+        with self.lock:
+            self.index[name] = {"host": str(ip), "port": int(port), "remoteFile": remoteFilename,
+                                "size": result.fileSize, "fetchTime": now, "useTime": now, "digests": result.digests}
+            self.evict()
+            self.writeIndex()
+        self.placeFile(path, localFilename)
+
+    def getDigests(self, path, entry, algorithms):
+        """The digests of a cached file for the given algorithms. The ones computed during the download are in the
+           entry, the file is only read for algorithms asked for later on"""
+        with self.lock:
+            digests = dict(entry.get("digests", {}))
+        missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+        if missing:
+            digests.update(digestFile(path, missing))
+            with self.lock:
+                entry["digests"] = dict(digests)
+        return {algorithm: digests[algorithm] for algorithm in algorithms}
+
+    def placeFile(self, path, localFilename):
+        """Put a cached file at localFilename, replacing what is there: as a reflink or, where that does not work,
+           as a copy. A hard link would share the cached file, which then breaks on the next write to localFilename:
+           opening it fails on the read-only file, or, for root, the cached copy gets overwritten"""
+        temporaryFile = localFilename + ".cache"
+        try:
+            os.remove(temporaryFile)
+        except FileNotFoundError:
+            pass
+
+        if not self.cloneFile(path, temporaryFile):
+            shutil.copyfile(path, temporaryFile)
+        os.replace(temporaryFile, localFilename)
+
+    def cloneFile(self, path, destination):
+        """Clone a file as a reflink. Returns False if the platform or file system cannot"""
+        if fcntl is None:
+            return False
+        with open(path, "rb") as source:
+            with open(destination, "wb") as filehandle:
+                try:
+                    fcntl.ioctl(filehandle.fileno(), self.FICLONE, source.fileno())
+                    return True
+                except OSError:
+                    pass
+        os.remove(destination)
+        return False
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its maximum size. Call with the lock held"""
+        total = sum(entry["size"] for entry in self.index.values())
+        for name in sorted(self.index, key=lambda name: self.index[name]["useTime"]):
+            if total <= self.maxSize:
+                break
+            total -= self.index[name]["size"]
+            self.removeEntry(name)
+            self.statistics["evictions"] += 1
+
+    def removeEntry(self, name):
+        """Remove an entry and its file. Call with the lock held"""
+        self.index.pop(name, None)
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def remove(self, name):
+        with self.lock:
+            if name in self.index:
+                self.removeEntry(name)
+                self.writeIndex()
+
+    def clear(self):
+        """Remove all the entries"""
+        with self.lock:
+            for name in list(self.index):
+                self.removeEntry(name)
+            self.writeIndex()
+
+    def getSize(self):
+        """Bytes of files in the cache"""
+        with self.lock:
+            return sum(entry["size"] for entry in self.index.values())
+
+    def getStatistics(self):
+        """Hits, misses, evictions and bytes not transferred thanks to the cache since it was created, together with
+           the number of entries and their size in bytes"""
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics["entries"] = len(self.index)
+            statistics["size"] = sum(entry["size"] for entry in self.index.values())
+        return statistics
+
+# End of file
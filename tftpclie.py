@@ -8,18 +8,26 @@ from tkinter import messagebox
 
 # Import configparse for configuration ini file
 import configparser
+import os
+import time
 
-# Import stuff to create threads
-import threading
-from time import sleep
-
-# Import socket stuff
-import ipaddress
-import socket
-import struct
+# Import the TFTP protocol engine
+from tftpcomm import TftpComm, TftpCancelledError, TransferEventQueue
+from tftpresolve import MAX_HOST_LENGTH
+from tftpstats import TransferStatisticsStore, formatSummary
 
 class TftpClientGui:
-    """TFTP Client GUI class. We use this to draw and handle the GUI"""
+    """TFTP Client GUI class. We use this to draw and handle the GUI. Transfers run in threads and Tk is not thread
+       safe, so they never touch the GUI: their events are queued and picked up by a timer on the main thread"""
+    # How often the transfer events are polled, in ms (about 30 updates per second)
+    POLL_INTERVAL = 33
+
+    # Settings are kept in memory and written to config.ini once they have not changed for this long, in ms
+    CONFIG_FLUSH_DELAY = 1000
+    CONFIG_FILE = "config.ini"
+
+    # When the window is closed, running transfers get this long (in seconds) to stop and tell their servers
+    SHUTDOWN_TIMEOUT = 1.0
 
     def __init__(self, master, tftpComm):
         """Create the GUI"""
@@ -40,11 +48,18 @@ class TftpClientGui:
         self.timeoutStr = StringVar()
         self.timeoutStr.trace("w", self.timeoutStrCallback)
 
+        self.blockSizeStr = StringVar()
+        self.blockSizeStr.trace("w", self.blockSizeStrCallback)
+
+        self.windowSizeStr = StringVar()
+        self.windowSizeStr.trace("w", self.windowSizeStrCallback)
+
         # Create master object for GUI (needed by Tkinter)
         self.master = master
 
-        # Create TFTP communication object
+        # Create TFTP communication object and the queue its transfer threads report to
         self.tftpComm = tftpComm
+        self.transferEvents = TransferEventQueue()
 
         # Create a title
         master.title("TFTP Client")
@@ -87,29 +102,63 @@ class TftpClientGui:
         self.timeoutUnitLabel = Label(master, text="ms")
         self.timeoutUnitLabel.grid(sticky="W", row=4, column=3, padx=5, pady=5)
 
+        self.blockSizeLabel = Label(master, text="Block size")
+        self.blockSizeLabel.grid(sticky="W", row=5, column=1, padx=5, pady=5)
+
+        self.blockSizeTextInput = Entry(master, width=10, textvariable = self.blockSizeStr)
+        self.blockSizeTextInput.grid(sticky="W", row=5, column=2, padx=5, pady=5)
+
+        self.blockSizeUnitLabel = Label(master, text="bytes")
+        self.blockSizeUnitLabel.grid(sticky="W", row=5, column=3, padx=5, pady=5)
+
+        self.windowSizeLabel = Label(master, text="Window size")
+        self.windowSizeLabel.grid(sticky="W", row=6, column=1, padx=5, pady=5)
+
+        self.windowSizeTextInput = Entry(master, width=10, textvariable = self.windowSizeStr)
+        self.windowSizeTextInput.grid(sticky="W", row=6, column=2, padx=5, pady=5)
+
+        self.windowSizeUnitLabel = Label(master, text="blocks")
+        self.windowSizeUnitLabel.grid(sticky="W", row=6, column=3, padx=5, pady=5)
+
         self.getButton = Button(master, text="Get", command=self.getTftp)
-        self.getButton.grid(sticky="W", row=5, column=1, padx=5, pady=5)
+        self.getButton.grid(sticky="W", row=7, column=1, padx=5, pady=5)
 
         self.putButton = Button(master, text="Put", command=self.putTftp)
-        self.putButton.grid(sticky="W", row=5, column=2, padx=5, pady=5)
+        self.putButton.grid(sticky="W", row=7, column=2, padx=5, pady=5)
 
         self.breakButton = Button(master, text="Break", command=self.breakTftp)
-        self.breakButton.grid(sticky="W", row=5, column=3, padx=5, pady=5)
+        self.breakButton.grid(sticky="W", row=7, column=3, padx=5, pady=5)
+
+        self.pauseButton = Button(master, text="Pause", command=self.pauseTftp)
+        self.pauseButton.grid(sticky="W", row=7, column=4, padx=5, pady=5)
 
         self.progressBar = Progressbar(master, orient="horizontal", length=400, mode="determinate")
-        self.progressBar.grid(row=6, column=1, columnspan=4, padx=5, pady=5)
+        self.progressBar.grid(row=8, column=1, columnspan=4, padx=5, pady=5)
 
         self.statisticsButton = Button(master, text="Statistics", command=self.showStatistics)
-        self.statisticsButton.grid(row=7, column=2, padx=5, pady=5)
+        self.statisticsButton.grid(row=9, column=2, padx=5, pady=5)
+
+        self.speedLabel = Label(master, text="")
+        self.speedLabel.grid(sticky="W", row=9, column=3, columnspan=2, padx=5, pady=5)
+        self.transferStartTime = None
 
-        # Load config
+        # Start polling the transfer events
+        master.after(self.POLL_INTERVAL, self.pollTransferEvents)
+
+        # Load config. Changes are flushed by a timer, and when the window is closed
         self.config = configparser.ConfigParser()
+        self.configFlushTimer = None
         self.loadConfiguration(self.config)
+        master.protocol("WM_DELETE_WINDOW", self.close)
+
+        # Statistics of every transfer, and the handle of the running one
+        self.statistics = TransferStatisticsStore()
+        self.currentHandle = None
 
     def loadConfiguration(self, config):
         """Load configuration from configuration file"""
         # Read the configuration from the ini file
-        self.config.read('config.ini')
+        self.config.read(self.CONFIG_FILE)
 
         # Get the values from the ini and set them to the GUI (use fallbacks)
         self.hostIpStr.set(self.config.get('gui', 'ip', fallback=''))
@@ -117,6 +166,8 @@ class TftpClientGui:
         self.localFileStr.set(self.config.get('gui', 'localFile', fallback=''))
         self.remoteFileStr.set(self.config.get('gui', 'remoteFile', fallback=''))
         self.timeoutStr.set(self.config.get('gui', 'timeout', fallback='10000')) # Fallback for timeout is 10s
+        self.blockSizeStr.set(self.config.get('gui', 'blockSize', fallback=str(TftpComm.DEFAULT_BLOCK_SIZE)))
+        self.windowSizeStr.set(self.config.get('gui', 'windowSize', fallback=str(TftpComm.DEFAULT_WINDOW_SIZE)))
 
     def getTftp(self):
         """Perform get command"""
@@ -128,67 +179,160 @@ class TftpClientGui:
             messagebox.showerror("Input Error", "Invalid timeout value")
             return
 
+        # Check the block size value
+        blockSize = self.tryParseBlockSize(self.blockSizeStr.get())
+
+        if blockSize is None:
+            self.setGui(NORMAL)
+            messagebox.showerror("Input Error", "Invalid block size, use a value between " + str(TftpComm.MIN_BLOCK_SIZE) + " and " + str(TftpComm.MAX_BLOCK_SIZE))
+            return
+
+        # Check the window size value
+        windowSize = self.tryParseWindowSize(self.windowSizeStr.get())
+
+        if windowSize is None:
+            self.setGui(NORMAL)
+            messagebox.showerror("Input Error", "Invalid window size, use a value between " + str(TftpComm.MIN_WINDOW_SIZE) + " and " + str(TftpComm.MAX_WINDOW_SIZE))
+            return
+
         self.setGui(DISABLED)
-        self.tftpComm.transferTftp(self.hostTextInput.get().strip(),
+        self.transferStartTime = time.monotonic()
+        self.currentHandle = self.tftpComm.transferTftp(self.hostTextInput.get().strip(),
                                    self.portTextInput.get().strip(),
                                    self.remoteFileTextInput.get().strip(),
                                    self.localFileTextInput.get().strip(),
                                    timeout,
                                    True,
-                                   self.progressBar,
-                                   self.doneCallback)
+                                   self.transferEvents.progressCallback,
+                                   self.transferEvents.doneCallback,
+                                   blockSize,
+                                   windowSize)
 
     def putTftp(self):
         """Perform put command"""
+        # Check the block size value
+        blockSize = self.tryParseBlockSize(self.blockSizeStr.get())
+
+        if blockSize is None:
+            self.setGui(NORMAL)
+            messagebox.showerror("Input Error", "Invalid block size, use a value between " + str(TftpComm.MIN_BLOCK_SIZE) + " and " + str(TftpComm.MAX_BLOCK_SIZE))
+            return
+
+        # Check the window size value
+        windowSize = self.tryParseWindowSize(self.windowSizeStr.get())
+
+        if windowSize is None:
+            self.setGui(NORMAL)
+            messagebox.showerror("Input Error", "Invalid window size, use a value between " + str(TftpComm.MIN_WINDOW_SIZE) + " and " + str(TftpComm.MAX_WINDOW_SIZE))
+            return
+
         self.setGui(DISABLED)
-        self.tftpComm.transferTftp(self.hostTextInput.get().strip(),
+        self.transferStartTime = time.monotonic()
+        self.currentHandle = self.tftpComm.transferTftp(self.hostTextInput.get().strip(),
                                    self.portTextInput.get().strip(),
                                    self.remoteFileTextInput.get().strip(),
                                    self.localFileTextInput.get().strip(),
                                    int(self.timeoutStr.get()),
                                    False,
-                                   self.progressBar,
-                                   self.doneCallback)
-
-    def doneCallback(self, nPackets, bytesLastPacket, fileSize):
-        """Call this function to unlock the GUI after a transfer and record statistics"""
+                                   self.transferEvents.progressCallback,
+                                   self.transferEvents.doneCallback,
+                                   blockSize,
+                                   windowSize)
+
+    def pollTransferEvents(self):
+        """Timer on the main thread showing what the transfer threads reported since the last poll"""
+        for kind, arguments in self.transferEvents.poll():
+            if kind == TransferEventQueue.PROGRESS:
+                self.showProgress(*arguments)
+            else:
+                self.transferDone(*arguments)
+        self.master.after(self.POLL_INTERVAL, self.pollTransferEvents)
+
+    def showProgress(self, bytesTransferred, totalBytes):
+        """Show the progress of the transfer. The total size is None if it is not known"""
+        if totalBytes is None:
+            # Keep the bar moving while we do not know how much is left
+            if str(self.progressBar["mode"]) != "indeterminate":
+                self.progressBar.config(mode="indeterminate")
+                self.progressBar.start(10)
+        else:
+            # The size may become known once the transfer is running (tsize option on get)
+            if str(self.progressBar["mode"]) != "determinate":
+                self.progressBar.stop()
+                self.progressBar.config(mode="determinate")
+            self.progressBar["maximum"] = max(totalBytes, 1)
+            self.progressBar["value"] = bytesTransferred
+
+        # Show the average speed so far and, with the size known, the time left at that speed
+        elapsed = time.monotonic() - self.transferStartTime
+        if bytesTransferred > 0 and elapsed > 0:
+            speed = bytesTransferred / elapsed
+            text = "%.1f" % (speed / 1024) + " KB/s"
+            if totalBytes is not None:
+                text += ", ETA: " + "%.0f" % (max(totalBytes - bytesTransferred, 0) / speed) + " s"
+            self.speedLabel["text"] = text
+
+    def transferDone(self, nPackets, bytesLastPacket, fileSize, error):
+        """Unlock the GUI after a transfer and record statistics. The error is the exception which ended the transfer
+           or None if it was successful"""
         # Unlock the GUI
+        self.progressBar.stop()
+        self.progressBar.config(mode="determinate")
+        self.speedLabel["text"] = ""
+        self.pauseButton["text"] = "Pause"
         self.setGui(NORMAL)
 
+        # Tell the user what went wrong
+        if isinstance(error, TftpCancelledError):
+            messagebox.showinfo("User action", str(error))
+        elif isinstance(error, ValueError):
+            messagebox.showerror("Input error", str(error))
+        elif error is not None:
+            messagebox.showerror("Error", str(error))
+
         # Show the user a message
         messagebox.showinfo("Last transmission statistics", "Packets: " + str(nPackets) + "\n" + "Last packet size: " + str(bytesLastPacket) + "\n" + "File size: " + str(fileSize) + "\n")
 
-        # Read the configuration
-        self.config.read('config.ini')
-        historic_nPackets = int(self.config.get('statistics', 'historic_nPackets', fallback='0'))
-        historic_bytesLastPacket = int(self.config.get('statistics', 'historic_bytesLastPacket', fallback='0'))
-        historic_fileSize = int(self.config.get('statistics', 'historic_fileSize', fallback='0'))
-
-        # Update historic numbers
-        historic_nPackets += nPackets
-        historic_bytesLastPacket += bytesLastPacket
-        historic_fileSize += fileSize
-
-        # Write back to configuration
-        self.writeConfig(self.config, 'statistics', 'last_nPackets', str(nPackets))
-        self.writeConfig(self.config, 'statistics', 'last_bytesLastPacket', str(bytesLastPacket))
-        self.writeConfig(self.config, 'statistics', 'last_fileSize', str(fileSize))
-
-        self.writeConfig(self.config, 'statistics', 'historic_nPackets', str(historic_nPackets))
-        self.writeConfig(self.config, 'statistics', 'historic_fileSize', str(historic_fileSize))
+        # Record the transfer. Wrong input never started one, so there is no handle
+        if self.currentHandle is not None:
+            try:
+                self.statistics.addTransfer(self.currentHandle)
+            except OSError as e:
+                messagebox.showerror("Error", "Could not save the statistics: " + str(e))
+            self.currentHandle = None
 
     def breakTftp(self):
         """Break ongoing command"""
         self.tftpComm.breakTftp()
 
+    def pauseTftp(self):
+        """Pause the ongoing command, or resume it if it is paused"""
+        if self.currentHandle is None:
+            return
+        if self.currentHandle.isPaused():
+            self.currentHandle.resume()
+            self.pauseButton["text"] = "Pause"
+        else:
+            self.currentHandle.pause()
+            self.pauseButton["text"] = "Resume"
+
     def showStatistics(self):
         """Show statistics"""
-        self.config.read('config.ini') # Read existing historical data from ini file and show it
-        messagebox.showinfo("Statistics", "Packets: " + self.config.get('statistics', 'last_nPackets', fallback='0') + "\n"
-                                        + "Last packet size: " + self.config.get('statistics', 'last_bytesLastPacket', fallback='0') + " bytes\n"
-                                        + "File size: " + self.config.get('statistics', 'last_fileSize', fallback='0') + "\n\n"
-                                        + "Total packets transferred: " + self.config.get('statistics', 'historic_nPackets', fallback='0') + "\n"
-                                        + "Total size of files transferred: " + self.config.get('statistics', 'historic_fileSize', fallback='0') + " bytes\n")
+        # The store reads its file once, later calls only aggregate what is in memory
+        last = self.statistics.getLast()
+        if last is None:
+            messagebox.showinfo("Statistics", "No transfers yet")
+            return
+        summary = self.statistics.getSummary()
+        messagebox.showinfo("Statistics", "Last transfer: " + last["direction"] + " " + last["remoteFile"] + " (" + last["status"] + ")\n"
+                                        + "Packets: " + str(last["packets"]) + "\n"
+                                        + "Last packet size: " + str(last["bytesLastPacket"]) + " bytes\n"
+                                        + "File size: " + str(last["bytes"]) + "\n"
+                                        + "Retransmits: " + str(last["retransmits"]) + "\n"
+                                        + "Throughput: " + "%.1f" % (last["throughput"] / 1024) + " KB/s\n\n"
+                                        + "Total packets transferred: " + str(summary["total"]["packets"]) + "\n"
+                                        + "Total size of files transferred: " + str(summary["total"]["bytes"]) + " bytes\n\n"
+                                        + formatSummary(summary))
 
     def selectLocalFile(self):
         """Called on local file selection button press"""
@@ -196,15 +340,16 @@ class TftpClientGui:
         self.localFileStr.set(filedialog.asksaveasfilename(initialdir = "/", title = "Select local file", filetypes = ([("All files", "*.*")])))
 
     def ipStringCallback(self, *args):
-        """Limits the size of a IP string to 15 chars and saves the configuration"""
-        if len(root.globalgetvar(args[0])) > 15:
-            root.globalsetvar(args[0], (root.globalgetvar(args[0])[:15])) # 15 is the max ip string lenght in ipv4
+        """Limits the size of the host string to the longest DNS name and saves the configuration. The host may be a
+           name, an IPv4 or an IPv6 address"""
+        if len(self.master.globalgetvar(args[0])) > MAX_HOST_LENGTH:
+            self.master.globalsetvar(args[0], (self.master.globalgetvar(args[0])[:MAX_HOST_LENGTH]))
         self.writeConfig(self.config, 'gui', 'ip', self.hostIpStr.get())
 
     def portStringCallback(self, *args):
         """Limits the size of the port string to 5 chars and saves the configuration"""
-        if len(root.globalgetvar(args[0])) > 5: # Limit to 5 chars
-            root.globalsetvar(args[0], (root.globalgetvar(args[0])[:5])) # 5 is the max port string length
+        if len(self.master.globalgetvar(args[0])) > 5: # Limit to 5 chars
+            self.master.globalsetvar(args[0], (self.master.globalgetvar(args[0])[:5])) # 5 is the max port string length
         self.writeConfig(self.config, 'gui', 'port', self.portStr.get())
 
     def localFileStrCallback(self, *args):
@@ -220,18 +365,53 @@ class TftpClientGui:
         if self.tryParseFloat(self.timeoutStr.get()):
             self.writeConfig(self.config, 'gui', 'timeout', self.timeoutStr.get())
 
+    def blockSizeStrCallback(self, *args):
+        """Use this callback to update the configuration each time the user changes the block size"""
+        if self.tryParseBlockSize(self.blockSizeStr.get()) is not None:
+            self.writeConfig(self.config, 'gui', 'blockSize', self.blockSizeStr.get())
+
+    def windowSizeStrCallback(self, *args):
+        """Use this callback to update the configuration each time the user changes the window size"""
+        if self.tryParseWindowSize(self.windowSizeStr.get()) is not None:
+            self.writeConfig(self.config, 'gui', 'windowSize', self.windowSizeStr.get())
+
     def writeConfig(self, config, section, key, value):
-        """Write configuration to disk"""
+        """Change a setting. It is written to disk by flushConfig() once the user stops typing"""
         # Only add section if not already existing
         if section not in config.sections():
-            self.config.add_section(section)
+            config.add_section(section)
 
-        # Set...
+        # Nothing to do if the value is the same
+        if config.get(section, key, fallback=None) == value:
+            return
         config.set(section, key, value)
 
-        # ...and save
-        with open('config.ini', 'w') as configfile:
-            self.config.write(configfile)
+        # Restart the timer on every change, so typing a whole IP address is written once
+        if self.configFlushTimer is not None:
+            self.master.after_cancel(self.configFlushTimer)
+        self.configFlushTimer = self.master.after(self.CONFIG_FLUSH_DELAY, self.flushConfig)
+
+    def flushConfig(self):
+        """Save the configuration to disk. It is written to a temporary file which then replaces config.ini, so the
+           file is never seen half written"""
+        if self.configFlushTimer is not None:
+            self.master.after_cancel(self.configFlushTimer)
+            self.configFlushTimer = None
+
+        temporaryFile = self.CONFIG_FILE + ".tmp"
+        try:
+            with open(temporaryFile, 'w') as configfile:
+                self.config.write(configfile)
+            os.replace(temporaryFile, self.CONFIG_FILE)
+        except OSError as e:
+            messagebox.showerror("Error", "Could not save the configuration: " + str(e))
+
+    def close(self):
+        """Called when the window is closed. Saves pending settings and stops the running transfer before quitting"""
+        if self.configFlushTimer is not None:
+            self.flushConfig()
+        self.tftpComm.breakTftp(self.SHUTDOWN_TIMEOUT)
+        self.master.destroy()
 
     def tryParseFloat(self, s):
         """Helper function to help sanitize number input"""
@@ -241,6 +421,29 @@ class TftpClientGui:
         except:
             return(None, False)
 
+    def tryParseBlockSize(self, s):
+        """Helper function to sanitize the block size input. Returns the block size or None if it is not valid"""
+        try:
+            blockSize = int(s)
+        except ValueError:
+            return None
+
+        # RFC 2348 limits the block size to this range
+        if blockSize < TftpComm.MIN_BLOCK_SIZE or blockSize > TftpComm.MAX_BLOCK_SIZE:
+            return None
+        return blockSize
+
+    def tryParseWindowSize(self, s):
+        """Helper function to sanitize the window size input. Returns the window size or None if it is not valid"""
+        try:
+            windowSize = int(s)
+        except ValueError:
+            return None
+
+        # RFC 7440 limits the window size to this range
+        if windowSize < TftpComm.MIN_WINDOW_SIZE or windowSize > TftpComm.MAX_WINDOW_SIZE:
+            return None
+        return windowSize
 
     def setGui(self, setState):
         """Set the gui state to the state passed as an argument"""
@@ -250,370 +453,29 @@ class TftpClientGui:
         self.localFileSelectButton.config(state=setState)
         self.remoteFileTextInput.config(state=setState)
         self.timeoutTextInput.config(state=setState)
+        self.blockSizeTextInput.config(state=setState)
+        self.windowSizeTextInput.config(state=setState)
         self.getButton.config(state=setState)
         self.putButton.config(state=setState)
         self.statisticsButton.config(state=setState)
 
 
-class TftpComm:
-    """TFTP Communication class. A thread is used to read or write files asynchronously from the GUI"""
-    # TFTP command opcodes and useful byte values
-    READ = bytes([0x00, 0x01])
-    WRITE = bytes([0x00, 0x02])
-    DATA = bytes([0x00, 0x03])
-    ACK = bytes([0x00, 0x04])
-    ERROR = bytes([0x00, 0x05])
-    NULLTERM = bytes([0x00])
-
-    MAX_RECEIVE_RETRIES = 3
-
-    def __init__(self):
-        # Set this to true to stop the ongoing threads
-        self.stopTransfer = False
-
-    def transferThread(self, ip, port, remoteFilename, filehandle, timeout, read, stop, progressBar, doneCallback):
-        """Thread that accepts or sends data to the server. Use the stop lambda to stop it. Takes care of it own resources"""
-        if read:
-            self.acceptDataStateMachine(ip, port, remoteFilename, filehandle, timeout, stop, progressBar, doneCallback)
-        else:
-            self.sendDataStateMachine(ip, port, remoteFilename, filehandle, timeout, stop, progressBar, doneCallback)
-        filehandle.close()
-
-    def transferTftp(self, ip, port, remoteFilename, localFilename, timeout, read, progressBar, doneCallback):
-        """Sanitize input and perform the TFTP transfer. Connection arguments are passed along down the line.
-           Returns nothing. Thread is responsible for closing passed resources"""
-        try:
-            ipaddress.ip_address(ip)
-        # Show possible errors to the user
-        except ValueError:
-            messagebox.showerror("Input error", ip + " is not a valid IP")
-            doneCallback(0, 0, 0)
-            return
-        except TypeError as e:
-            messagebox.showerror("Error", str(e))
-            doneCallback(0, 0, 0)
-            return
-
-        # Set file options for either reading or writing
-        if read:
-            fileOptions = "wb"
-        else:
-            fileOptions = "rb"
-
-        # Open file
-        try:
-            filehandle = open(localFilename, fileOptions)
-        except:
-            messagebox.showerror("Error", "Could not open file")
-            doneCallback(0, 0, 0)
-            return
-
-        # print(''.join(['\\x%02x' % b for b in message])) # Use this to print bytes in hex
-
-        self.stopTransfer = False # Set the stop lambda to false
-
-        # Setup and start the thread
-        thread = threading.Thread(target=self.transferThread, args = [ip, port, remoteFilename, filehandle, timeout, read, lambda: self.stopTransfer, progressBar, doneCallback])
-        thread.start()
-
-    def breakTftp(self):
-        """Break an ongoing TFTP actioon via the stopTransfer() lambda. This should always work unless the thread is
-           in some kind of socket timeout"""
-        self.stopTransfer = True  # Trigger a lambda to stop the ongoing thread
-
-    def sendMessage(self, sock, message, server):
-        """Send message (data) to socket"""
-        sock.sendto(message, server)
-
-    def sendDataStateMachine(self, ip, port, remoteFilename, filehandle, timeout, stop, progressBar, doneCallback):
-        """This state machine handles sending data to the server. Sending is simple compared to receiving. It is
-           two steps: Sending a request and waiting for an ACK and sending a block and waiting for an ACK. What is
-           important here is to keep the connection open after sending all the data to wait for the final ACK.
-           Pass server connection strings, local and remote file
-           information, a connection timeout, a lambda function used to stop the machine, a Tkinter progressBar object
-           and a callback to be called on end as an argument. Does not return anything and takes care of closing
-           any passed or open resources"""
-
-        # Init the state machine
-        state = "send_request"
-        expectedBlockNumber = 0
-
-        # Handle the progress bar
-        size = self.getFilesize(filehandle)
-        progressBar.mode = "determinate"
-        progressBar["value"] = 0
-        progressBar["maximum"] = int(size / 512)
-
-        # Initialise statistics counters
-        nPackets = 0
-        bytesLastPacket = 0
-        fileSize = 0
-
-        try:
-            # Open a connection to the server and prime the socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # Create UDP socket
-            sock.settimeout(timeout/1000)
-
-            # Break if stopped from the outside
-            while stop() == False:
-
-                if state == "send_request":
-                    expectedBlockNumber = 0
-                    retries = 0
-                    # Break if stopped from the outside
-                    while stop() == False:
-                        if retries > self.MAX_RECEIVE_RETRIES:
-                            raise self.TftpException("Timeout")
-                        retries += 1
-
-                        # Send a WRQ
-                        try:
-                            self.sendMessage(sock, self.createWriteRequest(remoteFilename, "octet"), (ip, int(port)))
-                        except:
-                            continue
-
-                        try:
-                            result, server = self.waitForAck(sock, expectedBlockNumber)
-                            if result:
-                                progressBar["value"] = expectedBlockNumber
-                                expectedBlockNumber += 1
-                                state = "send_block"
-                                break
-                        except self.TftpException as e:
-                            # Handle TFTP exception
-                            raise
-
-                elif state == "send_block":
-                    data = filehandle.read(512)
-
-                    # Send data if available
-                    if data:
-                        retries = 0
-                        while stop() == False:
-                            if retries > self.MAX_RECEIVE_RETRIES:
-                                raise self.TftpException("Timeout")
-                            retries += 1
-
-                            message = self.DATA + struct.pack(">H", expectedBlockNumber) + data
-                            try:
-                                self.sendMessage(sock, message, server)
-
-                                # Get stuff for statistics
-                                nPackets += 1
-                                bytesLastPacket = len(message)
-                                fileSize += len(data)
-                            except Exception as e:
-                                continue
-
-                            try:
-                                result, server = self.waitForAck(sock, expectedBlockNumber)
-
-                                if result:
-                                    progressBar["value"] = expectedBlockNumber
-                                    expectedBlockNumber += 1
-                                    state = "send_block"
-                                    break
-                            except self.TftpException as e:
-                                # Handle TFTP exception
-                                raise
-                    else:
-                        break
-
-                else:
-                    messagebox.showerror("Internal error", "Invalid state")
-                    break
-            if stop():
-                messagebox.showinfo("User action", "Send operation interrupted by user")
-
-        except socket.timeout as e:
-            messagebox.showerror("Error", "Connection error: " + e.args[0])
-        except socket.error as e:
-            messagebox.showerror("Error", "Connection error: " + e.args[0])
-        except self.TftpException as e:
-            messagebox.showerror("Error", e.args[0])
-        except Exception as e:
-            messagebox.showerror("Error", "An error has occurred during transfer: " + str(e))
-        finally:
-            sock.close()
-            doneCallback(nPackets, bytesLastPacket, fileSize)
-            return
-
-
-    def acceptDataStateMachine(self, ip, port, remoteFilename, filehandle, timeout, stop, progressBar, doneCallback):
-        """State machine used to accept data from the server. Pass server connection strings, local and remote file
-           information, a connection timeout, a lambda function used to stop the machine, a Tkinter progressBar object
-           and a callback to be called on end as an argument. Does not return anything and takes care of closing
-           any passed or open resources"""
-        retries = 0
-        # Handle progress bar
-        progressBar.mode = "indeterminate"
-        progressBar.start(10)
-
-        # Init the state machine
-        state = "send_request"
-        firstBlock = True
-        lastBlockReceived = False
-        expectedBlockNumber = 1
-
-        # Initialise statistics counters
-        nPackets = 0
-        bytesLastPacket = 0
-
-        fileSize = 0
-
-        try:
-            # Open a connection to the server and prime the socket
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # Create UDP socket
-            sock.settimeout(timeout/1000)
-
-            while stop() == False:
-
-                if state == "send_request":
-                    firstBlock = True
-                    lastBlockReceived = False
-                    expectedBlockNumber = 0
-
-                    # Send RRQ
-                    try:
-                        self.sendMessage(sock, self.createReadRequest(remoteFilename, "octet"), (ip, int(port)))
-                    except:
-                        continue
-
-                    state = "wait_for_block"
-                    continue
-
-                elif state == "wait_for_block":
-                    # Wait a block
-                    try:
-                        data, server = sock.recvfrom(1024)
-                    except:
-                        if retries < self.MAX_RECEIVE_RETRIES:
-                            retries += 1
-
-                            # Either go back to the start or keep waiting for an ack in case of an error
-                            if firstBlock:
-                                state = "send_request"
-                            else:
-                                state = "send_ack"
-                            continue
-                        else:
-                            raise
-
-                    expectedBlockNumber += 1
-
-                    # Parse incoming data
-                    if (data[0:2] == self.DATA) and (data[2:4] == struct.pack(">H", expectedBlockNumber)):
-                        filehandle.write(data[4:]) # Write to file
-
-                        # Handle last block specially
-                        if len(data[4:]) < 512: # Block size is always 512
-                            lastBlockReceived = True
-
-                        nPackets += 1
-                        bytesLastPacket = len(data)
-                        fileSize += len(data[4:])
-
-                        state = "send_ack"
-                        continue
-
-                    elif data[0:2] == self.ERROR:
-                        # Error, show it to the user
-                        messagebox.showerror("Server error", "The server has communicated the following error: Code: " + self.decodeErrorMessage(data))
-                        break
-                    elif firstBlock:
-                        state = "send_request"
-                    else:
-                        state = "send_ack"
-                    continue
-
-                elif state == "send_ack":
-                    # Create and send an ACK package
-                    try:
-                        self.sendMessage(sock, self.ACK + struct.pack(">H", expectedBlockNumber), server)
-                    except:
-                        continue
-
-                    # First block was received
-                    firstBlock = False
-
-                    if lastBlockReceived:
-                        break
-
-                    state = "wait_for_block"
-
-                else:
-                    messagebox.showerror("Internal error", "Invalid state")
-                    break
-        except socket.timeout as e:
-            messagebox.showerror("Error", "Connection error: " + e.args[0])
-        except socket.error as e:
-            messagebox.showerror("Error", "Connection error: " + e.args[0])
-        except Exception as e:
-            messagebox.showerror("Error", "An error has occurred during transfer")
-        finally:
-            sock.close()
-            progressBar.stop()
-            doneCallback(nPackets, bytesLastPacket, fileSize)
-            return
-
-    def waitForAck(self, sock, expectedBlockNumber):
-        """Waits and handles an incoming TFTP ACK. Pass a connected and valid socket as well as the expected block
-           number contained in the ACK as an argument. Returns a tuple of a success value and a server ip/port tuple"""
-        # Wait for an ACK
-        try:
-            data, server = sock.recvfrom(1024)
-        except:
-            raise
-
-        # Check for ACK message from server
-        if data[0:2] == self.ACK:
-            if data[2:4] == struct.pack(">H", expectedBlockNumber):
-                return True, server
-            else:
-                # Send an error to the server, this was not the block number we expected
-                self.sendMessage(sock, self.ERROR + "Unknown transfer ID".encode('ascii') + self.NULLTERM, server)
-                return False, server
-
-        elif data[0:2] == self.ERROR:
-            raise self.TftpException("The server has communicated the following error: Code: " + self.decodeErrorMessage(data))
-        else:
-            return False, server
-
-
-    def createReadRequest(self, filename, method):
-        """Creates a TFTP read request message. Pass the method as an argument"""
-        return self.READ + filename.encode('ascii') + self.NULLTERM + method.encode('ascii') + self.NULLTERM
-
-    def createWriteRequest(self, filename, method):
-        """Creates a TFTP write request message. Pass the method as an argument"""
-        return self.WRITE + filename.encode('ascii') + self.NULLTERM + method.encode('ascii') + self.NULLTERM
-
-    def getFilesize(self, filehandle):
-        """This helper function is used to get the file size of a file"""
-        filehandle.seek(0,2) # Move the cursor to the end of the file
-        size = filehandle.tell() # Tell() will tell us the length in bytes
-        filehandle.seek(0) # Move the cursor back to the start of the file
-        return size
-
-    def decodeErrorMessage(self, message):
-        """This is used for decoding server-side errors"""
-        # The error message consists of an error code and an error message. Convert all to strings
-        # and return them
-        return str(message[2]) + str(message[3]) + " " + message[4:-2].decode("ascii")
+def main():
+    """Start the GUI"""
+    # Init TFTP communication
+    tftpComm = TftpComm()
 
-    class TftpException(Exception):
-        """Base class for raising custom TFTP exceptions"""
+    # Start TKinter
+    root = Tk()
 
-# Init TFTP communication
-tftpComm = TftpComm()
+    # Create GUI
+    my_gui = TftpClientGui(root, tftpComm)
 
-# Start TKinter
-root = Tk()
+    # Run GUI
+    root.mainloop()
 
-# Create GUI
-my_gui = TftpClientGui(root, tftpComm)
 
-# Run GUI
-root.mainloop()
+if __name__ == "__main__":
+    main()
 
 # End of file
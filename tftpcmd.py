@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+"""Command line TFTP client. Uses the same engine as the GUI but never loads tkinter, so it works without a display.
+
+   Examples:
+     python -m tftpcmd get 192.168.1.10 firmware.bin
+     python -m tftpcmd put 192.168.1.10 config.txt --remote switch.cfg --blksize 8192 --windowsize 8
+     python -m tftpcmd get 192.168.1.10 log1.txt log2.txt log3.txt --jobs 3
+     python -m tftpcmd get switch1.example.net running-config.txt --mode netascii
+     python -m tftpcmd get 192.168.1.10 image.zst -o - | zstd -d | dd of=/dev/sdb bs=1M
+     generate-config | python -m tftpcmd put 192.168.1.10 - --remote switch.cfg
+     python -m tftpcmd get 192.168.1.10 boot.img kernel.img rootfs.img --manifest SHA256SUMS
+     python -m tftpcmd get 192.168.1.10 firmware.bin --trace firmware.trace --trace-pcap firmware.pcap"""
+
+import argparse
+import os
+import sys
+import time
+
+from tftpcache import DownloadCache
+from tftpcomm import TftpComm, TftpException, TransferManager, WriteBehindWriter
+from tftpdigest import ALGORITHMS, DEFAULT_ALGORITHM, Manifest
+from tftpmetrics import writeJsonFile, writePrometheusFile
+from tftptrace import PacketTrace
+
+
+def parseArguments(argv):
+    """Parse the command line. Returns the argparse namespace"""
+    parser = argparse.ArgumentParser(prog="tftpcmd", description="Simple TFTP client")
+    parser.add_argument("command", choices=["get", "put"], help="download (get) or upload (put) a file")
+    parser.add_argument("host", help="host name, IPv4 or IPv6 address of the server")
+    parser.add_argument("files", nargs="+", metavar="file", help="remote files for get, local files for put (- for the standard input)")
+    parser.add_argument("-o", "--local", help="local file for get of a single file (defaults to the remote file name, - for the standard output)")
+    parser.add_argument("-r", "--remote", help="remote file for put of a single file (defaults to the local file name)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of files transferred in parallel (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int, default=TftpComm.DEFAULT_PORT, help="server port (default: %(default)s)")
+    parser.add_argument("-t", "--timeout", type=float, default=TftpComm.DEFAULT_TIMEOUT, help="give up when the server is silent for this long, in ms (default: %(default)s)")
+    parser.add_argument("-b", "--blksize", type=int, default=TftpComm.DEFAULT_BLOCK_SIZE, help="block size to negotiate (default: %(default)s)")
+    parser.add_argument("-w", "--windowsize", type=int, default=TftpComm.DEFAULT_WINDOW_SIZE, help="window size to negotiate (default: %(default)s)")
+    parser.add_argument("-m", "--mode", choices=TftpComm.MODES, default=TftpComm.MODE_OCTET, help="transfer mode, netascii translates line endings (default: %(default)s)")
+    parser.add_argument("--max-size", type=int, help="refuse to download files bigger than this, in bytes")
+    parser.add_argument("--rollover", type=int, choices=TftpComm.ROLLOVER_POLICIES, default=TftpComm.ROLLOVER_ZERO, help="block number after 65535, must match the server (default: %(default)s)")
+    parser.add_argument("--cache", metavar="DIR", help="keep downloaded files in a cache in this directory and reuse them while the server reports the same size")
+    parser.add_argument("--cache-size", type=int, default=DownloadCache.DEFAULT_MAX_SIZE // (1024 * 1024), help="size of the cache in MB (default: %(default)s)")
+    parser.add_argument("--cache-ttl", type=float, help="reuse cached files younger than this without asking the server, in seconds")
+    parser.add_argument("--fsync", choices=WriteBehindWriter.FSYNC_POLICIES, default=WriteBehindWriter.FSYNC_NEVER, help="when to sync downloaded files to disk (default: %(default)s)")
+    parser.add_argument("--digest", action="append", choices=ALGORITHMS, default=[], help="compute this digest of every file while it is transferred, may be given more than once")
+    parser.add_argument("--manifest", metavar="FILE", help="check every file against the digests of this checksum file (as sha256sum or b2sum write them) while it is transferred, and fail the ones which do not match. Lines without the algorithm are of the first --digest (default: " + DEFAULT_ALGORITHM + ")")
+    parser.add_argument("--metrics-json", metavar="FILE", help="write the metrics of the transfers to a JSON file")
+    parser.add_argument("--metrics-prom", metavar="FILE", help="write the metrics of the transfers to a Prometheus text file")
+    parser.add_argument("--trace", metavar="FILE", help="record the packets of the transfers and write them to a binary trace file, see python -m tftptrace")
+    parser.add_argument("--trace-pcap", metavar="FILE", help="record the packets of the transfers and write them to a pcap file")
+    parser.add_argument("--trace-size", type=int, default=PacketTrace.DEFAULT_CAPACITY, help="packets kept in the trace, the last ones (default: %(default)s)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not print progress and statistics")
+    args = parser.parse_args(argv)
+
+    if len(args.files) > 1 and (args.local or args.remote):
+        parser.error("--local and --remote can only be used with a single file")
+    if args.command == "put" and "-" in args.files and (len(args.files) > 1 or not args.remote):
+        parser.error("put of the standard input needs --remote and works with a single file only")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.trace_size < 1:
+        parser.error("--trace-size must be at least 1")
+    return args
+
+
+def createProgressPrinter():
+    """Returns a progress callback printing to stderr, so stdout stays clean. Once the size is known it prints the
+       percentage and the estimated time left"""
+    startTime = time.monotonic()
+
+    def printProgress(bytesTransferred, totalBytes):
+        if totalBytes:
+            elapsed = time.monotonic() - startTime
+            eta = ""
+            if bytesTransferred > 0:
+                eta = ", ETA " + "%.0f" % ((totalBytes - bytesTransferred) * elapsed / bytesTransferred) + " s"
+            sys.stderr.write("\r" + str(bytesTransferred) + " / " + str(totalBytes) + " bytes (" + str(bytesTransferred * 100 // totalBytes) + "%" + eta + ")  ")
+        else:
+            sys.stderr.write("\r" + str(bytesTransferred) + " bytes")
+        sys.stderr.flush()
+
+    return printProgress
+
+
+def createTftpComm(args, metricsList):
+    """Create the engine for the command line options. The metrics of every transfer are appended to the list"""
+    trace = None
+    if args.trace or args.trace_pcap:
+        trace = PacketTrace(args.trace_size)
+    cache = None
+    if args.cache:
+        cache = DownloadCache(args.cache, args.cache_size * 1024 * 1024, args.cache_ttl)
+    manifest = None
+    if args.manifest:
+        manifest = Manifest.read(args.manifest, args.digest[0] if args.digest else DEFAULT_ALGORITHM)
+    return TftpComm(args.fsync, maxFileSize=args.max_size, metricsCallback=metricsList.append, rollover=args.rollover,
+                    cache=cache, digests=args.digest, manifest=manifest, trace=trace, mode=args.mode)
+
+
+def writeMetrics(args, metricsList):
+    """Export the metrics to the files asked for on the command line. Returns False if that failed"""
+    try:
+        if args.metrics_json:
+            writeJsonFile(args.metrics_json, metricsList)
+        if args.metrics_prom:
+            writePrometheusFile(args.metrics_prom, metricsList)
+    except OSError as e:
+        sys.stderr.write("Error: could not write the metrics: " + str(e) + "\n")
+        return False
+    return True
+
+
+def writeTrace(args, trace):
+    """Save the packet trace to the files asked for on the command line. Returns False if that failed"""
+    try:
+        if args.trace:
+            trace.save(args.trace)
+        if args.trace_pcap:
+            trace.savePcap(args.trace_pcap)
+    except OSError as e:
+        sys.stderr.write("Error: could not write the trace: " + str(e) + "\n")
+        return False
+    return True
+
+
+def main(argv=None):
+    """Run the command line client. Returns the exit code"""
+    args = parseArguments(argv)
+    metricsList = []
+    try:
+        tftpComm = createTftpComm(args, metricsList)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Error: " + str(e) + "\n")
+        return 1
+    if len(args.files) > 1:
+        exitCode = transferBatch(args, tftpComm)
+    else:
+        exitCode = transferSingle(args, tftpComm)
+    if tftpComm.cache is not None and not args.quiet:
+        statistics = tftpComm.cache.getStatistics()
+        sys.stderr.write("Cache: " + str(statistics["hits"]) + " hits, " + str(statistics["misses"]) + " misses, "
+                         + str(statistics["entries"]) + " files, " + str(statistics["size"]) + " bytes\n")
+    if not writeMetrics(args, metricsList) and exitCode == 0:
+        exitCode = 1
+    if tftpComm.trace is not None and not writeTrace(args, tftpComm.trace) and exitCode == 0:
+        exitCode = 1
+    return exitCode
+
+
+def transferSingle(args, tftpComm):
+    """Transfer a single file, printing its progress and statistics. Returns the exit code"""
+    progressCallback = None if args.quiet else createProgressPrinter()
+
+    try:
+        if args.command == "get":
+            localFilename = args.local or os.path.basename(args.files[0])
+            if localFilename == "-":
+                result = tftpComm.getStream(args.host, args.port, args.files[0], sys.stdout.buffer, args.timeout,
+                                            args.blksize, args.windowsize, progressCallback)
+                sys.stdout.buffer.flush()
+            else:
+                result = tftpComm.get(args.host, args.port, args.files[0], localFilename, args.timeout, args.blksize,
+                                      args.windowsize, progressCallback)
+        else:
+            remoteFilename = args.remote or os.path.basename(args.files[0])
+            if args.files[0] == "-":
+                result = tftpComm.putStream(args.host, args.port, remoteFilename, sys.stdin.buffer, args.timeout,
+                                            args.blksize, args.windowsize, progressCallback)
+            else:
+                result = tftpComm.put(args.host, args.port, remoteFilename, args.files[0], args.timeout, args.blksize,
+                                      args.windowsize, progressCallback)
+    except (TftpException, ValueError, OSError) as e:
+        if progressCallback:
+            sys.stderr.write("\n")
+        sys.stderr.write("Error: " + str(e) + "\n")
+        return 1
+    except KeyboardInterrupt:
+        sys.stderr.write("\nInterrupted by user\n")
+        return 130
+
+    if not args.quiet:
+        sys.stderr.write("\nPackets: " + str(result.nPackets) + "\n"
+                         + "Last packet size: " + str(result.bytesLastPacket) + "\n"
+                         + "File size: " + str(result.fileSize) + "\n"
+                         + "Block size: " + str(result.blockSize) + "\n"
+                         + "Window size: " + str(result.windowSize) + "\n")
+        sys.stderr.write("Retransmits: " + str(result.metrics.retransmits) + "\n"
+                         + "Timeouts: " + str(result.metrics.timeouts) + "\n")
+        if result.cached:
+            sys.stderr.write("From the cache\n")
+        elif args.command == "get":
+            sys.stderr.write("Write queue peak: " + str(result.writeQueuePeak) + " blocks\n"
+                             + "Write stall time: " + "%.3f" % result.writeStallTime + " s\n")
+        for algorithm, digest in result.digests.items():
+            sys.stderr.write(algorithm + ": " + digest + "\n")
+    return 0
+
+
+def transferBatch(args, tftpComm):
+    """Transfer several files, up to args.jobs at the same time. Prints one line per file and the totals.
+       Returns the exit code, 1 if any file failed"""
+    manager = TransferManager(tftpComm, maxConcurrency=args.jobs)
+
+    try:
+        for filename in args.files:
+            if args.command == "get":
+                manager.submitGet(args.host, args.port, filename, os.path.basename(filename), args.timeout,
+                                  args.blksize, args.windowsize)
+            else:
+                manager.submitPut(args.host, args.port, os.path.basename(filename), filename, args.timeout,
+                                  args.blksize, args.windowsize)
+    except ValueError as e:
+        sys.stderr.write("Error: " + str(e) + "\n")
+        return 1
+
+    try:
+        # Report the files in the order they finish
+        pending = manager.getHandles()
+        while pending:
+            finished = [handle for handle in pending if handle.isFinished()]
+            if not finished:
+                time.sleep(0.1)
+            for handle in finished:
+                pending.remove(handle)
+                if not args.quiet or handle.error is not None:
+                    if handle.error is not None:
+                        sys.stderr.write(handle.status + " " + handle.remoteFilename + ": " + str(handle.error) + "\n")
+                    else:
+                        sys.stderr.write(handle.status + " " + handle.remoteFilename + ": " + str(handle.result.fileSize) + " bytes"
+                                         + "".join(" " + algorithm + ":" + digest for algorithm, digest in handle.result.digests.items())
+                                         + "\n")
+    except KeyboardInterrupt:
+        manager.shutdown(cancel=True)
+        sys.stderr.write("Interrupted by user\n")
+        return 130
+
+    manager.shutdown()
+    statistics = manager.getStatistics()
+    if not args.quiet:
+        sys.stderr.write("Done: " + str(statistics["done"]) + ", failed: " + str(statistics["failed"]) + "\n"
+                         + "Total: " + str(statistics["bytes"]) + " bytes in " + "%.2f" % statistics["elapsed"] + " s ("
+                         + "%.0f" % statistics["throughput"] + " bytes/s)\n")
+    return 0 if statistics["done"] == len(args.files) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file
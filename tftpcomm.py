@@ -0,0 +1,1980 @@
+#!/usr/bin/env python3
+
+"""TFTP protocol engine. This module has no GUI dependencies, so it can be used from scripts, the command line
+   client (tftpcmd.py) or the GUI (tftpclie.py). Errors are reported with exceptions and transfers return a
+   TransferResult with the statistics"""
+
+# Import stuff to create threads
+import queue
+import threading
+import time
+
+# Import file stuff
+import errno
+import io
+import mmap
+import os
+import stat
+
+# Import socket stuff
+import selectors
+import socket
+import struct
+
+from tftpdigest import TransferDigest
+from tftpmetrics import TransferMetrics
+from tftpnetascii import NetasciiDecoder, encodeNetascii, getEncodedSize
+from tftpresolve import HostResolver, isValidHost
+from tftptrace import SENT, RECEIVED
+
+
+class TftpException(Exception):
+    """Base class for raising custom TFTP exceptions"""
+
+
+class TftpTimeoutError(TftpException):
+    """Raised when the server stops answering"""
+
+
+class TftpServerError(TftpException):
+    """Raised when the server sends an ERROR message. The TFTP error code and message are kept as attributes"""
+
+    def __init__(self, code, message):
+        super().__init__("The server has communicated the following error: Code: " + str(code) + " " + message)
+        self.code = code
+        self.message = message
+
+
+class TftpCancelledError(TftpException):
+    """Raised when a transfer is stopped from the outside"""
+
+
+class TftpDigestError(TftpException):
+    """Raised when the data transferred does not have the digest the manifest lists for the file. The algorithm and
+       both digests are kept as attributes"""
+
+    def __init__(self, filename, algorithm, expected, actual):
+        super().__init__("The " + algorithm + " digest of " + filename + " is " + actual + ", the manifest says " + expected)
+        self.algorithm = algorithm
+        self.expected = expected
+        self.actual = actual
+
+
+class TransferResult:
+    """Statistics of a transfer. Filled in while the transfer is running, so it also holds the partial statistics
+       of a transfer that failed"""
+
+    def __init__(self):
+        self.nPackets = 0
+        self.bytesLastPacket = 0
+        self.fileSize = 0
+
+        # Negotiated with the server
+        self.blockSize = TftpComm.DEFAULT_BLOCK_SIZE
+        self.windowSize = TftpComm.DEFAULT_WINDOW_SIZE
+
+        # Detailed performance metrics: round trip times, retransmissions, losses, disk time
+        self.metrics = TransferMetrics()
+
+        # Size of the file as reported by the server (RFC 2349), None if it did not say
+        self.transferSize = None
+
+        # Downloads only: most blocks waiting for the disk at once, and seconds the network loop waited for the disk
+        self.writeQueuePeak = 0
+        self.writeStallTime = 0.0
+
+        # Downloads only: True if the file came from the download cache
+        self.cached = False
+
+        # Digests of the data by algorithm, hex strings, see TftpComm(digests=...). Set once the transfer is over
+        self.digests = {}
+
+    def __repr__(self):
+        return ("TransferResult(nPackets=" + str(self.nPackets) + ", bytesLastPacket=" + str(self.bytesLastPacket)
+                + ", fileSize=" + str(self.fileSize) + ", blockSize=" + str(self.blockSize)
+                + ", windowSize=" + str(self.windowSize) + ", transferSize=" + str(self.transferSize) + ", writeQueuePeak=" + str(self.writeQueuePeak)
+                + ", writeStallTime=" + "%.3f" % self.writeStallTime + ", cached=" + str(self.cached) + ", digests=" + str(self.digests) + ")")
+
+
+class RttEstimator:
+    """Adaptive retransmission timeout of a transfer, estimated from the round trip times like TCP does (RFC 6298).
+       A lost packet is retransmitted after a few round trips instead of after the whole user timeout, and the
+       timeout doubles on every expiry so slow links are not flooded. The user timeout becomes a deadline: the
+       transfer gives up when the server has been silent for that long, however many retransmissions fit in it.
+       All times are in seconds"""
+    INITIAL_RTO = 1.0
+    MIN_RTO = 0.01
+    MAX_RTO = 10.0
+    CLOCK_GRANULARITY = 0.001
+
+    def __init__(self, deadline, metrics=None):
+        self.deadline = deadline
+        self.metrics = metrics # Gets the RTT samples, if given
+        self.smoothedRtt = None
+        self.rttVariance = None
+        self.rto = min(self.INITIAL_RTO, deadline)
+        self.lastProgress = time.monotonic()
+
+        # When the packet being timed was sent. None if there is nothing to time, or if the packet was a
+        # retransmission, since we cannot tell which copy the answer is for (Karn's algorithm)
+        self.sentTime = None
+
+        # When to retransmit (on the time.monotonic() clock) if nothing useful comes back, see startTimer()
+        self.retransmitTime = None
+
+    def packetSent(self, retransmission=False, delay=0.0):
+        """Call when a packet which expects an answer goes out, or is queued to go out delay seconds from now"""
+        self.sentTime = None if retransmission else time.monotonic() + delay
+
+    def progress(self):
+        """Call when the server answered and the transfer moved on. Takes an RTT sample if one is pending"""
+        now = time.monotonic()
+        if self.sentTime is not None:
+            self.addSample(now - self.sentTime)
+            self.sentTime = None
+        self.lastProgress = now
+
+    def addSample(self, rtt):
+        """Update the smoothed RTT and its variance with a new measurement"""
+        if self.metrics is not None:
+            self.metrics.addRtt(rtt)
+        if self.smoothedRtt is None:
+            self.smoothedRtt = rtt
+            self.rttVariance = rtt / 2
+        else:
+            self.rttVariance = 0.75 * self.rttVariance + 0.25 * abs(self.smoothedRtt - rtt)
+            self.smoothedRtt = 0.875 * self.smoothedRtt + 0.125 * rtt
+        self.rto = min(max(self.smoothedRtt + max(self.CLOCK_GRANULARITY, 4 * self.rttVariance), self.MIN_RTO), self.MAX_RTO)
+
+    def backoff(self):
+        """Call when the timeout expired. Doubles it until a new RTT sample comes in"""
+        if self.metrics is not None:
+            self.metrics.timeouts += 1
+        self.rto = min(self.rto * 2, self.MAX_RTO)
+        self.sentTime = None
+
+    def expired(self):
+        """True once the server has been silent for longer than the deadline"""
+        return time.monotonic() - self.lastProgress >= self.deadline
+
+    def getTimeout(self):
+        """Time to wait for the next answer before retransmitting. Never goes past the deadline"""
+        remaining = self.deadline - (time.monotonic() - self.lastProgress)
+        return max(min(self.rto, remaining), self.CLOCK_GRANULARITY)
+
+    def startTimer(self):
+        """Start the retransmission timer for a packet sent now, see retransmitTime. Packets which are ignored do
+           not restart it, so a stream of duplicates cannot hold off a retransmission"""
+        self.retransmitTime = time.monotonic() + self.getTimeout()
+
+    def suspend(self, duration):
+        """Call after the transfer was paused for duration seconds. The pause counts neither against the deadline
+           nor against the retransmission timer"""
+        self.lastProgress += duration
+        if self.retransmitTime is not None:
+            self.retransmitTime += duration
+
+    def allowsFastRetransmit(self, sentTime):
+        """True if a duplicate ACK received now asks again for the window sent at sentTime. One that comes back
+           sooner than half a round trip was already on its way, it is a copy of the ACK which made us send the
+           window, and answering it would double every packet from then on (the sorcerer's apprentice syndrome,
+           RFC 1123 section 4.2.3.1)"""
+        return self.smoothedRtt is not None and time.monotonic() - sentTime >= self.smoothedRtt / 2
+
+
+class UploadSource:
+    """Gives the blocks of a file being uploaded as memoryviews. Regular files are memory-mapped, so a block is a view
+       of the page cache and is never copied. Anything else (pipes, empty files, file objects without a descriptor)
+       is read ahead in large chunks and the blocks are views of the chunks. Instead of a file object the source may
+       be any iterable of bytes-like objects, e.g. a generator. Blocks must be asked for in order. A TransferDigest
+       given to the source gets every block as it is handed out"""
+    READ_AHEAD_SIZE = 1024 * 1024
+
+    def __init__(self, filehandle, blockSize, digest=None):
+        self.filehandle = filehandle
+        self.blockSize = blockSize
+        self.digest = digest
+        self.map = None
+        self.view = None
+
+        # Iterables are read through their iterator, the part of a piece which did not fit in a chunk is kept
+        self.iterator = None if hasattr(filehandle, "read") else iter(filehandle)
+        self.leftover = b""
+
+        # Read ahead a whole number of blocks
+        self.readAheadSize = max(1, self.READ_AHEAD_SIZE // blockSize) * blockSize
+        self.chunk = memoryview(b"")
+        self.chunkStart = 0
+        self.readTime = 0.0 # Time spent reading ahead. Reading a mapped file happens in the kernel, on page faults
+
+        try:
+            fileno = filehandle.fileno()
+            fileStat = os.fstat(fileno)
+            # Empty files cannot be mapped
+            if stat.S_ISREG(fileStat.st_mode) and fileStat.st_size > 0:
+                self.map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.map)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            self.map = None
+
+    def getBlock(self, blockIndex):
+        """Return the block with the given index, counting from 0. The block after the end of the file is empty"""
+        start = blockIndex * self.blockSize
+        if self.view is not None:
+            block = self.view[start:start + self.blockSize]
+        else:
+            # Read the next chunk once we are past the current one
+            if start >= self.chunkStart + len(self.chunk):
+                self.chunkStart = start
+                readStart = time.monotonic()
+                self.chunk = memoryview(self.readChunk())
+                self.readTime += time.monotonic() - readStart
+            offset = start - self.chunkStart
+            block = self.chunk[offset:offset + self.blockSize]
+        if self.digest is not None:
+            self.digest.update(block)
+        return block
+
+    def readChunk(self):
+        """Read the next chunk of the read ahead size. Only the last chunk is shorter: a short block ends the
+           transfer, so pipes and raw files, which may return less than asked for, are read until the chunk is full"""
+        if self.iterator is not None:
+            return self.readChunkFromIterator()
+        chunk = self.filehandle.read(self.readAheadSize)
+        if not chunk or len(chunk) == self.readAheadSize:
+            return chunk
+        chunk = bytearray(chunk)
+        while len(chunk) < self.readAheadSize:
+            data = self.filehandle.read(self.readAheadSize - len(chunk))
+            if not data:
+                break
+            chunk += data
+        return chunk
+
+    def readChunkFromIterator(self):
+        chunk = bytearray(self.leftover)
+        self.leftover = b""
+        for data in self.iterator:
+            chunk += data
+            if len(chunk) >= self.readAheadSize:
+                self.leftover = bytes(chunk[self.readAheadSize:])
+                del chunk[self.readAheadSize:]
+                break
+        return chunk
+
+    def close(self):
+        """Release the mapping. All the blocks handed out must be gone by now"""
+        self.chunk = memoryview(b"")
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class NetasciiSource:
+    """Gives the blocks of an upload in netascii mode, with the interface of UploadSource. The file is read through
+       an UploadSource in large chunks, each chunk is translated in one go and the blocks are views of the translated
+       chunks, so a line ending split across blocks needs no care. The digest gets the file as it is, untranslated"""
+
+    def __init__(self, filehandle, blockSize, digest=None):
+        self.source = UploadSource(filehandle, UploadSource.READ_AHEAD_SIZE)
+        self.blockSize = blockSize
+        self.digest = digest
+        self.chunkIndex = 0
+        self.chunk = memoryview(b"")
+        self.offset = 0
+        self.endOfFile = False
+        self.readTime = 0.0
+
+    def getBlock(self, blockIndex):
+        """Return the next block. Blocks must be asked for in order, the index is only there for the interface"""
+        # Translate chunks until a whole block is there. What is left of the previous chunk is less than a block,
+        # and the blocks handed out keep their chunk alive
+        while len(self.chunk) - self.offset < self.blockSize and not self.endOfFile:
+            data = self.source.getBlock(self.chunkIndex)
+            self.chunkIndex += 1
+            self.endOfFile = len(data) < UploadSource.READ_AHEAD_SIZE
+            if self.digest is not None:
+                self.digest.update(data)
+            encoded = encodeNetascii(data)
+            rest = self.chunk[self.offset:]
+            self.chunk = memoryview(rest.tobytes() + encoded if len(rest) else encoded)
+            self.offset = 0
+            data = None # The view of the file must be gone before the source is closed
+            self.readTime = self.source.readTime
+        block = self.chunk[self.offset:self.offset + self.blockSize]
+        self.offset += len(block)
+        return block
+
+    def close(self):
+        self.chunk = memoryview(b"")
+        self.source.close()
+
+
+class WriteBehindWriter:
+    """Writes the blocks of a download from a thread of its own, so the network loop never waits for the disk.
+       Blocks are received straight into buffers taken from a bounded pool and handed over as they are, the writer
+       thread gathers whatever is queued into one writev() and gives the buffers back. Only when the pool runs dry,
+       because the disk is slower than the network for long enough, does the network loop wait: that wait is
+       reported as stall time. Write errors are raised by the next write() or by close(). A TransferDigest given to
+       the writer gets the blocks in the writer thread, in order, just before they are written. With a
+       NetasciiDecoder the blocks are translated, a batch at a time, before they are digested and written"""
+    # When to fsync the file: never (leave it to the OS), at the end of the transfer or after every batch of writes
+    FSYNC_NEVER = "never"
+    FSYNC_END = "end"
+    FSYNC_ALWAYS = "always"
+    FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_END, FSYNC_ALWAYS)
+
+    # Most blocks gathered into one writev(), well under IOV_MAX
+    MAX_BATCH = 64
+
+    def __init__(self, filehandle, bufferSize, queueSize, fsyncPolicy=FSYNC_NEVER, digest=None, decoder=None):
+        if fsyncPolicy not in self.FSYNC_POLICIES:
+            raise ValueError(str(fsyncPolicy) + " is not a valid fsync policy")
+        self.filehandle = filehandle
+        self.bufferSize = bufferSize
+        self.fsyncPolicy = fsyncPolicy
+        self.digest = digest
+        self.decoder = decoder
+
+        # At least two buffers, one being received into while the other one is written
+        self.maxBuffers = max(2, queueSize // bufferSize)
+        self.allocatedBuffers = 0
+        self.freeBuffers = queue.Queue()
+        self.pending = queue.Queue()
+        self.error = None
+
+        # Statistics
+        self.queuePeak = 0
+        self.stallTime = 0.0
+        self.writeTime = 0.0
+
+        # Write through the descriptor with writev() where possible, other file objects get plain writes. Only plain
+        # binary files qualify, the descriptor of anything transforming the data (e.g. a GzipFile) would bypass it
+        self.fileno = None
+        if hasattr(os, "writev") and isinstance(filehandle, (io.FileIO, io.BufferedWriter, io.BufferedRandom)):
+            try:
+                self.fileno = filehandle.fileno()
+            except (OSError, ValueError, io.UnsupportedOperation):
+                self.fileno = None
+        self.flush()
+        self.start()
+
+    def start(self):
+        """Start writing, in a thread of its own"""
+        self.thread = threading.Thread(target=self.writerThread, daemon=True)
+        self.thread.start()
+
+    def getBuffer(self):
+        """Return a buffer to receive the next block into. Waits for the writer thread when all the buffers are
+           queued for writing"""
+        try:
+            return self.freeBuffers.get_nowait()
+        except queue.Empty:
+            pass
+        if self.allocatedBuffers < self.maxBuffers:
+            self.allocatedBuffers += 1
+            return bytearray(self.bufferSize)
+
+        start = time.monotonic()
+        buffer = self.freeBuffers.get()
+        self.stallTime += time.monotonic() - start
+        return buffer
+
+    def write(self, buffer, start, end):
+        """Queue buffer[start:end] for writing. The buffer belongs to the writer until it comes back from
+           getBuffer()"""
+        self.checkError()
+        self.pending.put((buffer, start, end))
+        self.queuePeak = max(self.queuePeak, self.pending.qsize())
+
+    def checkError(self):
+        if self.error is not None:
+            raise TftpException("Could not write file: " + str(self.error)) from self.error
+
+    def close(self):
+        """Wait for everything queued to be written (and synced if the policy asks for it). Raises a TftpException if
+           any write failed"""
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+            self.thread = None
+        self.checkError()
+
+    def writerThread(self):
+        """Writes batches of queued blocks until it gets None"""
+        done = False
+        while not done:
+            batch = [self.pending.get()]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+
+            # After an error the blocks are dropped, the buffers still go back so the network loop never hangs
+            self.writeBlocks(batch, done)
+            for buffer, begin, end in batch:
+                self.freeBuffers.put(buffer)
+
+    def writeBlocks(self, batch, done):
+        """Translate, digest and write a batch of (buffer, start, end) blocks, and sync if the policy asks for it.
+           done marks the last batch. Errors are kept for checkError(), the blocks after one are dropped"""
+        if self.error is not None:
+            return
+        views = [memoryview(buffer)[begin:end] for buffer, begin, end in batch]
+        if self.decoder is not None:
+            # The whole batch in one go, the last one flushes a CR kept back
+            views = [self.decoder.decode(b"".join(views), done)]
+        if self.digest is not None:
+            for view in views:
+                self.digest.update(view)
+        start = time.monotonic()
+        try:
+            self.writeBatch(views)
+            if self.fsyncPolicy == self.FSYNC_ALWAYS or (done and self.fsyncPolicy == self.FSYNC_END):
+                self.sync()
+        except (OSError, ValueError) as e:
+            self.error = e
+        self.writeTime += time.monotonic() - start
+
+    def writeBatch(self, views):
+        if self.fileno is None:
+            for view in views:
+                self.filehandle.write(view)
+            return
+
+        # writev() may write less than asked, go on from where it stopped
+        while views:
+            written = os.writev(self.fileno, views)
+            while views and written >= len(views[0]):
+                written -= len(views.pop(0))
+            if views and written:
+                views[0] = views[0][written:]
+
+    def flush(self):
+        # Anything with a write method will do, it need not have flush
+        if hasattr(self.filehandle, "flush"):
+            self.filehandle.flush()
+
+    def sync(self):
+        self.flush()
+        if self.fileno is not None:
+            try:
+                os.fsync(self.fileno)
+            except OSError as e:
+                # Pipes and terminals cannot be synced, there is nothing to sync
+                if e.errno != errno.EINVAL:
+                    raise
+
+
+class ChunkStream:
+    """Writable stream between a download and the consumer of TftpComm.getChunks(). Every write becomes a bytes
+       object in a bounded queue, which the consumer reads. Writes wait while the queue is full"""
+
+    def __init__(self, maxChunks):
+        self.chunks = queue.Queue(maxChunks)
+
+    def write(self, data):
+        # The buffer the data is in goes back to the receive loop, so it is copied
+        self.chunks.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        """Tell the consumer the download is over"""
+        self.chunks.put(None)
+
+    def read(self):
+        """The next chunk, None at the end. Waits for it"""
+        return self.chunks.get()
+
+    def discard(self):
+        """Throw away the chunks waiting"""
+        try:
+            while True:
+                self.chunks.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class TransferControl:
+    """Cancels, pauses and resumes a transfer from any thread. The transfer waits for its socket and for a wakeup
+       socket pair at the same time (see TransferWaiter), so a cancel or pause takes effect within milliseconds
+       whatever the timeouts. A stop lambda can be wrapped too, for callers which only have one. A lambda cannot
+       wake the transfer, so it is polled every POLL_INTERVAL seconds"""
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, stop=None):
+        self.stop = stop
+        self.cancelled = threading.Event()
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+        # Created while a transfer waits on them, a transfer which is only queued holds no descriptors
+        self.lock = threading.Lock()
+        self.wakeupSockets = None # (receiver, sender)
+
+    @classmethod
+    def fromStop(cls, stop):
+        """The control for the stop argument of the transfer methods: a TransferControl, a lambda returning True
+           once the transfer should stop, or None"""
+        if isinstance(stop, TransferControl):
+            return stop
+        return cls(stop)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.resumed.set()
+        self.wakeup()
+
+    def pause(self):
+        self.resumed.clear()
+        self.wakeup()
+
+    def resume(self):
+        self.resumed.set()
+        self.wakeup()
+
+    def isCancelled(self):
+        return self.cancelled.is_set() or (self.stop is not None and bool(self.stop()))
+
+    def isPaused(self):
+        return not self.resumed.is_set()
+
+    def waitWhilePaused(self):
+        """Block until resumed or cancelled. Returns the seconds waited"""
+        startTime = time.monotonic()
+        while not self.resumed.wait(self.POLL_INTERVAL if self.stop is not None else None):
+            if self.isCancelled():
+                break
+        return time.monotonic() - startTime
+
+    def openWakeup(self):
+        """The socket which becomes readable whenever the control changes. Call closeWakeup() when done waiting"""
+        with self.lock:
+            if self.wakeupSockets is None:
+                self.wakeupSockets = socket.socketpair()
+                for wakeupSocket in self.wakeupSockets:
+                    wakeupSocket.setblocking(False)
+            return self.wakeupSockets[0]
+
+    def closeWakeup(self):
+        with self.lock:
+            if self.wakeupSockets is not None:
+                for wakeupSocket in self.wakeupSockets:
+                    wakeupSocket.close()
+                self.wakeupSockets = None
+
+    def wakeup(self):
+        with self.lock:
+            if self.wakeupSockets is not None:
+                try:
+                    self.wakeupSockets[1].send(b"\0")
+                except OSError:
+                    # The socket buffer is full of wakeups already
+                    pass
+
+
+class TransferWaiter:
+    """Receives the messages of a transfer. Waits on a selector for the socket of the transfer and the wakeup
+       socket of its TransferControl together, instead of blocking in a socket timeout, and honours the
+       retransmission timer of its RttEstimator"""
+    # Where the platform has it (not on Windows), a message already queued is received without a select call first.
+    # Within a window the next block is usually there already
+    DONT_WAIT = getattr(socket, "MSG_DONTWAIT", None)
+
+    def __init__(self, sock, control, rtt, cancelMessage):
+        self.sock = sock
+        self.control = control
+        self.rtt = rtt
+        self.cancelMessage = cancelMessage
+        self.wakeupSocket = control.openWakeup()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeupSocket, selectors.EVENT_READ)
+
+    def receive(self, buffer):
+        """Receive the next message into buffer. Returns the number of bytes and the sender. Raises socket.timeout
+           once the retransmission timer expires and a TftpCancelledError once the transfer is cancelled. While
+           the transfer is paused it waits, and the pause does not count against the timers"""
+        while True:
+            if self.control.isCancelled():
+                raise TftpCancelledError(self.cancelMessage)
+            if self.control.isPaused():
+                self.rtt.suspend(self.control.waitWhilePaused())
+                continue
+
+            remaining = self.rtt.retransmitTime - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("timed out")
+            if self.DONT_WAIT is not None:
+                try:
+                    return self.sock.recvfrom_into(buffer, 0, self.DONT_WAIT)
+                except BlockingIOError:
+                    pass
+            if self.control.stop is not None:
+                remaining = min(remaining, self.control.POLL_INTERVAL)
+
+            readable = False
+            for key, events in self.selector.select(remaining):
+                if key.fileobj is self.sock:
+                    readable = True
+                else:
+                    self.drainWakeup()
+            # A readable UDP socket holds a whole datagram, receiving it does not block
+            if readable:
+                return self.sock.recvfrom_into(buffer)
+
+    def drainWakeup(self):
+        try:
+            while self.wakeupSocket.recv(1024):
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        self.selector.close()
+        self.control.closeWakeup()
+
+
+class TransferHandle:
+    """Handle of a single transfer, queued or running. Used to follow its progress and status and to cancel it
+       without touching any other transfer"""
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, read, ip, port, remoteFilename, localFilename):
+        self.read = read
+        self.ip = ip
+        self.port = port
+        self.remoteFilename = remoteFilename
+        self.localFilename = localFilename
+
+        self.status = self.QUEUED
+        self.result = TransferResult()
+        self.error = None # The exception which ended the transfer
+        self.bytesTransferred = 0
+        self.totalBytes = None # None while not known
+        self.startTime = None
+        self.endTime = None
+
+        self.control = TransferControl()
+        self.finished = threading.Event()
+
+    def cancel(self):
+        """Cancel the transfer. A queued transfer never starts, a running one stops right away"""
+        self.control.cancel()
+
+    def isCancelled(self):
+        return self.control.isCancelled()
+
+    def pause(self):
+        """Pause the transfer until resume() is called. The server gives up if the pause is longer than its timeout"""
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def isPaused(self):
+        return self.control.isPaused()
+
+    def isFinished(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the transfer to end. Returns False if the timeout (in seconds) expired first"""
+        return self.finished.wait(timeout)
+
+    def getElapsedTime(self):
+        """Seconds spent running so far, 0 if not started yet"""
+        if self.startTime is None:
+            return 0
+        return (self.endTime or time.monotonic()) - self.startTime
+
+    def getThroughput(self):
+        """Average transfer speed in bytes per second"""
+        elapsed = self.getElapsedTime()
+        return self.bytesTransferred / elapsed if elapsed > 0 else 0
+
+    def __repr__(self):
+        return ("TransferHandle(" + ("get " if self.read else "put ") + str(self.ip) + ":" + str(self.port) + " "
+                + self.remoteFilename + ", " + self.status + ")")
+
+
+class TransferEventQueue:
+    """Hands the progress and the end of transfers over from the transfer threads to a single consumer, typically a
+       GUI polling it from its own thread. Pass progressCallback and doneCallback to transferTftp(). Progress is
+       coalesced: only the latest value is kept, so a transfer sending thousands of blocks per second costs the
+       consumer one update per poll. Ends of transfers are queued and never lost"""
+    PROGRESS = "progress"
+    DONE = "done"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latestProgress = None
+        self.doneEvents = queue.Queue()
+
+    def progressCallback(self, bytesTransferred, totalBytes):
+        with self.lock:
+            self.latestProgress = (bytesTransferred, totalBytes)
+
+    def doneCallback(self, nPackets, bytesLastPacket, fileSize, error):
+        self.doneEvents.put((nPackets, bytesLastPacket, fileSize, error))
+
+    def poll(self):
+        """Returns the events since the last poll as a list of (kind, arguments) tuples, the arguments being the ones
+           of the callback. The latest progress comes first, so the end of a transfer is always the last word"""
+        events = []
+        with self.lock:
+            if self.latestProgress is not None:
+                events.append((self.PROGRESS, self.latestProgress))
+                self.latestProgress = None
+        while True:
+            try:
+                events.append((self.DONE, self.doneEvents.get_nowait()))
+            except queue.Empty:
+                break
+        return events
+
+
+class TftpComm:
+    """TFTP Communication class. Transfers can run synchronously with get() and put(), or in a thread with
+       transferTftp() which reports back through callbacks"""
+    # TFTP command opcodes and useful byte values
+    READ = bytes([0x00, 0x01])
+    WRITE = bytes([0x00, 0x02])
+    DATA = bytes([0x00, 0x03])
+    ACK = bytes([0x00, 0x04])
+    ERROR = bytes([0x00, 0x05])
+    OACK = bytes([0x00, 0x06])
+    NULLTERM = bytes([0x00])
+
+    # The same opcodes as numbers, for the headers parsed with HEADER
+    OPCODE_DATA = 3
+    OPCODE_ACK = 4
+    OPCODE_ERROR = 5
+    OPCODE_OACK = 6
+
+    # Opcode and block number at the start of DATA and ACK messages. Precompiled so that parsing a header does not
+    # slice the message or build comparison keys
+    HEADER = struct.Struct(">HH")
+    HEADER_SIZE = 4
+
+    # Big enough for any ACK, OACK or ERROR a server sends us
+    CONTROL_BUFFER_SIZE = 1024
+
+    # Send DATA messages with scatter-gather I/O where the platform supports it (not on Windows)
+    SEND_SCATTER_GATHER = hasattr(socket.socket, "sendmsg")
+
+    # TFTP error codes used by the client
+    ERROR_CODE_NOT_DEFINED = 0
+    ERROR_CODE_DISK_FULL = 3
+    ERROR_CODE_UNKNOWN_TRANSFER_ID = 5
+    ERROR_CODE_OPTION_NEGOTIATION = 8
+
+    DEFAULT_PORT = 69
+    DEFAULT_TIMEOUT = 10000 # In ms
+
+    # Block sizes. 512 is the RFC 1350 block size used when no options are negotiated, the limits come from RFC 2348
+    DEFAULT_BLOCK_SIZE = 512
+    MIN_BLOCK_SIZE = 8
+    MAX_BLOCK_SIZE = 65464
+
+    # Window sizes in blocks. A window of 1 is the lock-step transfer of RFC 1350, the limits come from RFC 7440
+    DEFAULT_WINDOW_SIZE = 1
+    MIN_WINDOW_SIZE = 1
+    MAX_WINDOW_SIZE = 65535
+
+    # Bytes of received blocks which may wait for the disk before the network loop has to wait too
+    DEFAULT_WRITE_QUEUE_SIZE = 8 * 1024 * 1024
+
+    # Block numbers are 16 bit. After block 65535 servers go on with either 0 (most of them) or 1, the rollover
+    # policy has to match the server's
+    ROLLOVER_ZERO = 0
+    ROLLOVER_ONE = 1
+    ROLLOVER_POLICIES = (ROLLOVER_ZERO, ROLLOVER_ONE)
+
+    # Transfer modes. Octet moves the bytes as they are, netascii translates line endings (see tftpnetascii.py)
+    MODE_OCTET = "octet"
+    MODE_NETASCII = "netascii"
+    MODES = (MODE_OCTET, MODE_NETASCII)
+
+    def __init__(self, fsyncPolicy=WriteBehindWriter.FSYNC_NEVER, writeQueueSize=DEFAULT_WRITE_QUEUE_SIZE, maxFileSize=None,
+                 metricsCallback=None, rollover=ROLLOVER_ZERO, cache=None, digests=(), manifest=None, trace=None,
+                 resolver=None, mode=MODE_OCTET):
+        """The fsync policy and the write queue size (in bytes) apply to the downloads of this object, see
+           WriteBehindWriter. Downloads bigger than maxFileSize bytes are refused, None means no limit. The metrics
+           callback gets the TransferMetrics of every transfer once it is over, successful or not. Rollover is the
+           block number following 65535, 0 or 1. Downloads go through the cache, a tftpcache.DownloadCache, if
+           one is given. digests lists the algorithms (see tftpdigest.ALGORITHMS) of the digests computed while the
+           data passes through, they end up in TransferResult.digests. With a tftpdigest.Manifest every transfer
+           is checked against it: files it does not list are refused, and a digest which does not match fails the
+           transfer with a TftpDigestError. Every packet sent or received is recorded into the trace, a
+           tftptrace.PacketTrace, if one is given. Servers are resolved through the resolver, a
+           tftpresolve.HostResolver; pass one to share its cache with other engines. The mode, octet or netascii,
+           applies to all the transfers, like the ascii and binary commands of the classic clients. Netascii
+           downloads do not go through the cache, and digests are those of the local files"""
+        if fsyncPolicy not in WriteBehindWriter.FSYNC_POLICIES:
+            raise ValueError(str(fsyncPolicy) + " is not a valid fsync policy")
+        if rollover not in self.ROLLOVER_POLICIES:
+            raise ValueError(str(rollover) + " is not a valid block number rollover")
+        if mode not in self.MODES:
+            raise ValueError(str(mode) + " is not a valid transfer mode")
+        self.fsyncPolicy = fsyncPolicy
+        self.writeQueueSize = writeQueueSize
+        self.maxFileSize = maxFileSize
+        self.metricsCallback = metricsCallback
+        self.rollover = rollover
+        self.cache = cache
+        self.digests = list(digests)
+        self.manifest = manifest
+        self.trace = trace
+        self.resolver = resolver or HostResolver()
+        self.mode = mode
+        TransferDigest(self.digests) # Raises a ValueError for unknown algorithms
+
+        # Transfers running in this object, so that breakTftp() can stop them
+        self.activeTransfers = set()
+        self.activeTransfersLock = threading.Lock()
+
+    def get(self, ip, port, remoteFilename, localFilename, timeout=DEFAULT_TIMEOUT, blockSize=DEFAULT_BLOCK_SIZE,
+            windowSize=DEFAULT_WINDOW_SIZE, progressCallback=None, stop=None):
+        """Download a file from the server and return a TransferResult. Raises a TftpException if the transfer fails.
+           The progress callback gets the bytes transferred so far and the total size (None if unknown). stop is a
+           TransferControl, to cancel, pause and resume the transfer, or a lambda returning True once it should be
+           cancelled"""
+        self.checkArguments(ip, port, blockSize, windowSize)
+        result = TransferResult()
+        try:
+            if self.useCache():
+                self.cache.get(self, ip, port, remoteFilename, localFilename, timeout, blockSize, windowSize,
+                               TransferControl.fromStop(stop), progressCallback or self.ignoreProgress, result)
+            else:
+                with open(localFilename, "wb") as filehandle:
+                    self.acceptDataStateMachine(ip, port, remoteFilename, filehandle, timeout, blockSize, windowSize,
+                                                TransferControl.fromStop(stop), progressCallback or self.ignoreProgress, result)
+        finally:
+            self.reportMetrics(result.metrics)
+        return result
+
+    def put(self, ip, port, remoteFilename, localFilename, timeout=DEFAULT_TIMEOUT, blockSize=DEFAULT_BLOCK_SIZE,
+            windowSize=DEFAULT_WINDOW_SIZE, progressCallback=None, stop=None):
+        """Upload a file to the server and return a TransferResult. Arguments and errors work like in get()"""
+        self.checkArguments(ip, port, blockSize, windowSize)
+        result = TransferResult()
+        try:
+            with open(localFilename, "rb") as filehandle:
+                self.sendDataStateMachine(ip, port, remoteFilename, filehandle, timeout, blockSize, windowSize,
+                                          TransferControl.fromStop(stop), progressCallback or self.ignoreProgress, result)
+        finally:
+            self.reportMetrics(result.metrics)
+        return result
+
+    def getStream(self, ip, port, remoteFilename, stream, timeout=DEFAULT_TIMEOUT, blockSize=DEFAULT_BLOCK_SIZE,
+                  windowSize=DEFAULT_WINDOW_SIZE, progressCallback=None, stop=None):
+        """Download a file from the server into a writable binary stream, anything with a write method: an open
+           file, sys.stdout.buffer, a pipe, a socket file, a compressor. The stream is neither flushed nor closed.
+           Arguments, result and errors work like in get()"""
+        self.checkArguments(ip, port, blockSize, windowSize)
+        result = TransferResult()
+        try:
+            self.acceptDataStateMachine(ip, port, remoteFilename, stream, timeout, blockSize, windowSize,
+                                        TransferControl.fromStop(stop), progressCallback or self.ignoreProgress, result)
+        finally:
+            self.reportMetrics(result.metrics)
+        return result
+
+    def putStream(self, ip, port, remoteFilename, stream, timeout=DEFAULT_TIMEOUT, blockSize=DEFAULT_BLOCK_SIZE,
+                  windowSize=DEFAULT_WINDOW_SIZE, progressCallback=None, stop=None):
+        """Upload the content of a readable binary stream (an open file, sys.stdin.buffer, a pipe) or of an iterable
+           of bytes (e.g. a generator) to the server. The size need not be known in advance: unless the stream can
+           seek the transfer size is not sent and the progress callback gets None as the total. The stream is
+           read from the start if it can seek, and is not closed. Arguments, result and errors work like in put()"""
+        self.checkArguments(ip, port, blockSize, windowSize)
+        result = TransferResult()
+        try:
+            self.sendDataStateMachine(ip, port, remoteFilename, stream, timeout, blockSize, windowSize,
+                                      TransferControl.fromStop(stop), progressCallback or self.ignoreProgress, result)
+        finally:
+            self.reportMetrics(result.metrics)
+        return result
+
+    def getChunks(self, ip, port, remoteFilename, timeout=DEFAULT_TIMEOUT, blockSize=DEFAULT_BLOCK_SIZE,
+                  windowSize=DEFAULT_WINDOW_SIZE, progressCallback=None, result=None):
+        """Download a file from the server and yield its content as bytes objects while it arrives, without writing
+           it anywhere. Up to the write queue size of data waits for the consumer, past that the transfer waits too.
+           Stopping the iteration early (break, close()) cancels the transfer. Pass a TransferResult to get the
+           statistics. A failed transfer raises its TftpException from the iteration, after the data received"""
+        self.checkArguments(ip, port, blockSize, windowSize)
+        if result is None:
+            result = TransferResult()
+        chunks = ChunkStream(max(2, self.writeQueueSize // max(blockSize, self.DEFAULT_BLOCK_SIZE)))
+        control = TransferControl()
+        errors = []
+
+        def transfer():
+            try:
+                self.acceptDataStateMachine(ip, port, remoteFilename, chunks, timeout, blockSize, windowSize,
+                                            control, progressCallback or self.ignoreProgress, result)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                chunks.close()
+                self.reportMetrics(result.metrics)
+
+        thread = threading.Thread(target=transfer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = chunks.read()
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # Stopped early: cancel the transfer, and throw away what it still writes so that it does not wait for us
+            control.cancel()
+            while thread.is_alive():
+                chunks.discard()
+                thread.join(0.05)
+        if errors:
+            raise errors[0]
+
+    def checkArguments(self, ip, port, blockSize, windowSize):
+        """Sanitize the connection arguments. Raises a ValueError with a message fit for the user if they are wrong"""
+        # Only the form of the host is checked, it is resolved once the transfer runs
+        if not isValidHost(ip):
+            raise ValueError(str(ip) + " is not a valid host name or IP")
+
+        try:
+            port = int(port)
+        except (TypeError, ValueError):
+            raise ValueError(str(port) + " is not a valid port")
+        if port < 1 or port > 65535:
+            raise ValueError(str(port) + " is not a valid port")
+
+        if blockSize < self.MIN_BLOCK_SIZE or blockSize > self.MAX_BLOCK_SIZE:
+            raise ValueError(str(blockSize) + " is not a valid block size")
+
+        if windowSize < self.MIN_WINDOW_SIZE or windowSize > self.MAX_WINDOW_SIZE:
+            raise ValueError(str(windowSize) + " is not a valid window size")
+
+    def openSocket(self, ip, port):
+        """Resolve the server and open a UDP socket of its address family. Returns the socket and the address to
+           send the request to. Raises a TftpException if the host cannot be resolved"""
+        try:
+            family, address = self.resolver.resolve(ip, port)
+        except OSError as e:
+            raise TftpException(str(e)) from e
+        return socket.socket(family, socket.SOCK_DGRAM), address
+
+    def useCache(self):
+        """True if downloads go through the cache. The cache compares the sizes of the files on the server and on
+           the disk, which differ in netascii"""
+        return self.cache is not None and self.mode == self.MODE_OCTET
+
+    def getUploadSize(self, filehandle):
+        """The number of bytes an upload of the file sends, None if it is not known before reading it all. In
+           netascii that is the size of the translated file, which takes a pass over the file"""
+        if self.mode == self.MODE_NETASCII:
+            return getEncodedSize(filehandle)
+        return self.getFilesize(filehandle)
+
+    def createUploadSource(self, filehandle, blockSize, digest):
+        """The source of the blocks of an upload, translating them in netascii mode"""
+        if self.mode == self.MODE_NETASCII:
+            return NetasciiSource(filehandle, blockSize, digest)
+        return UploadSource(filehandle, blockSize, digest)
+
+    def createDecoder(self):
+        """The decoder for the blocks of a download, None if they are written as they are"""
+        if self.mode == self.MODE_NETASCII:
+            return NetasciiDecoder()
+        return None
+
+    def ignoreProgress(self, bytesTransferred, totalBytes):
+        """Progress callback used when the caller is not interested in progress"""
+
+    def reportMetrics(self, metrics):
+        """Pass the metrics of a transfer which is over to the metrics callback, if there is one"""
+        if self.metricsCallback is not None and metrics.startTime is not None:
+            self.metricsCallback(metrics)
+
+    def createDigest(self, remoteFilename):
+        """Returns the TransferDigest for the data of a transfer, None if there is nothing to compute, and the
+           digests the manifest expects by algorithm. Raises a TftpException if there is a manifest and it does not
+           list the file"""
+        expected = {}
+        if self.manifest is not None:
+            expected = self.manifest.getExpected(remoteFilename)
+            if not expected:
+                raise TftpException(remoteFilename + " is not in the manifest")
+        algorithms = self.digests + [algorithm for algorithm in expected if algorithm not in self.digests]
+        if not algorithms:
+            return None, expected
+        return TransferDigest(algorithms), expected
+
+    def finishDigests(self, remoteFilename, digest, expected, result):
+        """Put the digests of all the data into the result and check them against the expected ones. Raises a
+           TftpDigestError on the first mismatch"""
+        if digest is None:
+            return
+        result.digests = digest.hexdigests()
+        for algorithm, expectedDigest in expected.items():
+            if result.digests[algorithm] != expectedDigest:
+                raise TftpDigestError(remoteFilename, algorithm, expectedDigest, result.digests[algorithm])
+
+    def runTransfer(self, handle, timeout, blockSize, windowSize, progressCallback=None):
+        """Run the transfer described by a handle in the calling thread, keeping the handle up to date. Errors do not
+           raise, they end up in the handle status and error. Opens and closes the local file"""
+        def trackProgress(bytesTransferred, totalBytes):
+            handle.bytesTransferred = bytesTransferred
+            handle.totalBytes = totalBytes
+            if progressCallback:
+                progressCallback(bytesTransferred, totalBytes)
+
+        handle.status = handle.RUNNING
+        handle.startTime = time.monotonic()
+        with self.activeTransfersLock:
+            self.activeTransfers.add(handle)
+
+        try:
+            # Set file options for either reading or writing
+            if handle.read:
+                fileOptions = "wb"
+            else:
+                fileOptions = "rb"
+
+            # Downloads through the cache only open the local file on a hit or at the end
+            if handle.read and self.useCache():
+                self.cache.get(self, handle.ip, handle.port, handle.remoteFilename, handle.localFilename, timeout, blockSize, windowSize, handle.control, trackProgress, handle.result)
+                handle.status = handle.DONE
+                return
+
+            # Open file
+            try:
+                filehandle = open(handle.localFilename, fileOptions)
+            except OSError:
+                raise TftpException("Could not open file " + handle.localFilename)
+
+            try:
+                if handle.read:
+                    self.acceptDataStateMachine(handle.ip, handle.port, handle.remoteFilename, filehandle, timeout, blockSize, windowSize, handle.control, trackProgress, handle.result)
+                else:
+                    self.sendDataStateMachine(handle.ip, handle.port, handle.remoteFilename, filehandle, timeout, blockSize, windowSize, handle.control, trackProgress, handle.result)
+            finally:
+                filehandle.close()
+            handle.status = handle.DONE
+        except TftpCancelledError as e:
+            handle.error = e
+            handle.status = handle.CANCELLED
+        except Exception as e:
+            handle.error = e
+            handle.status = handle.FAILED
+        finally:
+            with self.activeTransfersLock:
+                self.activeTransfers.discard(handle)
+            try:
+                self.reportMetrics(handle.result.metrics)
+            finally:
+                handle.endTime = time.monotonic()
+                handle.finished.set()
+
+    def transferThread(self, handle, timeout, blockSize, windowSize, progressCallback, doneCallback):
+        """Thread that accepts or sends data to the server. Cancel the handle to stop it. Takes care of it own resources"""
+        self.runTransfer(handle, timeout, blockSize, windowSize, progressCallback)
+        doneCallback(handle.result.nPackets, handle.result.bytesLastPacket, handle.result.fileSize, handle.error)
+
+    def transferTftp(self, ip, port, remoteFilename, localFilename, timeout, read, progressCallback, doneCallback, blockSize=DEFAULT_BLOCK_SIZE, windowSize=DEFAULT_WINDOW_SIZE):
+        """Sanitize input and perform the TFTP transfer in a thread. Connection arguments are passed along down the
+           line. The block and window sizes are negotiated with the server if they differ from the default ones.
+           The done callback gets the statistics and the exception which ended the transfer (None on success).
+           Returns the TransferHandle of the transfer, None if the input was wrong. Thread is responsible for closing
+           passed resources"""
+        try:
+            self.checkArguments(ip, port, blockSize, windowSize)
+        except ValueError as e:
+            doneCallback(0, 0, 0, e)
+            return None
+
+        # Setup and start the thread
+        handle = TransferHandle(read, ip, port, remoteFilename, localFilename)
+        # A daemon thread, so that a transfer never keeps the application from quitting
+        thread = threading.Thread(target=self.transferThread, args = [handle, timeout, blockSize, windowSize, progressCallback, doneCallback], daemon=True)
+        thread.start()
+        return handle
+
+    def breakTftp(self, timeout=None):
+        """Break all the ongoing TFTP actions of this object by cancelling their handles. They stop within
+           milliseconds, telling their servers. Waits up to timeout seconds for them to end, if given, and returns
+           False if some did not. Use TransferHandle.cancel() to stop a single one"""
+        with self.activeTransfersLock:
+            handles = list(self.activeTransfers)
+        for handle in handles:
+            handle.cancel()
+        if timeout is None:
+            return True
+        deadline = time.monotonic() + timeout
+        return all(handle.wait(max(deadline - time.monotonic(), 0)) for handle in handles)
+
+    def sendMessage(self, sock, message, server):
+        """Send message (data) to socket"""
+        sock.sendto(message, server)
+        if self.trace is not None:
+            self.trace.record(SENT, message, len(message), sock, server)
+
+    def sendData(self, sock, header, data, server, packetBuffer=None):
+        """Send a DATA message made of a header and a block of data. Where the platform has sendmsg both parts go to
+           the kernel as they are (scatter-gather) and nothing is joined. Otherwise they are copied into the packet
+           buffer, which must fit a whole message, and sent from there"""
+        if packetBuffer is None:
+            sock.sendmsg([header, data], [], 0, server)
+        else:
+            size = self.HEADER_SIZE + len(data)
+            packetBuffer[:self.HEADER_SIZE] = header
+            packetBuffer[self.HEADER_SIZE:size] = data
+            sock.sendto(memoryview(packetBuffer)[:size], server)
+        if self.trace is not None:
+            self.trace.record(SENT, header, self.HEADER_SIZE + len(data), sock, server)
+
+    def rejectTransferId(self, sock, address):
+        """Answer a packet which came from someone other than the server of the transfer, e.g. a second server port
+           answering a retransmitted request (RFC 1350 section 4). The transfer goes on undisturbed"""
+        try:
+            self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_UNKNOWN_TRANSFER_ID, "Unknown transfer ID"), address)
+        except OSError:
+            pass
+
+    def abortTransfer(self, sock, server):
+        """Tell the server that we gave up on the transfer, so that it frees its resources right away instead of
+           retransmitting until it times out"""
+        try:
+            self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_NOT_DEFINED, "Transfer cancelled"), server)
+        except OSError:
+            pass
+
+    def sendDataStateMachine(self, ip, port, remoteFilename, filehandle, timeout, blockSize, windowSize, control, progressCallback, result):
+        """This state machine handles sending data to the server. Sending is simple compared to receiving. It is
+           two steps: Sending a request and waiting for an ACK and sending a window of blocks and waiting for an ACK.
+           The ACK tells up to which block the server got the data, the window slides up to there and the rest of it
+           is sent again. With a window of one block this is the classic lock-step transfer. What is
+           important here is to keep the connection open after sending all the data to wait for the final ACK.
+           Pass server connection strings, local and remote file
+           information, a timeout (how long the server may stay silent, in ms), the requested block and window sizes,
+           the TransferControl of the transfer, a progress callback and the TransferResult to fill in as an
+           argument. Raises a TftpException if the transfer does not complete and takes care of closing any open
+           resources"""
+
+        # Init the state machine
+        state = "send_request"
+        expectedBlockNumber = 0
+        requestedBlockSize = blockSize
+        requestedWindowSize = windowSize
+        lastBlockSent = False
+
+        # Blocks sent but not acknowledged yet, as (header, data) pairs. The first one in the list is always the one
+        # after the last ACK. The data is a view of the file, headers are built once and reused for other blocks
+        # once acknowledged. Retransmissions send the same pair again, nothing is rebuilt
+        window = []
+        freeHeaders = []
+        nextBlockNumber = 1
+        source = None
+
+        # A window sent again reaches a server which may have got it the first time, and which then acknowledges it
+        # twice. The second of these ACKs is the echo of the retransmission, not a request for the next window
+        echoBlockNumber = None
+
+        # All the answers of the server are received into the same buffer. Without sendmsg the messages are joined
+        # in a buffer before sending
+        ackBuffer = bytearray(self.CONTROL_BUFFER_SIZE)
+        packetBuffer = None if self.SEND_SCATTER_GATHER else bytearray(blockSize + self.HEADER_SIZE)
+
+        # Digests are updated as the blocks are read for the first time, so none is read twice
+        digest, expectedDigests = self.createDigest(remoteFilename)
+
+        # Handle the progress
+        size = self.getUploadSize(filehandle)
+        progressCallback(0, size)
+
+        # Open a connection to the server. Retransmissions follow the estimated round trip time, the user timeout
+        # is how long the server may stay silent. Waits end early when the transfer is cancelled or paused
+        sock, request = self.openSocket(ip, port)
+        metrics = result.metrics
+        metrics.start("put", ip, port, remoteFilename)
+        rtt = RttEstimator(timeout/1000, metrics)
+        waiter = None
+        server = None
+
+        try:
+            waiter = TransferWaiter(sock, control, rtt, "Send operation interrupted by user")
+            # Break if stopped from the outside
+            while not control.isCancelled():
+
+                if state == "send_request":
+                    expectedBlockNumber = 0
+                    retransmission = False
+                    # Break if stopped from the outside
+                    while not control.isCancelled():
+                        if rtt.expired():
+                            raise TftpTimeoutError("Timeout")
+
+                        # Send a WRQ
+                        try:
+                            self.sendMessage(sock, self.createWriteRequest(remoteFilename, self.mode, self.createOptions(requestedBlockSize, requestedWindowSize, size)), request)
+                            rtt.packetSent(retransmission)
+                            result.metrics.retransmits += retransmission
+                        except OSError:
+                            continue
+                        retransmission = True
+                        rtt.startTimer()
+
+                        # Anything but the answer to the request is ignored. The first answer decides which port
+                        # of the server the transfer goes on with
+                        try:
+                            ackedBlockNumber = None
+                            while ackedBlockNumber is None:
+                                ackedBlockNumber, server, options = self.waitForAck(waiter, expectedBlockNumber, 1, ackBuffer)
+                        except socket.timeout:
+                            rtt.backoff()
+                            continue
+
+                        rtt.progress()
+                        # An OACK carries the negotiated options, a plain ACK means the server ignored them
+                        blockSize = self.negotiateBlockSize(sock, server, options, requestedBlockSize)
+                        windowSize = self.negotiateWindowSize(sock, server, options, requestedWindowSize)
+                        result.blockSize = blockSize
+                        result.windowSize = windowSize
+                        result.transferSize = self.negotiateTransferSize(options)
+                        source = self.createUploadSource(filehandle, blockSize, digest)
+                        state = "send_window"
+                        break
+
+                elif state == "send_window":
+                    # Blocks left in the window have been sent before, so this round is a retransmission
+                    resent = len(window)
+                    retransmission = resent > 0
+
+                    # Top up the window with new blocks from the file. A block shorter than the block size ends the
+                    # transfer. If the file size is a multiple of the block size an empty block must be sent
+                    while len(window) < windowSize and not lastBlockSent:
+                        data = source.getBlock(nextBlockNumber - 1)
+                        if len(data) < blockSize:
+                            lastBlockSent = True
+
+                        header = freeHeaders.pop() if freeHeaders else bytearray(self.HEADER_SIZE)
+                        self.HEADER.pack_into(header, 0, self.OPCODE_DATA, self.toWireBlockNumber(nextBlockNumber))
+                        window.append((header, data))
+                        nextBlockNumber += 1
+                        result.fileSize += len(data)
+
+                        # The source digested the whole file. Never let the server complete a file which does not match
+                        if digest is not None and lastBlockSent:
+                            try:
+                                self.finishDigests(remoteFilename, digest, expectedDigests, result)
+                            except TftpDigestError:
+                                self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_NOT_DEFINED, "Digest mismatch"), server)
+                                raise
+
+                    # The last block has been acknowledged, we are done
+                    if not window:
+                        break
+
+                    if rtt.expired():
+                        raise TftpTimeoutError("Timeout")
+
+                    # Send the whole window. Blocks which were not acknowledged are sent again
+                    for header, data in window:
+                        try:
+                            self.sendData(sock, header, data, server, packetBuffer)
+
+                            # Get stuff for statistics
+                            result.nPackets += 1
+                            result.bytesLastPacket = self.HEADER_SIZE + len(data)
+                        except OSError:
+                            continue
+                    rtt.packetSent(retransmission)
+                    result.metrics.retransmits += resent
+                    sentTime = time.monotonic()
+                    rtt.startTimer()
+
+                    # Wait for an ACK within the window. Stale ACKs, garbage and packets from other ports are
+                    # ignored and do not restart the retransmission timer
+                    expectedBlockNumber = nextBlockNumber - 1
+                    try:
+                        while True:
+                            ackedBlockNumber, server, options = self.waitForAck(waiter, expectedBlockNumber, len(window), ackBuffer, server)
+                            if ackedBlockNumber is None:
+                                continue
+
+                            # The ACK of the block before the window, the highest one acknowledged, again. Unless it
+                            # is a copy of the ACK which made us send the window, the server got none of it: send it
+                            # again right away instead of waiting for the timer (fast retransmit)
+                            if ackedBlockNumber <= expectedBlockNumber - len(window):
+                                metrics.duplicates += 1
+                                if ackedBlockNumber == echoBlockNumber:
+                                    echoBlockNumber = None
+                                elif rtt.allowsFastRetransmit(sentTime):
+                                    metrics.fastRetransmits += 1
+                                    echoBlockNumber = expectedBlockNumber
+                                    break
+                                continue
+
+                            # Slide the window past the acknowledged blocks
+                            rtt.progress()
+                            acknowledged = len(window) - (expectedBlockNumber - ackedBlockNumber)
+                            freeHeaders.extend(header for header, data in window[:acknowledged])
+                            del window[:acknowledged]
+                            # Everything up to the last block read has been read, so the bytes read cap a short last block
+                            metrics.recordBytes(min(ackedBlockNumber * blockSize, result.fileSize))
+                            progressCallback(min(ackedBlockNumber * blockSize, result.fileSize), size)
+                            if not window or self.allowsPartialRetransmit(rtt, retransmission, sentTime):
+                                # The server stopped short of the end of the window, it lost the rest and the rest is
+                                # sent again. The echo of that is expected like after a fast retransmit
+                                if window:
+                                    echoBlockNumber = expectedBlockNumber
+                                break
+                            # Stopping short of a window sent again may be the answer to the window sent before: keep
+                            # waiting for the rest of the ACKs, the timer covers a real loss
+                    except socket.timeout:
+                        # Nothing useful came back, send the window again
+                        rtt.backoff()
+                        echoBlockNumber = expectedBlockNumber
+
+                else:
+                    raise TftpException("Invalid state")
+
+            if control.isCancelled():
+                raise TftpCancelledError("Send operation interrupted by user")
+
+        except TftpCancelledError:
+            if server is not None:
+                self.abortTransfer(sock, server)
+            raise
+        except OSError as e:
+            raise TftpException("Connection error: " + str(e)) from e
+        finally:
+            if waiter is not None:
+                waiter.close()
+            sock.close()
+            # The views into the file must be gone before the file can be unmapped
+            window.clear()
+            data = None
+            if source is not None:
+                metrics.diskTime += source.readTime
+                source.close()
+            metrics.finish()
+
+
+    def acceptDataStateMachine(self, ip, port, remoteFilename, filehandle, timeout, blockSize, windowSize, control, progressCallback, result):
+        """State machine used to accept data from the server. Blocks are acknowledged once a whole window has been
+           received in order, at the end of the transfer, or when something goes missing so that the server goes back
+           to the last block we got. Pass server connection strings, local and remote file
+           information, a timeout (how long the server may stay silent, in ms), the requested block and window sizes,
+           the TransferControl of the transfer, a progress callback and the TransferResult to fill in as an
+           argument. Raises a TftpException if the transfer does not complete and takes care of closing any open
+           resources"""
+        # The writer thread updates the digests, off the network loop
+        digest, expectedDigests = self.createDigest(remoteFilename)
+
+        # Handle progress, the size is not known
+        progressCallback(0, None)
+
+        # Init the state machine. The expected block number is the number of the last block received in order
+        state = "send_request"
+        firstBlock = True
+        lastBlockReceived = False
+        expectedBlockNumber = 0
+        requestedBlockSize = blockSize
+        requestedWindowSize = windowSize
+        blocksInWindow = 0
+        windowBroken = False
+        requestSent = False
+        lastAckSent = None
+        preallocated = False
+        server = None # Known from the first answer on
+
+        # Blocks are received into buffers from the writer's pool and handed over to it for writing, so neither
+        # receiving nor writing allocates anything per packet. A buffer must fit the header plus the largest block
+        # the server may send, which is the default size if it ignores our options
+        # Open a connection to the server. Retransmissions follow the estimated round trip time, the user timeout
+        # is how long the server may stay silent. Waits end early when the transfer is cancelled or paused
+        sock, request = self.openSocket(ip, port)
+        metrics = result.metrics
+        metrics.start("get", ip, port, remoteFilename)
+        rtt = RttEstimator(timeout/1000, metrics)
+        waiter = None
+
+        writer = WriteBehindWriter(filehandle, max(blockSize, self.DEFAULT_BLOCK_SIZE) + self.HEADER_SIZE,
+                                   self.writeQueueSize, self.fsyncPolicy, digest, self.createDecoder())
+        buffer = writer.getBuffer()
+        view = memoryview(buffer)
+
+        try:
+            waiter = TransferWaiter(sock, control, rtt, "Receive operation interrupted by user")
+            while not control.isCancelled():
+
+                if state == "send_request":
+                    firstBlock = True
+                    lastBlockReceived = False
+                    expectedBlockNumber = 0
+
+                    # Send RRQ
+                    try:
+                        self.sendMessage(sock, self.createReadRequest(remoteFilename, self.mode, self.createOptions(requestedBlockSize, requestedWindowSize, 0)), request)
+                        rtt.packetSent(requestSent)
+                        result.metrics.retransmits += requestSent
+                    except OSError:
+                        continue
+
+                    requestSent = True
+                    rtt.startTimer()
+                    state = "wait_for_block"
+                    continue
+
+                elif state == "wait_for_block":
+                    # Wait a block. Packets which are ignored do not restart the retransmission timer
+                    try:
+                        nbytes, sender = waiter.receive(buffer)
+                        if self.trace is not None:
+                            self.trace.record(RECEIVED, buffer, nbytes, sock, sender)
+                    except socket.timeout:
+                        if rtt.expired():
+                            raise TftpTimeoutError("Timeout")
+                        rtt.backoff()
+
+                        # Either go back to the start or keep waiting for an ack in case of an error
+                        if firstBlock:
+                            state = "send_request"
+                        else:
+                            state = "send_ack"
+                        continue
+
+                    # Once the server has answered, anyone else gets an error and the transfer goes on
+                    if server is not None and sender != server:
+                        self.rejectTransferId(sock, sender)
+                        continue
+
+                    # Parse incoming data. Anything too short to have a header is garbage
+                    if nbytes < self.HEADER_SIZE:
+                        continue
+                    opcode, blockNumber = self.HEADER.unpack_from(buffer)
+                    blockNumber = self.fromWireBlockNumber(blockNumber, expectedBlockNumber)
+
+                    if firstBlock and opcode == self.OPCODE_OACK:
+                        # The server accepted our options, acknowledge them with block number 0
+                        server = sender
+                        rtt.progress()
+                        options = self.parseOptionAck(view[:nbytes])
+                        blockSize = self.negotiateBlockSize(sock, server, options, requestedBlockSize)
+                        windowSize = self.negotiateWindowSize(sock, server, options, requestedWindowSize)
+                        result.blockSize = blockSize
+                        result.windowSize = windowSize
+
+                        # With the size known, refuse files which are too big and reserve the space for the rest
+                        result.transferSize = self.negotiateTransferSize(options)
+                        if result.transferSize is not None:
+                            self.checkFileSize(sock, server, result.transferSize)
+                            preallocated = self.preallocate(sock, server, filehandle, result.transferSize)
+                            progressCallback(0, result.transferSize)
+                        state = "send_ack"
+                        continue
+
+                    elif opcode == self.OPCODE_DATA and blockNumber == expectedBlockNumber + 1:
+                        # Data without an OACK means the server ignored our options, use the default sizes
+                        if firstBlock:
+                            server = sender
+                            blockSize = self.DEFAULT_BLOCK_SIZE
+                            windowSize = self.DEFAULT_WINDOW_SIZE
+                            result.blockSize = blockSize
+                            result.windowSize = windowSize
+                            firstBlock = False
+
+                        expectedBlockNumber += 1
+                        blocksInWindow += 1
+                        windowBroken = False
+                        rtt.progress()
+                        rtt.startTimer()
+
+                        # Hand the block over to the writer and receive the next one into a new buffer
+                        dataSize = nbytes - self.HEADER_SIZE
+                        writer.write(buffer, self.HEADER_SIZE, nbytes)
+                        buffer = writer.getBuffer()
+                        view = memoryview(buffer)
+
+                        # Handle last block specially
+                        if dataSize < blockSize:
+                            lastBlockReceived = True
+
+                        result.nPackets += 1
+                        result.bytesLastPacket = nbytes
+                        result.fileSize += dataSize
+                        self.checkFileSize(sock, server, result.fileSize)
+
+                        # Only acknowledge at the end of a window
+                        if lastBlockReceived or blocksInWindow >= windowSize:
+                            metrics.recordBytes(result.fileSize)
+                            progressCallback(result.fileSize, result.transferSize)
+                            state = "send_ack"
+                        continue
+
+                    elif opcode == self.OPCODE_ERROR:
+                        # Error, pass it on to the caller
+                        code, message = self.parseErrorMessage(view[:nbytes])
+                        raise TftpServerError(code, message)
+
+                    # A block we already have, or an OACK acknowledged before, was delayed or duplicated on the way
+                    # and is ignored. Answering it would make the server send its window twice from then on. If our
+                    # ACK got lost instead, the retransmission timer sends it again
+                    if opcode == self.OPCODE_OACK or (opcode == self.OPCODE_DATA and blockNumber <= expectedBlockNumber):
+                        metrics.duplicates += 1
+                        continue
+
+                    # A block which skipped a missing one. Acknowledge the last good one so that the server restarts
+                    # the window there (RFC 7440). The rest of the broken window is ignored, otherwise every block in
+                    # it would trigger an ACK
+                    if opcode == self.OPCODE_DATA:
+                        metrics.outOfOrder += 1
+                        if not firstBlock and not windowBroken:
+                            windowBroken = True
+                            state = "send_ack"
+                    continue
+
+                elif state == "send_ack":
+                    # Create and send an ACK package
+                    try:
+                        self.sendMessage(sock, self.ACK + struct.pack(">H", self.toWireBlockNumber(expectedBlockNumber)), server)
+                        # Sending the same ACK again is a retransmission
+                        rtt.packetSent(lastAckSent == expectedBlockNumber)
+                        result.metrics.retransmits += lastAckSent == expectedBlockNumber
+                        lastAckSent = expectedBlockNumber
+                    except OSError:
+                        continue
+                    rtt.startTimer()
+
+                    # First block was received
+                    firstBlock = False
+                    blocksInWindow = 0
+
+                    if lastBlockReceived:
+                        break
+
+                    state = "wait_for_block"
+
+                else:
+                    raise TftpException("Invalid state")
+
+            if control.isCancelled():
+                raise TftpCancelledError("Receive operation interrupted by user")
+
+        except TftpCancelledError:
+            if server is not None:
+                self.abortTransfer(sock, server)
+            raise
+        except OSError as e:
+            raise TftpException("Connection error: " + str(e)) from e
+        finally:
+            if waiter is not None:
+                waiter.close()
+            sock.close()
+
+            # Whatever was received is written out before returning
+            try:
+                writer.close()
+            finally:
+                result.writeQueuePeak = writer.queuePeak
+                result.writeStallTime = writer.stallTime
+                metrics.diskTime += writer.writeTime
+                metrics.finish()
+                # Drop the reserved space the server did not fill, so the file is never longer than what we got
+                if preallocated and result.fileSize != result.transferSize:
+                    filehandle.truncate(result.fileSize)
+
+        # The writer has seen every block by now
+        self.finishDigests(remoteFilename, digest, expectedDigests, result)
+
+    def waitForAck(self, waiter, expectedBlockNumber, windowSize=1, buffer=None, server=None):
+        """Waits and handles an incoming TFTP ACK. Pass the TransferWaiter of the socket, the number of the last block
+           sent and the number of blocks in flight as an argument, and optionally a bytearray to receive into so
+           that nothing is allocated per ACK and the server the transfer goes on with. Messages from anyone else get
+           an "Unknown transfer ID" error and are not accepted. Returns what parseAck() returns, raises what
+           TransferWaiter.receive() raises"""
+        if buffer is None:
+            buffer = bytearray(self.CONTROL_BUFFER_SIZE)
+
+        # Wait for an ACK
+        nbytes, sender = waiter.receive(buffer)
+        if self.trace is not None:
+            self.trace.record(RECEIVED, buffer, nbytes, waiter.sock, sender)
+        if server is not None and sender != server:
+            self.rejectTransferId(waiter.sock, sender)
+            return None, server, None
+        return self.parseAck(waiter.sock, memoryview(buffer)[:nbytes], sender, expectedBlockNumber, windowSize)
+
+    def allowsPartialRetransmit(self, rtt, retransmission, sentTime):
+        """True if an ACK stopping short of the end of the window asks for the rest of it. After a window sent for
+           the first time it always does. After a retransmission the ACK may answer the window sent before (Karn's
+           rule), the same gate as for duplicate ACKs applies"""
+        return not retransmission or rtt.allowsFastRetransmit(sentTime)
+
+    def parseAck(self, sock, data, server, expectedBlockNumber, windowSize=1):
+        """Handles an incoming TFTP ACK. Pass the socket (or anything with a sendto method) it came from, the message,
+           its sender, the number of the last block sent and the number of blocks in flight as an argument. Any ACK
+           within the window is accepted. An OACK is accepted in place of the ACK for block 0. Returns a tuple of the
+           acknowledged block number (None if the message was not an acceptable ACK), a server ip/port tuple and a
+           dictionary with the options acknowledged by the server (None unless an OACK was received). Block numbers
+           are counted from the start of the transfer, past 65535. Stale ACKs of blocks acknowledged before, delayed
+           or duplicated on the way, are ignored without an answer (RFC 1123 section 4.2.3.1)"""
+        # Anything too short to have a header is garbage
+        if len(data) < self.HEADER_SIZE:
+            return None, server, None
+        opcode, ackedBlockNumber = self.HEADER.unpack_from(data)
+        ackedBlockNumber = self.fromWireBlockNumber(ackedBlockNumber, expectedBlockNumber)
+
+        # Check for ACK message from server
+        if opcode == self.OPCODE_ACK:
+            # The ACK for the block before the window means the server got none of it and wants it again
+            if expectedBlockNumber - windowSize <= ackedBlockNumber <= expectedBlockNumber:
+                return ackedBlockNumber, server, None
+            return None, server, None
+
+        elif opcode == self.OPCODE_OACK and expectedBlockNumber == 0:
+            return 0, server, self.parseOptionAck(data)
+
+        elif opcode == self.OPCODE_ERROR:
+            code, message = self.parseErrorMessage(data)
+            raise TftpServerError(code, message)
+        else:
+            return None, server, None
+
+
+    def toWireBlockNumber(self, blockNumber):
+        """The 16 bit block number sent for a block, counted from the start of the transfer"""
+        if blockNumber == 0 or self.rollover == self.ROLLOVER_ZERO:
+            return blockNumber & 0xFFFF
+        return (blockNumber - 1) % 0xFFFF + 1
+
+    def fromWireBlockNumber(self, wireBlockNumber, reference):
+        """The block number, counted from the start of the transfer, of a received 16 bit one. Of all the blocks
+           sharing the 16 bit number, it is the one closest to the reference, e.g. the last block received"""
+        # Block numbers repeat every 65536 blocks, or every 65535 if 0 is skipped
+        period = 0x10000 if self.rollover == self.ROLLOVER_ZERO else 0xFFFF
+        if wireBlockNumber == 0 and self.rollover == self.ROLLOVER_ONE:
+            return 0
+        difference = (wireBlockNumber - self.toWireBlockNumber(reference)) % period
+        if difference > period // 2:
+            difference -= period
+        return reference + difference
+
+    def queryTransferSize(self, ip, port, remoteFilename, timeout=DEFAULT_TIMEOUT, control=None):
+        """Ask the server for the size of a file without transferring it: a read request with the tsize option (RFC
+           2349), whose answer is cut short with an error. Returns the size, None if the server did not tell (it does
+           not support options). Raises a TftpServerError if the server refuses the request, a TftpTimeoutError if
+           it does not answer within the timeout (in ms) and a TftpCancelledError if control, the TransferControl of
+           the transfer asking, is cancelled meanwhile"""
+        control = TransferControl.fromStop(control)
+        request = self.createReadRequest(remoteFilename, self.MODE_OCTET, {"tsize": 0})
+        buffer = bytearray(self.CONTROL_BUFFER_SIZE)
+        sock, address = self.openSocket(ip, port)
+        rtt = RttEstimator(timeout/1000)
+        retransmission = False
+        waiter = None
+        try:
+            waiter = TransferWaiter(sock, control, rtt, "Size query interrupted by user")
+            while True:
+                if rtt.expired():
+                    raise TftpTimeoutError("Timeout")
+                self.sendMessage(sock, request, address)
+                rtt.packetSent(retransmission)
+                retransmission = True
+                rtt.startTimer()
+
+                # Only the timer sends the request again. Garbage and packets from other hosts are ignored, the
+                # server answers from a port of its own but from the host the request went to
+                try:
+                    while True:
+                        nbytes, server = waiter.receive(buffer)
+                        if self.trace is not None:
+                            self.trace.record(RECEIVED, buffer, nbytes, sock, server)
+                        if server[0] == address[0] and nbytes >= self.HEADER_SIZE:
+                            opcode = self.HEADER.unpack_from(buffer)[0]
+                            if opcode in (self.OPCODE_ERROR, self.OPCODE_OACK, self.OPCODE_DATA):
+                                break
+                except socket.timeout:
+                    rtt.backoff()
+                    continue
+
+                if opcode == self.OPCODE_ERROR:
+                    code, message = self.parseErrorMessage(memoryview(buffer)[:nbytes])
+                    raise TftpServerError(code, message)
+                # Either way the server started a transfer we do not want, stop it
+                self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_NOT_DEFINED, "Size query only"), server)
+                if opcode == self.OPCODE_DATA:
+                    return None
+                return self.negotiateTransferSize(self.parseOptionAck(memoryview(buffer)[:nbytes]))
+        except OSError as e:
+            raise TftpException("Connection error: " + str(e)) from e
+        finally:
+            if waiter is not None:
+                waiter.close()
+            sock.close()
+
+    def createReadRequest(self, filename, method, options=None):
+        """Creates a TFTP read request message. Pass the method and optionally a dictionary of options as an argument"""
+        return self.READ + filename.encode('ascii') + self.NULLTERM + method.encode('ascii') + self.NULLTERM + self.encodeOptions(options)
+
+    def createWriteRequest(self, filename, method, options=None):
+        """Creates a TFTP write request message. Pass the method and optionally a dictionary of options as an argument"""
+        return self.WRITE + filename.encode('ascii') + self.NULLTERM + method.encode('ascii') + self.NULLTERM + self.encodeOptions(options)
+
+    def createErrorMessage(self, code, message):
+        """Creates a TFTP error message. Pass the error code and a human readable message as an argument"""
+        return self.ERROR + struct.pack(">H", code) + message.encode('ascii') + self.NULLTERM
+
+    def createOptions(self, blockSize, windowSize, transferSize=None):
+        """Creates the dictionary of options to request from the server. Options which are set to their default
+           value are left out so that servers without option support (RFC 2347) keep working as before. The transfer
+           size (RFC 2349) is 0 in a read request, asking the server for the size, and the size of the file in a
+           write request. None leaves it out"""
+        options = {}
+        if blockSize != self.DEFAULT_BLOCK_SIZE:
+            options["blksize"] = blockSize
+        if windowSize != self.DEFAULT_WINDOW_SIZE:
+            options["windowsize"] = windowSize
+        if transferSize is not None:
+            options["tsize"] = transferSize
+        return options
+
+    def encodeOptions(self, options):
+        """Encodes a dictionary of options as the null terminated name/value pairs appended to a request"""
+        if not options:
+            return b""
+        return b"".join(str(name).encode('ascii') + self.NULLTERM + str(value).encode('ascii') + self.NULLTERM for name, value in options.items())
+
+    def parseOptionAck(self, message):
+        """Parses an OACK message (bytes or a memoryview) into a dictionary of lowercase option names and string values"""
+        message = bytes(message)
+        # Drop the opcode and split the null terminated strings. The trailing terminator leaves an empty last field
+        fields = message[2:].split(self.NULLTERM)
+        options = {}
+        for i in range(0, len(fields) - 1, 2):
+            options[fields[i].decode('ascii').lower()] = fields[i + 1].decode('ascii')
+        return options
+
+    def negotiateBlockSize(self, sock, server, options, requestedBlockSize):
+        """Works out the block size to use from the options acknowledged by the server. Pass None if the server answered
+           with a plain ACK or DATA, which means it does not support options. The server may lower the block size but
+           never raise it. An invalid answer is reported to the server and raises a TftpException"""
+        if not options or "blksize" not in options:
+            return self.DEFAULT_BLOCK_SIZE
+
+        try:
+            blockSize = int(options["blksize"])
+        except ValueError:
+            blockSize = None
+
+        if blockSize is None or blockSize < self.MIN_BLOCK_SIZE or blockSize > requestedBlockSize:
+            self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_OPTION_NEGOTIATION, "Invalid blksize"), server)
+            raise TftpException("The server has answered with an invalid block size: " + options["blksize"])
+
+        return blockSize
+
+    def negotiateWindowSize(self, sock, server, options, requestedWindowSize):
+        """Works out the window size to use from the options acknowledged by the server, like negotiateBlockSize.
+           Without the option the transfer falls back to lock-step, one block per ACK"""
+        if not options or "windowsize" not in options:
+            return self.DEFAULT_WINDOW_SIZE
+
+        try:
+            windowSize = int(options["windowsize"])
+        except ValueError:
+            windowSize = None
+
+        if windowSize is None or windowSize < self.MIN_WINDOW_SIZE or windowSize > requestedWindowSize:
+            self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_OPTION_NEGOTIATION, "Invalid windowsize"), server)
+            raise TftpException("The server has answered with an invalid window size: " + options["windowsize"])
+
+        return windowSize
+
+    def negotiateTransferSize(self, options):
+        """Returns the size of the file acknowledged by the server, None if the server did not tell. The size is only
+           used for progress and preallocation, so a server answering nonsense is not an error"""
+        if not options or "tsize" not in options:
+            return None
+        try:
+            transferSize = int(options["tsize"])
+        except ValueError:
+            return None
+        return transferSize if transferSize >= 0 else None
+
+    def checkFileSize(self, sock, server, size):
+        """Refuse a download bigger than the maximum file size. The server is told and a TftpException is raised"""
+        if self.maxFileSize is not None and size > self.maxFileSize:
+            self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_DISK_FULL, "File too big"), server)
+            raise TftpException("The file is bigger than the maximum of " + str(self.maxFileSize) + " bytes")
+
+    def preallocate(self, sock, server, filehandle, size):
+        """Reserve the disk space of a download up front, so the file is not fragmented and a full disk shows up
+           before the transfer. Returns True if the space was reserved. Platforms and file systems without
+           posix_fallocate just go without. A full disk is reported to the server and raises a TftpException"""
+        # Netascii files end up shorter than what the server sends, by how much is known at the end only
+        if size <= 0 or self.mode == self.MODE_NETASCII or not hasattr(os, "posix_fallocate"):
+            return False
+        try:
+            # Only files written from the start, a stream written from somewhere in the middle is left alone
+            if filehandle.tell() != 0:
+                return False
+            os.posix_fallocate(filehandle.fileno(), 0, size)
+        except (AttributeError, ValueError, io.UnsupportedOperation):
+            return False
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EFBIG):
+                self.sendMessage(sock, self.createErrorMessage(self.ERROR_CODE_DISK_FULL, "Disk full"), server)
+                raise TftpException("Not enough disk space for " + str(size) + " bytes") from e
+            return False
+        return True
+
+    def getFilesize(self, filehandle):
+        """This helper function is used to get the file size of a file. Returns None for pipes, iterables and
+           anything else that cannot seek, whose size is not known before reading it all"""
+        try:
+            filehandle.seek(0,2) # Move the cursor to the end of the file
+            size = filehandle.tell() # Tell() will tell us the length in bytes
+            filehandle.seek(0) # Move the cursor back to the start of the file
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+        return size
+
+    def parseErrorMessage(self, message):
+        """This is used for decoding server-side errors. Returns a tuple of the error code and the error message"""
+        # The error message consists of an error code and a null terminated error message
+        message = bytes(message)
+        if len(message) < self.HEADER_SIZE:
+            return 0, ""
+        code = struct.unpack(">H", message[2:4])[0]
+        return code, message[4:].split(self.NULLTERM)[0].decode("ascii", "replace")
+
+    def decodeErrorMessage(self, message):
+        """This is used for decoding server-side errors into a single string"""
+        code, text = self.parseErrorMessage(message)
+        return str(code) + " " + text
+
+class TransferManager:
+    """Runs a queue of get and put jobs with a bounded number of transfers in parallel. Every job gets its own
+       TransferHandle for status and cancelling, and the manager reports the aggregate throughput"""
+
+    def __init__(self, tftpComm=None, maxConcurrency=4):
+        self.tftpComm = tftpComm or TftpComm()
+        self.maxConcurrency = maxConcurrency
+        self.jobs = queue.Queue()
+        self.handles = []
+        self.workers = []
+        self.lock = threading.Lock()
+
+    def submitGet(self, ip, port, remoteFilename, localFilename, timeout=TftpComm.DEFAULT_TIMEOUT,
+                  blockSize=TftpComm.DEFAULT_BLOCK_SIZE, windowSize=TftpComm.DEFAULT_WINDOW_SIZE, progressCallback=None):
+        """Queue a download. Returns its TransferHandle. Raises a ValueError right away if the input is wrong"""
+        return self.submit(True, ip, port, remoteFilename, localFilename, timeout, blockSize, windowSize, progressCallback)
+
+    def submitPut(self, ip, port, remoteFilename, localFilename, timeout=TftpComm.DEFAULT_TIMEOUT,
+                  blockSize=TftpComm.DEFAULT_BLOCK_SIZE, windowSize=TftpComm.DEFAULT_WINDOW_SIZE, progressCallback=None):
+        """Queue an upload. Returns its TransferHandle. Raises a ValueError right away if the input is wrong"""
+        return self.submit(False, ip, port, remoteFilename, localFilename, timeout, blockSize, windowSize, progressCallback)
+
+    def submit(self, read, ip, port, remoteFilename, localFilename, timeout, blockSize, windowSize, progressCallback):
+        """Queue a transfer and make sure there are workers to run it"""
+        self.tftpComm.checkArguments(ip, port, blockSize, windowSize)
+        handle = TransferHandle(read, ip, port, remoteFilename, localFilename)
+        # Look the host up while the job waits in the queue, the worker then finds it in the cache
+        self.tftpComm.resolver.prefetch([ip])
+
+        with self.lock:
+            self.handles.append(handle)
+            # Start workers on demand, up to the concurrency limit
+            if len(self.workers) < self.maxConcurrency:
+                worker = threading.Thread(target=self.workerThread, daemon=True)
+                self.workers.append(worker)
+                worker.start()
+
+        self.jobs.put((handle, timeout, blockSize, windowSize, progressCallback))
+        return handle
+
+    def workerThread(self):
+        """Takes jobs from the queue until it gets None"""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            handle, timeout, blockSize, windowSize, progressCallback = job
+            if handle.isCancelled():
+                # Cancelled while waiting in the queue
+                handle.status = handle.CANCELLED
+                handle.error = TftpCancelledError("Transfer cancelled before it started")
+                handle.finished.set()
+                continue
+
+            self.tftpComm.runTransfer(handle, timeout, blockSize, windowSize, progressCallback)
+
+    def waitAll(self, timeout=None):
+        """Wait for all the submitted transfers to end. Returns False if the timeout (in seconds) expired first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for handle in self.getHandles():
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not handle.wait(remaining):
+                return False
+        return True
+
+    def cancelAll(self):
+        """Cancel every queued and running transfer"""
+        for handle in self.getHandles():
+            handle.cancel()
+
+    def shutdown(self, cancel=False):
+        """Stop the workers once the queue is empty, or right away if cancel is set, and wait for them"""
+        if cancel:
+            self.cancelAll()
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = []
+        for worker in workers:
+            self.jobs.put(None)
+        for worker in workers:
+            worker.join()
+
+    def getHandles(self):
+        with self.lock:
+            return list(self.handles)
+
+    def getStatistics(self):
+        """Aggregate statistics of all the submitted transfers. Returns a dictionary with the number of transfers in
+           each status, the total bytes transferred, the wall time since the first transfer started and the
+           resulting throughput in bytes per second"""
+        handles = self.getHandles()
+        statistics = {status: 0 for status in (TransferHandle.QUEUED, TransferHandle.RUNNING, TransferHandle.DONE,
+                                               TransferHandle.FAILED, TransferHandle.CANCELLED)}
+        for handle in handles:
+            statistics[handle.status] += 1
+
+        startTimes = [handle.startTime for handle in handles if handle.startTime is not None]
+        if startTimes:
+            # Still running transfers count up to now
+            now = time.monotonic()
+            endTimes = [handle.endTime or now for handle in handles if handle.startTime is not None]
+            elapsed = max(endTimes) - min(startTimes)
+        else:
+            elapsed = 0
+
+        totalBytes = sum(handle.bytesTransferred for handle in handles)
+        statistics["bytes"] = totalBytes
+        statistics["elapsed"] = elapsed
+        statistics["throughput"] = totalBytes / elapsed if elapsed > 0 else 0
+        return statistics
+
+# End of file
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""Digests of the data of a transfer, computed block by block while it passes through the engine, so checking a
+   multi-GB image costs no second read of the file. A manifest holds the digests the files are expected to have.
+
+   Example:
+     from tftpcomm import TftpComm
+     from tftpdigest import Manifest
+
+     tftpComm = TftpComm(digests=["sha256"], manifest=Manifest.read("SHA256SUMS"))
+     result = tftpComm.get("192.168.1.10", 69, "firmware.bin", "firmware.bin")
+     print(result.digests["sha256"])"""
+
+import hashlib
+import re
+import zlib
+
+# Algorithms which can be asked for. crc32 is the checksum of zlib and gzip, the others are hashlib's
+ALGORITHMS = ("crc32", "md5", "sha1", "sha256", "sha512", "blake2b", "blake2s")
+DEFAULT_ALGORITHM = "sha256"
+
+# Read size when a file has to be digested from the disk after all
+READ_SIZE = 1024 * 1024
+
+
+class Crc32:
+    """CRC-32 with the update() and hexdigest() methods of the hashlib objects"""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+def createHash(algorithm):
+    """A new hash object for one of the ALGORITHMS. Raises a ValueError for anything else"""
+    if algorithm not in ALGORITHMS:
+        raise ValueError(str(algorithm) + " is not a supported digest algorithm")
+    if algorithm == "crc32":
+        return Crc32()
+    return hashlib.new(algorithm)
+
+
+class TransferDigest:
+    """Several digests of the same data, updated together. Blocks must be passed in order. hashlib releases the GIL
+       for blocks of a couple of KB and more, so digesting from the writer thread does not hold up the network loop"""
+
+    def __init__(self, algorithms):
+        self.hashes = {algorithm: createHash(algorithm) for algorithm in algorithms}
+
+    def getAlgorithms(self):
+        return list(self.hashes)
+
+    def update(self, data):
+        for hashObject in self.hashes.values():
+            hashObject.update(data)
+
+    def hexdigests(self):
+        """The digests of the data so far as lowercase hex strings, by algorithm"""
+        return {algorithm: hashObject.hexdigest() for algorithm, hashObject in self.hashes.items()}
+
+
+def digestFile(path, algorithms):
+    """Read a whole file and return its digests like TransferDigest.hexdigests()"""
+    digest = TransferDigest(algorithms)
+    with open(path, "rb") as filehandle:
+        while True:
+            data = filehandle.read(READ_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigests()
+
+
+class Manifest:
+    """Expected digests of files, as checksum files like the ones of sha256sum, b2sum and friends list them: lines
+       of "DIGEST  NAME", or with --tag "ALGORITHM (NAME) = DIGEST". Untagged lines do not tell the algorithm, they
+       are taken to be of the one given when reading. Files are looked up by their name on the server, or failing
+       that by the last part of it, so "images/boot.img" finds a manifest line of "boot.img"""
+    TAGGED_LINE = re.compile(r"^([A-Za-z0-9_-]+) \((.+)\) = ([0-9A-Fa-f]+)$")
+    UNTAGGED_LINE = re.compile(r"^([0-9A-Fa-f]+) [ *](.+)$")
+
+    def __init__(self):
+        self.entries = {} # Name: {algorithm: digest}
+
+    @classmethod
+    def read(cls, path, algorithm=DEFAULT_ALGORITHM):
+        """Read a manifest file. Blank lines and lines starting with # are skipped. Raises an OSError if the file
+           cannot be read and a ValueError, with the line number, if a line makes no sense"""
+        manifest = cls()
+        with open(path, "r", encoding="utf-8") as filehandle:
+            for lineNumber, line in enumerate(filehandle, 1):
+                line = line.rstrip("\r\n")
+                if not line.strip() or line.startswith("#"):
+                    continue
+                match = cls.TAGGED_LINE.match(line)
+                try:
+                    if match:
+                        manifest.add(match.group(2), match.group(1).lower(), match.group(3))
+                    else:
+                        match = cls.UNTAGGED_LINE.match(line)
+                        if not match:
+                            raise ValueError("not a checksum line")
+                        manifest.add(match.group(2), algorithm, match.group(1))
+                except ValueError as e:
+                    raise ValueError(path + " line " + str(lineNumber) + ": " + str(e))
+        return manifest
+
+    def add(self, name, algorithm, digest):
+        """Expect a file to have a digest. Raises a ValueError if the algorithm is not supported or the digest does
+           not have its length"""
+        expectedLength = len(createHash(algorithm).hexdigest())
+        if len(digest) != expectedLength:
+            raise ValueError(algorithm + " digests have " + str(expectedLength) + " hex digits, not " + str(len(digest)))
+        self.entries.setdefault(name, {})[algorithm] = digest.lower()
+
+    def getExpected(self, name):
+        """The digests expected for a file by algorithm, empty if the manifest does not list it"""
+        if name in self.entries:
+            return dict(self.entries[name])
+        return dict(self.entries.get(name.replace("\\", "/").rsplit("/", 1)[-1], {}))
+
+    def __len__(self):
+        return len(self.entries)
+
+# End of file
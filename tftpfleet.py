@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""Fleet transfers: push one file to (or pull files from) many devices listed in an inventory. The devices are
+   split across worker processes, one per CPU core by default, and every process runs many transfers at once on
+   the asyncio engine. Failed transfers are retried per device, and the packets sent by all the processes together
+   can be capped to spare the switches in the way.
+
+   The inventory is a CSV file with a header line or a JSON file holding a list of objects. The fields are host,
+   port, remote (the remote file) and local (the local file: the file to push, or where a pulled file goes). All but
+   host may be left out, the defaults come from the command line. remote and local may contain {host}, {port},
+   {remote} (local only) and {index} (line in the inventory, from 0), e.g. logs/{host}.log.
+
+   Examples:
+     python -m tftpfleet push switches.csv --local switch.cfg --remote startup.cfg --rate 20000
+     python -m tftpfleet pull switches.json --remote log.txt --local "logs/{host}.txt" --report report.json"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from tftpasync import TftpAsyncComm
+from tftpcomm import TftpComm, TftpException, TftpServerError
+from tftpmetrics import writeFileAtomically
+
+
+class FleetTarget:
+    """One device of the inventory and the files transferred with it"""
+
+    def __init__(self, index, host, port, remoteFilename, localFilename):
+        self.index = index
+        self.host = host
+        self.port = port
+        self.remoteFilename = remoteFilename
+        self.localFilename = localFilename
+
+    def __repr__(self):
+        return ("FleetTarget(index=" + str(self.index) + ", host=" + self.host + ", port=" + str(self.port)
+                + ", remoteFilename=" + self.remoteFilename + ", localFilename=" + self.localFilename + ")")
+
+
+def readInventory(path, port=TftpComm.DEFAULT_PORT, remoteFilename=None, localFilename=None):
+    """Read the targets of an inventory file, CSV or JSON (by the .json extension). port, remoteFilename and
+       localFilename are used for the fields a line leaves out. Raises a ValueError if a line has no host, a
+       remote or local file cannot be told, or a template names an unknown field, and an OSError if the file
+       cannot be read"""
+    with open(path, "r", encoding="utf-8", newline="") as filehandle:
+        if path.lower().endswith(".json"):
+            entries = json.load(filehandle)
+            if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+                raise ValueError(path + ": expected a list of objects")
+        else:
+            entries = list(csv.DictReader(filehandle))
+
+    targets = []
+    for index, entry in enumerate(entries):
+        where = path + ", entry " + str(index + 1)
+        host = str(entry.get("host") or "").strip()
+        if not host:
+            raise ValueError(where + ": no host")
+        try:
+            targetPort = int(entry.get("port") or port)
+        except ValueError:
+            raise ValueError(where + ": invalid port " + str(entry.get("port"))) from None
+
+        remote = entry.get("remote") or remoteFilename
+        local = entry.get("local") or localFilename
+        if not remote or not local:
+            raise ValueError(where + ": no " + ("remote" if not remote else "local") + " file")
+        try:
+            remote = remote.format(host=host, port=targetPort, index=index)
+            local = local.format(host=host, port=targetPort, remote=remote, index=index)
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(where + ": invalid file name template: " + str(e)) from None
+        targets.append(FleetTarget(index, host, targetPort, remote, local))
+    return targets
+
+
+class FleetOptions:
+    """Settings shared by all the transfers of a fleet run. rateLimit is in packets per second for the whole run,
+       None for no limit"""
+
+    def __init__(self, command, timeout=TftpComm.DEFAULT_TIMEOUT, blockSize=TftpComm.DEFAULT_BLOCK_SIZE,
+                 windowSize=TftpComm.DEFAULT_WINDOW_SIZE, rollover=TftpComm.ROLLOVER_ZERO, concurrency=64, retries=2,
+                 retryDelay=1.0, rateLimit=None, mode=TftpComm.MODE_OCTET):
+        if command not in ("push", "pull"):
+            raise ValueError("Invalid command " + str(command))
+        self.command = command
+        self.timeout = timeout
+        self.blockSize = blockSize
+        self.windowSize = windowSize
+        self.rollover = rollover
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.rateLimit = rateLimit
+        self.mode = mode
+
+
+class FleetRunner:
+    """Runs the transfers of an inventory across a pool of processes. Each process gets every n-th target and an
+       equal share of the rate limit, and runs up to options.concurrency transfers at once"""
+
+    def __init__(self, options, processes=None):
+        self.options = options
+        self.processes = processes or os.cpu_count() or 1
+
+    def run(self, targets):
+        """Transfer all the targets. Returns one record per target, in inventory order: a dictionary with the host,
+           port, remote and local file, the status ("done" or "failed"), the last error, the number of attempts,
+           the bytes transferred, the duration of the last attempt and its retransmissions"""
+        processes = max(1, min(self.processes, len(targets)))
+        shards = [targets[i::processes] for i in range(processes)]
+        if processes == 1:
+            records = runShard(self.options, targets, 1)
+        else:
+            # Spawned rather than forked, so no thread or lock of the caller ends up in the workers
+            context = multiprocessing.get_context("spawn")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+                futures = [executor.submit(runShard, self.options, shard, processes) for shard in shards]
+                records = []
+                for future in futures:
+                    records.extend(future.result())
+        return sorted(records, key=lambda record: record["index"])
+
+
+def runShard(options, targets, processes):
+    """Worker process: transfer a share of the targets on an event loop of its own"""
+    return asyncio.run(transferShard(options, targets, processes))
+
+
+async def transferShard(options, targets, processes):
+    rateLimit = options.rateLimit / processes if options.rateLimit else None
+    comm = TftpAsyncComm(rollover=options.rollover, rateLimit=rateLimit, mode=options.mode)
+    # Look every host up in the background from the start, most transfers then find theirs in the cache
+    comm.tftpComm.resolver.prefetch(target.host for target in targets)
+    semaphore = asyncio.Semaphore(options.concurrency)
+    return await asyncio.gather(*[transferTarget(comm, options, target, semaphore) for target in targets])
+
+
+async def transferTarget(comm, options, target, semaphore):
+    """Transfer the file of one target, retrying up to options.retries times with a doubling delay. Errors
+       reported by the server (file not found, access violation...) and invalid arguments are final and not
+       retried"""
+    record = {"index": target.index, "host": target.host, "port": target.port, "remoteFile": target.remoteFilename,
+              "localFile": target.localFilename, "status": "failed", "error": None, "attempts": 0, "bytes": 0,
+              "duration": 0.0, "retransmits": 0}
+    for attempt in range(options.retries + 1):
+        if attempt > 0:
+            # Waiting does not hold a slot, other targets go on meanwhile
+            await asyncio.sleep(options.retryDelay * 2 ** (attempt - 1))
+        async with semaphore:
+            record["attempts"] += 1
+            startTime = time.monotonic()
+            try:
+                if options.command == "push":
+                    result = await comm.put(target.host, target.port, target.remoteFilename, target.localFilename,
+                                            options.timeout, options.blockSize, options.windowSize)
+                else:
+                    directory = os.path.dirname(target.localFilename)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    result = await comm.get(target.host, target.port, target.remoteFilename, target.localFilename,
+                                            options.timeout, options.blockSize, options.windowSize)
+            except (TftpServerError, ValueError) as e:
+                record["error"] = str(e)
+                record["duration"] = time.monotonic() - startTime
+                break
+            except (TftpException, OSError) as e:
+                record["error"] = str(e)
+                record["duration"] = time.monotonic() - startTime
+                continue
+        record["status"] = "done"
+        record["error"] = None
+        record["bytes"] = result.fileSize
+        record["duration"] = time.monotonic() - startTime
+        record["retransmits"] = result.metrics.retransmits
+        break
+    return record
+
+
+def summarizeFleet(records, elapsed):
+    """Totals of a fleet run: targets, done and failed, attempts beyond the first, bytes, the wall time in seconds
+       and the resulting throughput in bytes per second"""
+    totalBytes = sum(record["bytes"] for record in records)
+    return {"targets": len(records),
+            "done": sum(1 for record in records if record["status"] == "done"),
+            "failed": sum(1 for record in records if record["status"] != "done"),
+            "retries": sum(record["attempts"] - 1 for record in records if record["attempts"] > 1),
+            "bytes": totalBytes,
+            "elapsed": elapsed,
+            "throughput": totalBytes / elapsed if elapsed > 0 else 0}
+
+
+def formatFleetSummary(summary, records):
+    """Human readable text of a fleet run: the failed targets and the totals"""
+    text = ""
+    for record in records:
+        if record["status"] != "done":
+            text += ("failed " + record["host"] + ":" + str(record["port"]) + " " + record["remoteFile"] + " after "
+                     + str(record["attempts"]) + " attempts: " + str(record["error"]) + "\n")
+    text += ("Targets: " + str(summary["targets"]) + ", done: " + str(summary["done"]) + ", failed: "
+             + str(summary["failed"]) + ", retries: " + str(summary["retries"]) + "\n"
+             + "Total: " + str(summary["bytes"]) + " bytes in " + "%.2f" % summary["elapsed"] + " s ("
+             + "%.0f" % summary["throughput"] + " bytes/s)\n")
+    return text
+
+
+def main(argv=None):
+    """Run a fleet transfer from the command line. Returns the exit code, 1 if any target failed"""
+    parser = argparse.ArgumentParser(prog="tftpfleet", description="TFTP transfers to and from many devices")
+    parser.add_argument("command", choices=["push", "pull"], help="upload a file to every device (push) or download one from every device (pull)")
+    parser.add_argument("inventory", help="CSV or JSON file listing the devices")
+    parser.add_argument("-r", "--remote", help="remote file, for devices the inventory gives none (may be a template)")
+    parser.add_argument("-l", "--local", help="local file, for devices the inventory gives none (may be a template)")
+    parser.add_argument("-p", "--port", type=int, default=TftpComm.DEFAULT_PORT, help="server port, for devices the inventory gives none (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="worker processes (default: %(default)s, the CPU cores)")
+    parser.add_argument("--concurrency", type=int, default=64, help="transfers at once per process (default: %(default)s)")
+    parser.add_argument("--retries", type=int, default=2, help="attempts after a failed one, per device (default: %(default)s)")
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="seconds before the first retry, doubling for every further one (default: %(default)s)")
+    parser.add_argument("--rate", type=float, help="at most this many packets per second for all the transfers together")
+    parser.add_argument("-t", "--timeout", type=float, default=TftpComm.DEFAULT_TIMEOUT, help="give up when a server is silent for this long, in ms (default: %(default)s)")
+    parser.add_argument("-b", "--blksize", type=int, default=TftpComm.DEFAULT_BLOCK_SIZE, help="block size to negotiate (default: %(default)s)")
+    parser.add_argument("-w", "--windowsize", type=int, default=TftpComm.DEFAULT_WINDOW_SIZE, help="window size to negotiate (default: %(default)s)")
+    parser.add_argument("--rollover", type=int, choices=TftpComm.ROLLOVER_POLICIES, default=TftpComm.ROLLOVER_ZERO, help="block number after 65535, must match the servers (default: %(default)s)")
+    parser.add_argument("-m", "--mode", choices=TftpComm.MODES, default=TftpComm.MODE_OCTET, help="transfer mode, netascii translates line endings (default: %(default)s)")
+    parser.add_argument("--report", metavar="FILE", help="write the summary and a record per device to a JSON file")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print the failures")
+    args = parser.parse_args(argv)
+
+    if args.processes < 1 or args.concurrency < 1 or args.retries < 0:
+        parser.error("--processes and --concurrency must be at least 1, --retries at least 0")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+
+    try:
+        targets = readInventory(args.inventory, args.port, args.remote, args.local)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Error: could not read the inventory: " + str(e) + "\n")
+        return 1
+
+    # Pulled files going to the same place would overwrite each other
+    if args.command == "pull":
+        localFilenames = [os.path.abspath(target.localFilename) for target in targets]
+        if len(set(localFilenames)) != len(localFilenames):
+            sys.stderr.write("Error: several devices pull to the same local file, use a template like logs/{host}.log\n")
+            return 1
+
+    options = FleetOptions(args.command, args.timeout, args.blksize, args.windowsize, args.rollover, args.concurrency,
+                           args.retries, args.retry_delay, args.rate, args.mode)
+    startTime = time.monotonic()
+    try:
+        records = FleetRunner(options, args.processes).run(targets)
+    except KeyboardInterrupt:
+        sys.stderr.write("Interrupted by user\n")
+        return 130
+    summary = summarizeFleet(records, time.monotonic() - startTime)
+
+    text = formatFleetSummary(summary, records)
+    if args.quiet:
+        text = "".join(line + "\n" for line in text.splitlines() if line.startswith("failed "))
+    sys.stderr.write(text)
+    if args.report:
+        try:
+            writeFileAtomically(args.report, json.dumps({"summary": summary, "records": records}, indent=1) + "\n")
+        except OSError as e:
+            sys.stderr.write("Error: could not write the report: " + str(e) + "\n")
+            return 1
+    return 0 if summary["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""Performance metrics of a single transfer, filled in by the engines while it runs. They tell apart the usual
+   reasons for a slow transfer: loss (retransmissions, timeouts, duplicates), server latency (round trip times) and
+   the local disk (time spent reading or writing the file). Metrics can be exported as JSON or in the Prometheus
+   text format, e.g. for the textfile collector of the node exporter"""
+
+import json
+import os
+import time
+
+
+class TransferMetrics:
+    """Metrics of one transfer. Times are in seconds. The engine calls start() and finish() around the transfer and
+       the add/record methods as things happen"""
+    # Upper bounds of the round trip time histogram buckets, the last bucket (+Inf) is implicit
+    RTT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+    # Bytes transferred are sampled at most this often, for the throughput over time
+    SAMPLE_INTERVAL = 0.25
+
+    def __init__(self):
+        self.direction = None # "get" or "put"
+        self.host = None
+        self.port = None
+        self.remoteFilename = None
+        self.startTime = None
+        self.endTime = None
+
+        self.bytes = 0
+        self.samples = [] # (seconds since the start, bytes transferred)
+        self.lastSampleTime = None
+
+        self.rttCounts = [0] * (len(self.RTT_BUCKETS) + 1)
+        self.rttSum = 0.0
+        self.rttCount = 0
+
+        self.retransmits = 0 # Packets sent again because no answer came back in time
+        self.duplicates = 0 # Blocks or ACKs received again
+        self.outOfOrder = 0 # Blocks received ahead of a missing one
+        self.timeouts = 0 # Times the retransmission timer expired
+        self.fastRetransmits = 0 # Windows sent again on a duplicate ACK, without waiting for the timer
+        self.diskTime = 0.0 # Time spent reading or writing the local file
+
+    def start(self, direction, host, port, remoteFilename):
+        self.direction = direction
+        self.host = host
+        self.port = int(port)
+        self.remoteFilename = remoteFilename
+        self.startTime = time.monotonic()
+        self.lastSampleTime = self.startTime
+        self.samples.append((0.0, 0))
+
+    def finish(self):
+        if self.endTime is None:
+            self.endTime = time.monotonic()
+            self.samples.append((self.getWallTime(), self.bytes))
+
+    def addRtt(self, rtt):
+        """Add a round trip time sample to the histogram"""
+        self.rttSum += rtt
+        self.rttCount += 1
+        for i, bound in enumerate(self.RTT_BUCKETS):
+            if rtt <= bound:
+                self.rttCounts[i] += 1
+                return
+        self.rttCounts[-1] += 1
+
+    def recordBytes(self, bytesTransferred):
+        """Record the bytes transferred so far, sampling them for the throughput over time"""
+        self.bytes = bytesTransferred
+        now = time.monotonic()
+        if self.lastSampleTime is not None and now - self.lastSampleTime >= self.SAMPLE_INTERVAL:
+            self.lastSampleTime = now
+            self.samples.append((now - self.startTime, bytesTransferred))
+
+    def getWallTime(self):
+        if self.startTime is None:
+            return 0.0
+        return (self.endTime or time.monotonic()) - self.startTime
+
+    def getThroughput(self):
+        """Average bytes per second over the whole transfer"""
+        wallTime = self.getWallTime()
+        return self.bytes / wallTime if wallTime > 0 else 0.0
+
+    def getThroughputSeries(self):
+        """Bytes per second between consecutive samples, as (seconds since the start, bytes per second) tuples"""
+        series = []
+        for (previousTime, previousBytes), (sampleTime, sampleBytes) in zip(self.samples, self.samples[1:]):
+            if sampleTime > previousTime:
+                series.append((sampleTime, (sampleBytes - previousBytes) / (sampleTime - previousTime)))
+        return series
+
+    def toDict(self):
+        return {"direction": self.direction,
+                "host": self.host,
+                "port": self.port,
+                "remoteFile": self.remoteFilename,
+                "wallTime": self.getWallTime(),
+                "bytes": self.bytes,
+                "throughput": self.getThroughput(),
+                "throughputSeries": self.getThroughputSeries(),
+                "rttHistogram": {"buckets": list(self.RTT_BUCKETS), "counts": list(self.rttCounts),
+                                 "sum": self.rttSum, "count": self.rttCount},
+                "retransmits": self.retransmits,
+                "duplicates": self.duplicates,
+                "outOfOrder": self.outOfOrder,
+                "timeouts": self.timeouts,
+                "fastRetransmits": self.fastRetransmits,
+                "diskTime": self.diskTime}
+
+    def toJson(self):
+        return json.dumps(self.toDict())
+
+    def getLabels(self):
+        """Prometheus label set of the transfer"""
+        return ("direction=\"" + escapeLabel(self.direction) + "\",host=\"" + escapeLabel(self.host)
+                + "\",port=\"" + escapeLabel(self.port) + "\",file=\"" + escapeLabel(self.remoteFilename) + "\"")
+
+    def __repr__(self):
+        return "TransferMetrics(" + self.toJson() + ")"
+
+
+# Name, type, help text and value of the Prometheus metrics exported for every transfer
+PROMETHEUS_METRICS = (
+    ("tftp_transfer_wall_time_seconds", "gauge", "Wall time of the transfer", lambda metrics: metrics.getWallTime()),
+    ("tftp_transfer_bytes", "gauge", "Bytes transferred", lambda metrics: metrics.bytes),
+    ("tftp_transfer_throughput_bytes_per_second", "gauge", "Average throughput of the transfer", lambda metrics: metrics.getThroughput()),
+    ("tftp_transfer_retransmits_total", "counter", "Packets sent again", lambda metrics: metrics.retransmits),
+    ("tftp_transfer_duplicates_total", "counter", "Duplicate blocks or ACKs received", lambda metrics: metrics.duplicates),
+    ("tftp_transfer_out_of_order_total", "counter", "Blocks received out of order", lambda metrics: metrics.outOfOrder),
+    ("tftp_transfer_timeouts_total", "counter", "Retransmission timer expiries", lambda metrics: metrics.timeouts),
+    ("tftp_transfer_fast_retransmits_total", "counter", "Windows sent again on a duplicate ACK", lambda metrics: metrics.fastRetransmits),
+    ("tftp_transfer_disk_seconds_total", "counter", "Time spent reading or writing the local file", lambda metrics: metrics.diskTime),
+)
+
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formatPrometheus(metricsList):
+    """Text exposition format of a list of TransferMetrics, every transfer told apart by its labels"""
+    lines = []
+    for name, kind, helpText, getValue in PROMETHEUS_METRICS:
+        lines.append("# HELP " + name + " " + helpText)
+        lines.append("# TYPE " + name + " " + kind)
+        for metrics in metricsList:
+            lines.append(name + "{" + metrics.getLabels() + "} " + repr(float(getValue(metrics))))
+
+    name = "tftp_transfer_rtt_seconds"
+    lines.append("# HELP " + name + " Round trip time of the packets of the transfer")
+    lines.append("# TYPE " + name + " histogram")
+    for metrics in metricsList:
+        labels = metrics.getLabels()
+        cumulative = 0
+        for bound, count in zip(metrics.RTT_BUCKETS + (float("inf"),), metrics.rttCounts):
+            cumulative += count
+            lines.append(name + "_bucket{" + labels + ",le=\"" + ("+Inf" if bound == float("inf") else repr(bound)) + "\"} " + str(cumulative))
+        lines.append(name + "_sum{" + labels + "} " + repr(metrics.rttSum))
+        lines.append(name + "_count{" + labels + "} " + str(metrics.rttCount))
+    return "\n".join(lines) + "\n"
+
+
+def writeFileAtomically(path, text):
+    """Write a whole file through a temporary file, so a collector never reads it half written"""
+    temporaryFile = path + ".tmp"
+    with open(temporaryFile, "w", encoding="utf-8") as filehandle:
+        filehandle.write(text)
+    os.replace(temporaryFile, path)
+
+
+def writePrometheusFile(path, metricsList):
+    """Export a list of TransferMetrics to a Prometheus text file (use a .prom name for the node exporter)"""
+    writeFileAtomically(path, formatPrometheus(metricsList))
+
+
+def writeJsonFile(path, metricsList):
+    """Export a list of TransferMetrics to a JSON file holding a list of objects"""
+    writeFileAtomically(path, json.dumps([metrics.toDict() for metrics in metricsList], indent=2) + "\n")
+
+# End of file
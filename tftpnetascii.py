@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Netascii, the text mode of TFTP (RFC 1350, after RFC 764). On the wire every line ends with CR LF and a CR of its
+   own is sent as CR NUL; locally lines end with LF. The translation works on whole chunks with bytes.replace, which
+   runs in C at memory speed, never byte by byte. Encoding needs no state. Decoding keeps back a CR ending a chunk,
+   since what it stands for depends on the byte starting the next one.
+
+   Example:
+     from tftpcomm import TftpComm
+
+     TftpComm(mode=TftpComm.MODE_NETASCII).get("192.168.1.10", 69, "switch.log", "switch.log")"""
+
+# Read size when a file is scanned for its encoded size
+READ_SIZE = 1024 * 1024
+
+
+def encodeNetascii(data):
+    """Translate local data to netascii. Any chunking of the data gives the same result joined"""
+    # CRs first, the CRs of the CR LFs added next must stay as they are
+    return bytes(data).replace(b"\r", b"\r\0").replace(b"\n", b"\r\n")
+
+
+def getEncodedSize(filehandle):
+    """Size of the content of a file once encoded, so an upload knows its transfer size up front: every LF and CR
+       adds a byte. Reads the file once and goes back to the start. Returns None for pipes, iterables and anything
+       else that cannot seek"""
+    try:
+        filehandle.seek(0)
+    except (AttributeError, OSError, ValueError):
+        return None
+    size = 0
+    while True:
+        data = filehandle.read(READ_SIZE)
+        if not data:
+            break
+        size += len(data) + data.count(b"\n") + data.count(b"\r")
+    filehandle.seek(0)
+    return size
+
+
+class NetasciiDecoder:
+    """Translates netascii back to local data, a chunk at a time. A CR at the end of a chunk is kept back until the
+       next one tells whether it was a CR LF, a CR NUL or (from a sloppy sender) a CR of its own. A bare CR stays a
+       CR and a bare LF an LF"""
+
+    def __init__(self):
+        self.pendingCr = False
+
+    def decode(self, data, final=False):
+        """Translate the next chunk. Pass final=True with the last one (which may be empty) to get a CR kept back
+           from before"""
+        if self.pendingCr:
+            data = b"\r" + data
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+        self.pendingCr = not final and data.endswith(b"\r")
+        if self.pendingCr:
+            data = data[:-1]
+        # CR LF first: the CRs the second replace leaves must not pair up with an LF again
+        return data.replace(b"\r\n", b"\n").replace(b"\r\0", b"\r")
+
+# End of file
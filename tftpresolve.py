@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""Resolution of the servers: host names and IPv4 or IPv6 addresses, turned with getaddrinfo into the address family
+   and socket address to talk to. Lookups are cached for a time to live, and many transfers to the same host wait for
+   a single lookup, so a batch fanning out to thousands of devices does not ask the DNS thousands of times.
+
+   Example:
+     from tftpresolve import HostResolver
+
+     resolver = HostResolver(ttl=60)
+     resolver.prefetch(["switch1.example.net", "switch2.example.net"])
+     family, address = resolver.resolve("switch1.example.net", 69)"""
+
+import asyncio
+import concurrent.futures
+import ipaddress
+import re
+import socket
+import threading
+import time
+
+# A DNS name has up to 253 characters, in labels of up to 63 letters, digits, hyphens (not at either end) and, as
+# some networks use them, underscores
+MAX_HOST_LENGTH = 253
+HOST_LABEL = re.compile(r"^(?!-)[A-Za-z0-9_-]{1,63}(?<!-)$")
+
+
+def normalizeHost(host):
+    """The host as getaddrinfo wants it: no surrounding blanks, and IPv6 addresses without the brackets of URLs"""
+    host = str(host).strip()
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    return host
+
+
+def isValidHost(host):
+    """True for an IPv4 or IPv6 address (with or without brackets and zone, like [fe80::1%eth0]) or a name fit for
+       the DNS. Nothing is looked up"""
+    host = normalizeHost(host)
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        pass
+    if host.endswith("."):
+        # Fully qualified, with the dot of the root
+        host = host[:-1]
+    if not host or len(host) > MAX_HOST_LENGTH:
+        return False
+    return all(HOST_LABEL.match(label) for label in host.split("."))
+
+
+class HostResolver:
+    """getaddrinfo with a cache. An entry lives ttl seconds, failed lookups are kept negativeTtl seconds so that a
+       dead name in a batch does not stall every job on it. The first address getaddrinfo returns is used, which
+       follows the preference of the system (RFC 6724, /etc/gai.conf on Linux). Thread safe; the lookup of a host is
+       done once even when many threads ask for it at the same time"""
+    DEFAULT_TTL = 300.0
+    DEFAULT_NEGATIVE_TTL = 10.0
+
+    # Threads looking up prefetched hosts
+    PREFETCH_WORKERS = 16
+
+    def __init__(self, ttl=DEFAULT_TTL, negativeTtl=DEFAULT_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+
+        # Host: (expiry time, family, socket address, error message). Failed lookups have an error and no family
+        self.entries = {}
+        # Host: Event set when the lookup running for it ends
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.statistics = {"hits": 0, "lookups": 0, "failures": 0}
+
+    def resolve(self, host, port):
+        """The address family and the socket address of a host for the given port, as (family, address), ready for
+           socket() and sendto(). Blocks if the host has to be looked up. Raises an OSError if it cannot be resolved"""
+        host = normalizeHost(host)
+        while True:
+            with self.lock:
+                entry = self.getEntry(host)
+                if entry is not None:
+                    self.statistics["hits"] += 1
+                    return self.makeAddress(host, entry, port)
+                event = self.pending.get(host)
+                if event is None:
+                    # Nobody is looking it up, it is our turn
+                    event = self.pending[host] = threading.Event()
+                    break
+            # Another thread is looking it up, wait for it and take its result from the cache
+            event.wait()
+
+        entry = None
+        try:
+            entry = self.lookup(host)
+        finally:
+            with self.lock:
+                if entry is not None:
+                    self.entries[host] = entry
+                    self.statistics["lookups"] += 1
+                    self.statistics["failures"] += entry[1] is None
+                del self.pending[host]
+            event.set()
+        return self.makeAddress(host, entry, port)
+
+    async def resolveAsync(self, host, port):
+        """resolve() for coroutines. Cached hosts are answered right away, lookups run in the default executor of the
+           loop so that it goes on meanwhile"""
+        with self.lock:
+            entry = self.getEntry(normalizeHost(host))
+            if entry is not None:
+                self.statistics["hits"] += 1
+                return self.makeAddress(normalizeHost(host), entry, port)
+        return await asyncio.get_running_loop().run_in_executor(None, self.resolve, host, port)
+
+    def prefetch(self, hosts):
+        """Start looking up hosts in the background, so that the transfers to them find them in the cache instead of
+           waiting for the DNS one by one. Hosts which are cached or being looked up are skipped"""
+        with self.lock:
+            missing = set()
+            for host in hosts:
+                host = normalizeHost(host)
+                if self.getEntry(host) is None and host not in self.pending:
+                    missing.add(host)
+            if not missing:
+                return
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.PREFETCH_WORKERS, "resolver")
+        for host in missing:
+            self.executor.submit(self.resolveQuietly, host)
+
+    def resolveQuietly(self, host):
+        """resolve() for prefetching: failures are cached, no one is there to take the exception"""
+        try:
+            self.resolve(host, 0)
+        except OSError:
+            pass
+
+    def getEntry(self, host):
+        """The cache entry of a host, None if there is none or it expired. Call with the lock held"""
+        entry = self.entries.get(host)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[host]
+            return None
+        return entry
+
+    def lookup(self, host):
+        """Ask getaddrinfo, and return a cache entry with the first IPv4 or IPv6 address or with the error"""
+        try:
+            for family, ignore, ignore, ignore, address in socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_DGRAM):
+                if family in (socket.AF_INET, socket.AF_INET6):
+                    return (time.monotonic() + self.ttl, family, address, None)
+            error = "no IPv4 or IPv6 address"
+        except (OSError, UnicodeError) as e:
+            # UnicodeError: a label too long for IDNA
+            error = str(e)
+        return (time.monotonic() + self.negativeTtl, None, None, error)
+
+    def makeAddress(self, host, entry, port):
+        """(family, socket address) from a cache entry, with the port put in. Raises an OSError for failed lookups"""
+        ignore, family, address, error = entry
+        if family is None:
+            raise OSError("Could not resolve " + host + ": " + error)
+        # IPv6 socket addresses carry the flow info and the scope id after the port
+        return family, (address[0], int(port)) + tuple(address[2:])
+
+    def clear(self):
+        """Forget every cached host"""
+        with self.lock:
+            self.entries.clear()
+
+    def getStatistics(self):
+        """Cache hits, lookups and failed lookups since the resolver was created, and the number of cached hosts"""
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics["entries"] = len(self.entries)
+        return statistics
+
+# End of file
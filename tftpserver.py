@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+
+"""Small TFTP server and network impairment proxy for tests and benchmarks. Both run in threads of the calling
+   process and listen on 127.0.0.1 by default, so the client can be exercised without a real server or network.
+
+   Examples:
+     python -m tftpserver /srv/tftp --port 6969
+     python -m tftpserver /srv/tftp --port 6969 --loss 0.01 --delay 0.005 --jitter 0.002"""
+
+import argparse
+import heapq
+import io
+import os
+import random
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+from tftpcomm import TftpComm
+from tftpnetascii import NetasciiDecoder, encodeNetascii
+
+
+def getFamily(host):
+    """Address family of the address to listen on: IPv6 for addresses like ::1, IPv4 otherwise"""
+    return socket.AF_INET6 if ":" in host else socket.AF_INET
+
+
+class TftpServer:
+    """TFTP server serving the files of a directory. Supports read and write requests with the blksize, windowsize
+       and tsize options. Like a real server every transfer gets a thread and a port (transfer ID) of its own.
+       Netascii files are translated to and from LF line endings"""
+    OPCODE_READ = 1
+    OPCODE_WRITE = 2
+
+    ERROR_CODE_NOT_FOUND = 1
+    ERROR_CODE_ACCESS_VIOLATION = 2
+    ERROR_CODE_ILLEGAL_OPERATION = 4
+    ERROR_CODE_UNKNOWN_TRANSFER_ID = 5
+
+    def __init__(self, root, host="127.0.0.1", port=0, options=True, timeout=0.5, retries=10, rollover=TftpComm.ROLLOVER_ZERO):
+        """Serve the files under root. Port 0 picks a free port, see address. Without options the server behaves
+           like a plain RFC 1350 server and ignores them. Timeout (in seconds) and retries apply to every packet.
+           Rollover is the block number following 65535, 0 or 1"""
+        self.root = os.path.realpath(root)
+        self.host = host
+        self.options = options
+        self.timeout = timeout
+        self.retries = retries
+        self.tftpComm = TftpComm(rollover=rollover)
+
+        self.sock = socket.socket(getFamily(host), socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.running = False
+        self.thread = None
+
+        # Clients with a transfer running. A request repeated because our answer was slow must not start a second
+        # transfer, which would truncate the file of a write
+        self.activeClients = set()
+        self.activeClientsLock = threading.Lock()
+
+    def start(self):
+        """Start serving in a thread. Returns the server"""
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop taking requests. Transfers already running finish on their own"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sock.close()
+
+    def serve(self):
+        """Waits for requests and starts a thread for every one"""
+        # Closing a socket does not wake up a thread blocked on it, so check now and then whether to stop
+        self.sock.settimeout(0.1)
+        while self.running:
+            try:
+                message, client = self.sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self.activeClientsLock:
+                if client in self.activeClients:
+                    continue
+                self.activeClients.add(client)
+            threading.Thread(target=self.handleRequest, args=(message, client), daemon=True).start()
+
+    def handleRequest(self, message, client):
+        """Run one transfer from its request to the end, on a socket of its own"""
+        sock = socket.socket(getFamily(self.host), socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.host, 0))
+            sock.settimeout(self.timeout)
+
+            try:
+                opcode = struct.unpack_from(">H", message)[0]
+                filename, mode, options = self.parseRequest(message)
+            except (struct.error, IndexError, UnicodeDecodeError):
+                self.sendError(sock, client, self.ERROR_CODE_ILLEGAL_OPERATION, "Malformed request")
+                return
+            if opcode not in (self.OPCODE_READ, self.OPCODE_WRITE) or mode not in ("octet", "netascii"):
+                self.sendError(sock, client, self.ERROR_CODE_ILLEGAL_OPERATION, "Illegal TFTP operation")
+                return
+
+            path = self.resolvePath(filename)
+            if path is None:
+                self.sendError(sock, client, self.ERROR_CODE_ACCESS_VIOLATION, "Access violation")
+                return
+
+            if opcode == self.OPCODE_READ:
+                try:
+                    filehandle = open(path, "rb")
+                except OSError:
+                    self.sendError(sock, client, self.ERROR_CODE_NOT_FOUND, "File not found")
+                    return
+                with filehandle:
+                    if mode == "netascii":
+                        # Test files are small, translate them in one go
+                        filehandle = io.BytesIO(encodeNetascii(filehandle.read()))
+                    self.sendFile(sock, client, filehandle, options)
+            else:
+                try:
+                    filehandle = open(path, "wb")
+                except OSError:
+                    self.sendError(sock, client, self.ERROR_CODE_ACCESS_VIOLATION, "Cannot write file")
+                    return
+                with filehandle:
+                    if mode == "netascii":
+                        filehandle = NetasciiWriter(filehandle)
+                    self.receiveFile(sock, client, filehandle, options)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+            with self.activeClientsLock:
+                self.activeClients.discard(client)
+
+    def parseRequest(self, message):
+        """Returns the file name, the lowercase mode and a dictionary of the options of a request"""
+        fields = bytes(message[2:]).split(TftpComm.NULLTERM)
+        options = {}
+        for i in range(2, len(fields) - 1, 2):
+            options[fields[i].decode("ascii").lower()] = fields[i + 1].decode("ascii")
+        return fields[0].decode("ascii"), fields[1].decode("ascii").lower(), options
+
+    def resolvePath(self, filename):
+        """The path of a requested file, None if it is outside the served directory"""
+        path = os.path.realpath(os.path.join(self.root, filename.lstrip("/")))
+        if os.path.commonpath([self.root, path]) != self.root:
+            return None
+        return path
+
+    def negotiate(self, options, transferSize):
+        """Works out the block and window sizes from the requested options. Returns them with the options to
+           acknowledge, an empty dictionary if there is nothing to acknowledge"""
+        blockSize = TftpComm.DEFAULT_BLOCK_SIZE
+        windowSize = TftpComm.DEFAULT_WINDOW_SIZE
+        accepted = {}
+        if not self.options:
+            return blockSize, windowSize, accepted
+
+        try:
+            if "blksize" in options and int(options["blksize"]) >= TftpComm.MIN_BLOCK_SIZE:
+                blockSize = min(int(options["blksize"]), TftpComm.MAX_BLOCK_SIZE)
+                accepted["blksize"] = blockSize
+            if "windowsize" in options and int(options["windowsize"]) >= TftpComm.MIN_WINDOW_SIZE:
+                windowSize = min(int(options["windowsize"]), TftpComm.MAX_WINDOW_SIZE)
+                accepted["windowsize"] = windowSize
+            if "tsize" in options:
+                accepted["tsize"] = transferSize if transferSize is not None else int(options["tsize"])
+        except ValueError:
+            pass
+        return blockSize, windowSize, accepted
+
+    def sendError(self, sock, client, code, message):
+        sock.sendto(self.tftpComm.createErrorMessage(code, message), client)
+
+    def receiveFrom(self, sock, client, bufferSize):
+        """Receive the next message of the transfer. Messages from anyone else get an error and are skipped.
+           Raises socket.timeout"""
+        while True:
+            message, address = sock.recvfrom(bufferSize)
+            if address == client:
+                return message
+            self.sendError(sock, address, self.ERROR_CODE_UNKNOWN_TRANSFER_ID, "Unknown transfer ID")
+
+    def sendFile(self, sock, client, filehandle, options):
+        """Answer a read request: send the file in windows and slide them on the ACKs"""
+        size = filehandle.seek(0, os.SEEK_END)
+        filehandle.seek(0)
+        blockSize, windowSize, accepted = self.negotiate(options, size)
+
+        # Options are acknowledged with an OACK, which the client acknowledges with ACK 0
+        if accepted:
+            oack = TftpComm.OACK + self.tftpComm.encodeOptions(accepted)
+            if not self.exchange(sock, client, oack, 0):
+                return
+
+        lastBlockNumber = size // blockSize + 1
+        window = []
+        acked = 0
+        nextBlockNumber = 1
+        resend = True
+        retries = 0
+        while True:
+            while len(window) < windowSize and nextBlockNumber <= lastBlockNumber:
+                window.append(TftpComm.DATA + struct.pack(">H", self.tftpComm.toWireBlockNumber(nextBlockNumber)) + filehandle.read(blockSize))
+                nextBlockNumber += 1
+                resend = True
+            if not window:
+                return
+
+            if resend:
+                for message in window:
+                    sock.sendto(message, client)
+                resend = False
+
+            try:
+                message = self.receiveFrom(sock, client, TftpComm.CONTROL_BUFFER_SIZE)
+            except socket.timeout:
+                retries += 1
+                if retries > self.retries:
+                    return
+                resend = True
+                continue
+
+            if len(message) < TftpComm.HEADER_SIZE:
+                continue
+            opcode, blockNumber = TftpComm.HEADER.unpack_from(message)
+            if opcode == TftpComm.OPCODE_ERROR:
+                return
+            if opcode != TftpComm.OPCODE_ACK:
+                continue
+
+            blockNumber = self.tftpComm.fromWireBlockNumber(blockNumber, acked)
+            if acked < blockNumber <= acked + len(window):
+                del window[:blockNumber - acked]
+                acked = blockNumber
+                retries = 0
+                # A partial ACK means the rest of the window was lost (RFC 7440), go on from there
+                resend = True
+            elif blockNumber == acked and windowSize > 1:
+                resend = True
+            # A duplicate ACK in lock-step is ignored, answering it would start the sorcerer's apprentice
+
+    def exchange(self, sock, client, message, expectedBlockNumber):
+        """Send a message until it is acknowledged with the expected block number. Returns False if it never is"""
+        for attempt in range(self.retries + 1):
+            sock.sendto(message, client)
+            deadline = time.monotonic() + self.timeout
+            while True:
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                try:
+                    answer = self.receiveFrom(sock, client, TftpComm.CONTROL_BUFFER_SIZE)
+                except socket.timeout:
+                    break
+                if len(answer) < TftpComm.HEADER_SIZE:
+                    continue
+                opcode, blockNumber = TftpComm.HEADER.unpack_from(answer)
+                if opcode == TftpComm.OPCODE_ERROR:
+                    return False
+                if opcode == TftpComm.OPCODE_ACK and blockNumber == expectedBlockNumber:
+                    sock.settimeout(self.timeout)
+                    return True
+        sock.settimeout(self.timeout)
+        return False
+
+    def receiveFile(self, sock, client, filehandle, options):
+        """Answer a write request: acknowledge windows of blocks until a short one ends the file"""
+        blockSize, windowSize, accepted = self.negotiate(options, None)
+        if accepted:
+            ack = TftpComm.OACK + self.tftpComm.encodeOptions(accepted)
+        else:
+            ack = TftpComm.ACK + struct.pack(">H", 0)
+        sock.sendto(ack, client)
+
+        expectedBlockNumber = 1
+        blocksInWindow = 0
+        windowBroken = False
+        retries = 0
+        while True:
+            try:
+                message = self.receiveFrom(sock, client, blockSize + TftpComm.HEADER_SIZE)
+            except socket.timeout:
+                retries += 1
+                if retries > self.retries:
+                    return
+                sock.sendto(ack, client)
+                continue
+
+            if len(message) < TftpComm.HEADER_SIZE:
+                continue
+            opcode, blockNumber = TftpComm.HEADER.unpack_from(message)
+            if opcode == TftpComm.OPCODE_ERROR:
+                return
+            if opcode != TftpComm.OPCODE_DATA:
+                continue
+
+            if blockNumber == self.tftpComm.toWireBlockNumber(expectedBlockNumber):
+                filehandle.write(message[TftpComm.HEADER_SIZE:])
+                expectedBlockNumber += 1
+                blocksInWindow += 1
+                windowBroken = False
+                retries = 0
+                lastBlock = len(message) - TftpComm.HEADER_SIZE < blockSize
+                if lastBlock or blocksInWindow >= windowSize:
+                    ack = TftpComm.ACK + struct.pack(">H", self.tftpComm.toWireBlockNumber(expectedBlockNumber - 1))
+                    blocksInWindow = 0
+                    if lastBlock:
+                        filehandle.close()
+                        sock.sendto(ack, client)
+                        self.dally(sock, client, ack)
+                        return
+                    sock.sendto(ack, client)
+            elif self.tftpComm.fromWireBlockNumber(blockNumber, expectedBlockNumber - 1) < expectedBlockNumber:
+                # A block we already have. The client sends it again when our ACK was lost, so like RFC 1123 section
+                # 4.2.3.1 asks of a receiver it is answered with the ACK of the last block received: always in
+                # lock-step, and in windows when it is the last block of a window we acknowledged. The client
+                # ignores the duplicate ACKs this gives, so it does not send its window again for them
+                if windowSize == 1 or (blocksInWindow == 0 and
+                                       self.tftpComm.fromWireBlockNumber(blockNumber, expectedBlockNumber - 1) == expectedBlockNumber - 1):
+                    sock.sendto(TftpComm.ACK + struct.pack(">H", self.tftpComm.toWireBlockNumber(expectedBlockNumber - 1)), client)
+            elif not windowBroken:
+                # A block skipped a missing one: acknowledge the last good block once so the client goes back there
+                windowBroken = True
+                blocksInWindow = 0
+                ack = TftpComm.ACK + struct.pack(">H", self.tftpComm.toWireBlockNumber(expectedBlockNumber - 1))
+                sock.sendto(ack, client)
+
+    def dally(self, sock, client, ack):
+        """Wait after the final ACK and send it again if the client repeats the last block, which means the ACK was
+           lost. The client may be backing off, so this waits as long as the server would wait for a lost packet"""
+        deadline = time.monotonic() + self.timeout * self.retries
+        while time.monotonic() < deadline:
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            try:
+                message = self.receiveFrom(sock, client, 65536)
+            except socket.timeout:
+                return
+            if len(message) >= TftpComm.HEADER_SIZE and TftpComm.HEADER.unpack_from(message)[0] == TftpComm.OPCODE_DATA:
+                sock.sendto(ack, client)
+
+
+class NetasciiWriter:
+    """File written by a netascii upload: translates what the server receives before writing it"""
+
+    def __init__(self, filehandle):
+        self.filehandle = filehandle
+        self.decoder = NetasciiDecoder()
+
+    def write(self, data):
+        self.filehandle.write(self.decoder.decode(data))
+
+    def close(self):
+        if not self.filehandle.closed:
+            self.filehandle.write(self.decoder.decode(b"", True))
+            self.filehandle.close()
+
+
+class ImpairmentProxy:
+    """UDP proxy between a TFTP client and server which impairs the traffic in both directions: it drops, delays
+       (with jitter), duplicates and reorders packets with the given probabilities. Clients send their requests to
+       the proxy address. Since the server answers from a new port (transfer ID), the proxy opens a port for every
+       server transfer ID it sees and the client talks to that one, so the whole transfer goes through the proxy.
+       Delays and jitter are in seconds. A seed makes the impairments repeatable"""
+    # Extra delay of a reordered packet, so the packets after it overtake it
+    REORDER_DELAY = 0.005
+
+    # Sockets of a client which has been silent this long are closed, in seconds
+    SESSION_TIMEOUT = 30.0
+
+    def __init__(self, server, host="127.0.0.1", port=0, delay=0.0, jitter=0.0, loss=0.0, duplicate=0.0, reorder=0.0, seed=None):
+        self.server = server
+        self.host = host
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(getFamily(host), socket.SOCK_DGRAM)
+        self.listener.bind((host, port))
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ, ("listen", None))
+        self.address = self.listener.getsockname()
+
+        # Sockets towards the server per client, and towards the client per client and server transfer ID
+        self.upstream = {}
+        self.downstream = {}
+        self.lastActivity = {}
+
+        # Packets waiting for their delay to pass, as (time, sequence, socket, message, address)
+        self.pending = []
+        self.sequence = 0
+
+        self.statistics = {"forwarded": 0, "dropped": 0, "duplicated": 0, "reordered": 0}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start forwarding in a thread. Returns the proxy"""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def run(self):
+        """Forward packets until stopped. A single thread does everything, so nothing needs locking"""
+        lastCleanup = time.monotonic()
+        while self.running:
+            timeout = 0.1
+            if self.pending:
+                timeout = min(timeout, max(self.pending[0][0] - time.monotonic(), 0))
+
+            for key, mask in self.selector.select(timeout):
+                try:
+                    message, address = key.fileobj.recvfrom(65536)
+                except OSError:
+                    continue
+                role, info = key.data
+                if role == "listen":
+                    # A request from a client, towards the server's well known port
+                    self.forward(self.getUpstream(address), message, self.server)
+                elif role == "up":
+                    # The server answering a client, through the port standing for this server transfer ID
+                    self.forward(self.getDownstream(info, address), message, info)
+                elif address == info[0]:
+                    # The client talking to a server transfer ID
+                    client, serverAddress = info
+                    self.forward(self.getUpstream(client), message, serverAddress)
+
+            self.sendDue()
+            if time.monotonic() - lastCleanup > 1.0:
+                self.closeIdleSessions()
+                lastCleanup = time.monotonic()
+
+    def getUpstream(self, client):
+        self.lastActivity[client] = time.monotonic()
+        if client not in self.upstream:
+            sock = self.openSocket(("up", client))
+            self.upstream[client] = sock
+        return self.upstream[client]
+
+    def getDownstream(self, client, serverAddress):
+        self.lastActivity[client] = time.monotonic()
+        if (client, serverAddress) not in self.downstream:
+            self.downstream[(client, serverAddress)] = self.openSocket(("down", (client, serverAddress)))
+        return self.downstream[(client, serverAddress)]
+
+    def openSocket(self, data):
+        sock = socket.socket(getFamily(self.host), socket.SOCK_DGRAM)
+        sock.bind((self.host, 0))
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, data)
+        return sock
+
+    def closeIdleSessions(self):
+        now = time.monotonic()
+        for client in [client for client, last in self.lastActivity.items() if now - last > self.SESSION_TIMEOUT]:
+            del self.lastActivity[client]
+            sockets = [self.upstream.pop(client)] if client in self.upstream else []
+            for key in [key for key in self.downstream if key[0] == client]:
+                sockets.append(self.downstream.pop(key))
+            for sock in sockets:
+                self.selector.unregister(sock)
+                sock.close()
+
+    def forward(self, sock, message, address):
+        """Queue a packet, applying the impairments"""
+        if self.random.random() < self.loss:
+            self.statistics["dropped"] += 1
+            return
+
+        sendTime = time.monotonic() + self.delay + self.random.uniform(0, self.jitter)
+        if self.random.random() < self.reorder:
+            sendTime += self.REORDER_DELAY + self.delay
+            self.statistics["reordered"] += 1
+        self.schedule(sendTime, sock, message, address)
+
+        if self.random.random() < self.duplicate:
+            self.schedule(sendTime + self.random.uniform(0, self.jitter), sock, message, address)
+            self.statistics["duplicated"] += 1
+
+    def schedule(self, sendTime, sock, message, address):
+        # The sequence number keeps packets due at the same time in order
+        self.sequence += 1
+        heapq.heappush(self.pending, (sendTime, self.sequence, sock, message, address))
+
+    def sendDue(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            ignore, ignore, sock, message, address = heapq.heappop(self.pending)
+            try:
+                sock.sendto(message, address)
+                self.statistics["forwarded"] += 1
+            except OSError:
+                pass
+
+
+def main(argv=None):
+    """Serve a directory, optionally behind an impairment proxy, until interrupted"""
+    parser = argparse.ArgumentParser(prog="tftpserver", description="TFTP server for tests and benchmarks")
+    parser.add_argument("root", help="directory to serve")
+    parser.add_argument("--host", default="127.0.0.1", help="IPv4 or IPv6 address to listen on (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int, default=TftpComm.DEFAULT_PORT, help="port to listen on (default: %(default)s)")
+    parser.add_argument("--no-options", action="store_true", help="ignore the options like a plain RFC 1350 server")
+    parser.add_argument("--rollover", type=int, choices=TftpComm.ROLLOVER_POLICIES, default=TftpComm.ROLLOVER_ZERO, help="block number after 65535 (default: %(default)s)")
+    parser.add_argument("--delay", type=float, default=0.0, help="delay added to every packet, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra delay up to this, in seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of dropping a packet")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probability of duplicating a packet")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability of delaying a packet past the next ones")
+    parser.add_argument("--seed", type=int, help="seed of the impairments, for repeatable runs")
+    args = parser.parse_args(argv)
+
+    impaired = args.delay or args.jitter or args.loss or args.duplicate or args.reorder
+    server = TftpServer(args.root, args.host, 0 if impaired else args.port, not args.no_options, rollover=args.rollover).start()
+    proxy = None
+    if impaired:
+        proxy = ImpairmentProxy(server.address, args.host, args.port, args.delay, args.jitter, args.loss,
+                                args.duplicate, args.reorder, args.seed).start()
+    address = proxy.address if proxy else server.address
+    sys.stderr.write("Serving " + args.root + " on " + address[0] + ":" + str(address[1]) + "\n")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    if proxy:
+        proxy.stop()
+        sys.stderr.write(str(proxy.statistics) + "\n")
+    server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file
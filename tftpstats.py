@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Append-only store of per-transfer statistics. Every transfer adds one JSON line to the file, nothing is ever
+   rewritten, so recording a transfer is a single small write however long the history is. The records are parsed
+   once, when the store is first asked for them, and kept in memory afterwards"""
+
+import json
+import math
+import time
+
+
+class TransferStatisticsStore:
+    """Statistics of all the transfers made, one JSON object per line. Records hold the time, host, direction,
+       file, status, size, duration, throughput, packets, retransmits and the negotiated block and window sizes"""
+    DEFAULT_PATH = "statistics.jsonl"
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.records = None # Loaded on first use
+
+    def getRecords(self):
+        """All the records, oldest first. Lines which cannot be parsed (a write cut short by a crash) are skipped"""
+        if self.records is None:
+            self.records = []
+            try:
+                with open(self.path, "r", encoding="utf-8") as filehandle:
+                    for line in filehandle:
+                        try:
+                            self.records.append(json.loads(line))
+                        except ValueError:
+                            continue
+            except FileNotFoundError:
+                pass
+        return self.records
+
+    def add(self, record):
+        """Append a record to the file and to the records in memory"""
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with open(self.path, "a", encoding="utf-8") as filehandle:
+            filehandle.write(line)
+        # Only keep it in memory once the file has been read, otherwise it would be read twice
+        if self.records is not None:
+            self.records.append(record)
+
+    def addTransfer(self, handle):
+        """Record a finished transfer from its TransferHandle"""
+        result = handle.result
+        duration = handle.getElapsedTime()
+        self.add({"time": time.time(),
+                  "host": str(handle.ip),
+                  "port": int(handle.port),
+                  "direction": "get" if handle.read else "put",
+                  "remoteFile": handle.remoteFilename,
+                  "status": handle.status,
+                  "error": str(handle.error) if handle.error is not None else None,
+                  "bytes": result.fileSize,
+                  "packets": result.nPackets,
+                  "bytesLastPacket": result.bytesLastPacket,
+                  "retransmits": result.metrics.retransmits,
+                  "blockSize": result.blockSize,
+                  "windowSize": result.windowSize,
+                  "duration": duration,
+                  "throughput": result.fileSize / duration if duration > 0 else 0})
+
+    def getLast(self):
+        """The last record, None if there are none"""
+        records = self.getRecords()
+        return records[-1] if records else None
+
+    def getSummary(self):
+        """Aggregates of all the records: totals and, per host, the number of transfers, bytes, retransmits and the
+           median and 90th percentile of throughput and duration. Returns a dictionary with "total" and "hosts" keys,
+           the latter mapping host names to the same kind of dictionary"""
+        records = self.getRecords()
+        hosts = {}
+        for record in records:
+            hosts.setdefault(record.get("host"), []).append(record)
+        return {"total": self.summarize(records),
+                "hosts": {host: self.summarize(hostRecords) for host, hostRecords in sorted(hosts.items())}}
+
+    def summarize(self, records):
+        throughputs = sorted(record.get("throughput", 0) for record in records)
+        durations = sorted(record.get("duration", 0) for record in records)
+        return {"transfers": len(records),
+                "failed": sum(1 for record in records if record.get("status") != "done"),
+                "bytes": sum(record.get("bytes", 0) for record in records),
+                "packets": sum(record.get("packets", 0) for record in records),
+                "retransmits": sum(record.get("retransmits", 0) for record in records),
+                "throughputMedian": percentile(throughputs, 50),
+                "throughputP90": percentile(throughputs, 90),
+                "durationMedian": percentile(durations, 50),
+                "durationP90": percentile(durations, 90)}
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values, 0 if there are none"""
+    if not values:
+        return 0
+    rank = max(1, math.ceil(percent / 100 * len(values)))
+    return values[rank - 1]
+
+
+def formatSummary(summary):
+    """Human readable text of a getSummary() result"""
+    def formatGroup(name, group):
+        return (name + ": " + str(group["transfers"]) + " transfers (" + str(group["failed"]) + " failed), "
+                + str(group["bytes"]) + " bytes, " + str(group["retransmits"]) + " retransmits\n"
+                + "  throughput median/p90: " + "%.1f" % (group["throughputMedian"] / 1024) + " / "
+                + "%.1f" % (group["throughputP90"] / 1024) + " KB/s, duration median/p90: "
+                + "%.2f" % group["durationMedian"] + " / " + "%.2f" % group["durationP90"] + " s\n")
+
+    text = formatGroup("All hosts", summary["total"])
+    for host, group in summary["hosts"].items():
+        text += formatGroup(host, group)
+    return text
+
+# End of file
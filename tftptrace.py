@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+"""Packet trace of the transfers, for finding out why one is slow. The engine records the time, direction, opcode,
+   block number and length of every packet it sends or receives into a ring buffer allocated up front, which costs
+   about a microsecond per packet and no memory over time, so the trace can be left on. The ring keeps the last
+   packets; it can be saved as a compact binary trace or as a pcap file for Wireshark, and summarized into the
+   stalls and the clusters of retransmissions of every transfer.
+
+   Examples:
+     python -m tftpcmd get 192.168.1.10 firmware.bin --trace firmware.trace
+     python -m tftptrace summary firmware.trace --stall 100
+     python -m tftptrace pcap firmware.trace firmware.pcap"""
+
+import argparse
+import ipaddress
+import itertools
+import struct
+import sys
+import time
+import weakref
+
+SENT = 0
+RECEIVED = 1
+
+# Time, direction, opcode, block number (the 16 bit one on the wire, the error code of an ERROR), length of the
+# message, local port, remote port and remote address (IPv4 addresses mapped into IPv6 ones)
+RECORD = struct.Struct("<dBHHIHH16s")
+
+# Opcode and block number at the start of the messages
+MESSAGE_HEADER = struct.Struct(">HH")
+
+OPCODE_NAMES = {1: "RRQ", 2: "WRQ", 3: "DATA", 4: "ACK", 5: "ERROR", 6: "OACK"}
+
+# The binary trace file: magic, record size, records recorded in all (more than in the file once the ring wrapped)
+# and records in the file, followed by the records
+TRACE_MAGIC = b"TFTPTRC1"
+TRACE_HEADER = struct.Struct("<8sIQI")
+
+# pcap file of raw IP packets with microsecond timestamps, see https://wiki.wireshark.org/Development/LibpcapFileFormat
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_RECORD = struct.Struct("<IIII")
+PCAP_MAGIC = 0xa1b2c3d4
+LINKTYPE_RAW = 101
+IPV4_HEADER = struct.Struct(">BBHHHBBH4s4s")
+IPV6_HEADER = struct.Struct(">IHBB16s16s")
+UDP_HEADER = struct.Struct(">HHHH")
+UDP_PROTOCOL = 17
+
+DEFAULT_STALL_THRESHOLD = 0.2 # Seconds without a packet of the transfer
+DEFAULT_CLUSTER_GAP = 0.05 # Seconds between retransmissions of the same cluster
+
+
+class PacketTrace:
+    """Ring buffer of the last capacity packets of the transfers of an engine, see TftpComm(trace=...). One trace
+       may be shared by all the transfers, in any number of threads. Records are tuples of the time (time.time()),
+       the direction (SENT or RECEIVED), the opcode, the block number, the length, the local port, the remote
+       address and the remote port. The transfers are told apart by their local ports"""
+    DEFAULT_CAPACITY = 65536
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+
+        # Slots are handed out by a counter, whose next() is atomic, so recording takes no lock. count is the number
+        # of records recorded in all, the ring holds the last capacity of them
+        self.counter = itertools.count()
+        self.count = 0
+
+        # Looked up once per socket and address, not for every packet
+        self.localPorts = weakref.WeakKeyDictionary()
+        self.packedAddresses = {}
+
+    def record(self, direction, message, length, sock, address):
+        """Record a packet. message is anything holding the message from its start (a buffer it was received into,
+           or the header of a DATA message), length the length of the message. sock is the socket, or the asyncio
+           transport, it went through and address the remote (host, port)"""
+        if length >= MESSAGE_HEADER.size:
+            opcode, blockNumber = MESSAGE_HEADER.unpack_from(message)
+        else:
+            opcode = blockNumber = 0
+        localPort = self.localPorts.get(sock) or self.getLocalPort(sock)
+        packedAddress = self.packedAddresses.get(address[0]) or self.packAddress(address[0])
+        index = next(self.counter)
+        RECORD.pack_into(self.buffer, (index % self.capacity) * RECORD.size, time.time(), direction, opcode,
+                         blockNumber, length, localPort, address[1], packedAddress)
+        if index >= self.count:
+            self.count = index + 1
+
+    def getLocalPort(self, sock):
+        """The local port of a socket or asyncio transport, 0 while it is not bound"""
+        try:
+            if hasattr(sock, "getsockname"):
+                port = sock.getsockname()[1]
+            else:
+                port = sock.get_extra_info("socket").getsockname()[1]
+        except (AttributeError, OSError, TypeError, IndexError):
+            return 0
+        if port:
+            self.localPorts[sock] = port
+        return port
+
+    def packAddress(self, host):
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return bytes(16)
+        if address.version == 4:
+            packedAddress = bytes(10) + b"\xff\xff" + address.packed
+        else:
+            packedAddress = address.packed
+        self.packedAddresses[host] = packedAddress
+        return packedAddress
+
+    def getRecords(self):
+        """The records in the ring, oldest first. Packets recorded while this runs may or may not be in it"""
+        count = self.count
+        data = bytes(self.buffer)
+        if count > self.capacity:
+            start = (count % self.capacity) * RECORD.size
+            data = data[start:] + data[:start]
+        else:
+            data = data[:count * RECORD.size]
+        return [unpackRecord(fields) for fields in RECORD.iter_unpack(data)]
+
+    def getDropped(self):
+        """Records overwritten because the ring was full"""
+        return max(0, self.count - self.capacity)
+
+    def clear(self):
+        """Forget the records. Do not call it while transfers are running"""
+        self.counter = itertools.count()
+        self.count = 0
+
+    def save(self, path):
+        """Save the ring as a binary trace file"""
+        writeTrace(path, self.getRecords(), self.getDropped())
+
+    def savePcap(self, path):
+        """Save the ring as a pcap file"""
+        writePcap(path, self.getRecords())
+
+
+def unpackRecord(fields):
+    """The record tuple of the fields of a packed record"""
+    recordTime, direction, opcode, blockNumber, length, localPort, remotePort, packedAddress = fields
+    address = ipaddress.IPv6Address(packedAddress)
+    host = str(address.ipv4_mapped or address)
+    return (recordTime, direction, opcode, blockNumber, length, localPort, host, remotePort)
+
+
+def packRecord(record):
+    recordTime, direction, opcode, blockNumber, length, localPort, host, remotePort = record
+    address = ipaddress.ip_address(host)
+    packedAddress = bytes(10) + b"\xff\xff" + address.packed if address.version == 4 else address.packed
+    return RECORD.pack(recordTime, direction, opcode, blockNumber, length, localPort, remotePort, packedAddress)
+
+
+def writeTrace(path, records, dropped=0):
+    """Write records to a binary trace file, dropped being the number of older records which were lost"""
+    with open(path, "wb") as filehandle:
+        filehandle.write(TRACE_HEADER.pack(TRACE_MAGIC, RECORD.size, len(records) + dropped, len(records)))
+        filehandle.write(b"".join(packRecord(record) for record in records))
+
+
+def readTrace(path):
+    """Read a binary trace file. Returns the records and the number of older records which were lost. Raises an
+       OSError if the file cannot be read and a ValueError if it is not a trace"""
+    with open(path, "rb") as filehandle:
+        data = filehandle.read()
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError(path + " is not a packet trace")
+    magic, recordSize, total, count = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or recordSize != RECORD.size or len(data) < TRACE_HEADER.size + count * RECORD.size:
+        raise ValueError(path + " is not a packet trace")
+    data = data[TRACE_HEADER.size:TRACE_HEADER.size + count * RECORD.size]
+    return [unpackRecord(fields) for fields in RECORD.iter_unpack(data)], total - count
+
+
+def ipv4Checksum(header):
+    total = sum(struct.unpack(">10H", header))
+    while total > 0xFFFF:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def writePcap(path, records):
+    """Write records to a pcap file of synthesized IP and UDP packets. Only the opcode and block number of the TFTP
+       messages were recorded, so the packets are cut short after them, as with a capture length of 4 bytes of
+       payload: the original length of every packet is kept. The local address is not recorded either, it shows
+       up as 0.0.0.0 or ::"""
+    with open(path, "wb") as filehandle:
+        filehandle.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, 65535, LINKTYPE_RAW))
+        for recordTime, direction, opcode, blockNumber, length, localPort, host, remotePort in records:
+            remoteAddress = ipaddress.ip_address(host)
+            localAddress = ipaddress.ip_address("0.0.0.0" if remoteAddress.version == 4 else "::")
+            if direction == SENT:
+                source, destination, sourcePort, destinationPort = localAddress, remoteAddress, localPort, remotePort
+            else:
+                source, destination, sourcePort, destinationPort = remoteAddress, localAddress, remotePort, localPort
+
+            payload = MESSAGE_HEADER.pack(opcode, blockNumber) if length >= MESSAGE_HEADER.size else b""
+            udpHeader = UDP_HEADER.pack(sourcePort, destinationPort, UDP_HEADER.size + length, 0)
+            if remoteAddress.version == 4:
+                ipHeader = IPV4_HEADER.pack(0x45, 0, IPV4_HEADER.size + UDP_HEADER.size + length, 0, 0x4000, 64,
+                                            UDP_PROTOCOL, 0, source.packed, destination.packed)
+                ipHeader = ipHeader[:10] + struct.pack(">H", ipv4Checksum(ipHeader)) + ipHeader[12:]
+            else:
+                ipHeader = IPV6_HEADER.pack(0x60000000, UDP_HEADER.size + length, UDP_PROTOCOL, 64,
+                                            source.packed, destination.packed)
+            packet = ipHeader + udpHeader + payload
+            seconds = int(recordTime)
+            filehandle.write(PCAP_RECORD.pack(seconds, int((recordTime - seconds) * 1000000), len(packet),
+                                              len(ipHeader) + UDP_HEADER.size + length))
+            filehandle.write(packet)
+
+
+def describePacket(direction, opcode, blockNumber):
+    """Short text of a packet, e.g. "sent DATA 12" """
+    text = ("sent " if direction == SENT else "received ") + OPCODE_NAMES.get(opcode, "opcode " + str(opcode))
+    if opcode in (3, 4, 5):
+        text += " " + str(blockNumber)
+    return text
+
+
+def summarizeTrace(records, stallThreshold=DEFAULT_STALL_THRESHOLD, clusterGap=DEFAULT_CLUSTER_GAP):
+    """Sum up the transfers in a trace. Returns a list with a dictionary per transfer (told apart by the local port)
+       holding its server, direction, duration, packets, bytes of data, retransmissions, the stalls (times the
+       transfer went without a packet for more than stallThreshold seconds) and the clusters of retransmissions
+       (retransmissions less than clusterGap seconds apart). A packet sent again, DATA, an ACK or a request, is a
+       retransmission. Times are in seconds, those of stalls and clusters from the start of the transfer"""
+    transfers = {}
+    for recordTime, direction, opcode, blockNumber, length, localPort, host, remotePort in records:
+        transfer = transfers.get(localPort)
+        if transfer is None:
+            transfer = transfers[localPort] = {"localPort": localPort, "host": host, "port": remotePort,
+                                               "direction": None, "start": recordTime, "end": recordTime,
+                                               "packets": 0, "bytes": 0, "retransmits": 0, "stalls": [],
+                                               "clusters": [], "sent": set(), "lastBlock": 0, "lastPacket": None}
+        offset = recordTime - transfer["start"]
+
+        # The server answers from a port of its own, the last one seen is the one the transfer went on with
+        if direction == RECEIVED:
+            transfer["port"] = remotePort
+        if direction == SENT and opcode in (1, 2):
+            transfer["direction"] = "get" if opcode == 1 else "put"
+
+        if transfer["lastPacket"] is not None and recordTime - transfer["end"] > stallThreshold:
+            transfer["stalls"].append({"at": transfer["end"] - transfer["start"], "gap": recordTime - transfer["end"],
+                                       "after": describePacket(*transfer["lastPacket"])})
+        transfer["end"] = recordTime
+        transfer["lastPacket"] = (direction, opcode, blockNumber)
+        transfer["packets"] += 1
+        if opcode == 3:
+            transfer["bytes"] += max(0, length - MESSAGE_HEADER.size)
+
+        if direction == SENT and opcode in (1, 2, 3, 4):
+            # Block numbers wrap around after 65535, count them from the start of the transfer
+            if opcode in (3, 4):
+                difference = (blockNumber - transfer["lastBlock"]) % 0x10000
+                if difference > 0x8000:
+                    difference -= 0x10000
+                blockNumber = transfer["lastBlock"] + difference
+                transfer["lastBlock"] = blockNumber
+            key = (opcode, blockNumber)
+            if key in transfer["sent"]:
+                transfer["retransmits"] += 1
+                clusters = transfer["clusters"]
+                if clusters and offset - clusters[-1]["at"] - clusters[-1]["duration"] <= clusterGap:
+                    cluster = clusters[-1]
+                    cluster["duration"] = offset - cluster["at"]
+                    cluster["packets"] += 1
+                    cluster["firstBlock"] = min(cluster["firstBlock"], blockNumber)
+                    cluster["lastBlock"] = max(cluster["lastBlock"], blockNumber)
+                else:
+                    clusters.append({"at": offset, "duration": 0.0, "packets": 1, "firstBlock": blockNumber,
+                                     "lastBlock": blockNumber, "packet": describePacket(direction, opcode, blockNumber)})
+            transfer["sent"].add(key)
+
+    summary = []
+    for transfer in transfers.values():
+        del transfer["sent"], transfer["lastBlock"], transfer["lastPacket"]
+        transfer["duration"] = transfer["end"] - transfer["start"]
+        summary.append(transfer)
+    return summary
+
+
+def formatTraceSummary(summary, dropped=0):
+    """Text of the summary of a trace, a few lines per transfer"""
+    text = ""
+    if dropped:
+        text += str(dropped) + " older packets were overwritten in the ring, the trace starts in the middle\n"
+    for transfer in summary:
+        text += ("Transfer from port " + str(transfer["localPort"]) + " with " + transfer["host"] + ":"
+                 + str(transfer["port"]) + " (" + (transfer["direction"] or "request not in the trace") + "): "
+                 + str(transfer["packets"]) + " packets, " + str(transfer["bytes"]) + " bytes of data in "
+                 + "%.3f" % transfer["duration"] + " s\n")
+        text += ("  Retransmits: " + str(transfer["retransmits"]) + " in " + str(len(transfer["clusters"]))
+                 + " clusters\n")
+        for cluster in transfer["clusters"]:
+            text += ("    at " + "%.3f" % cluster["at"] + " s: " + str(cluster["packets"]) + " packets in "
+                     + "%.3f" % cluster["duration"] + " s, " + cluster["packet"].split(" ")[1] + " "
+                     + str(cluster["firstBlock"]) + (" to " + str(cluster["lastBlock"]) if cluster["lastBlock"] != cluster["firstBlock"] else "")
+                     + "\n")
+        text += "  Stalls: " + str(len(transfer["stalls"])) + "\n"
+        for stall in transfer["stalls"]:
+            text += ("    at " + "%.3f" % stall["at"] + " s: silent for " + "%.3f" % stall["gap"] + " s after "
+                     + stall["after"] + "\n")
+    return text
+
+
+def main(argv=None):
+    """Summarize a binary trace or convert it to pcap. Returns the exit code"""
+    parser = argparse.ArgumentParser(prog="tftptrace", description="Look into TFTP packet traces")
+    parser.add_argument("command", choices=["summary", "pcap"], help="sum up the stalls and retransmissions of the transfers (summary) or convert the trace for Wireshark (pcap)")
+    parser.add_argument("trace", help="binary trace file, as written by tftpcmd --trace")
+    parser.add_argument("output", nargs="?", help="pcap file to write (pcap only)")
+    parser.add_argument("--stall", type=float, default=DEFAULT_STALL_THRESHOLD * 1000, help="report gaps between packets longer than this, in ms (default: %(default)s)")
+    parser.add_argument("--cluster-gap", type=float, default=DEFAULT_CLUSTER_GAP * 1000, help="retransmissions less than this apart belong to the same cluster, in ms (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.command == "pcap" and not args.output:
+        parser.error("pcap needs the file to write")
+
+    try:
+        records, dropped = readTrace(args.trace)
+        if args.command == "pcap":
+            writePcap(args.output, records)
+            return 0
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Error: " + str(e) + "\n")
+        return 1
+    sys.stdout.write(formatTraceSummary(summarizeTrace(records, args.stall / 1000, args.cluster_gap / 1000), dropped))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file